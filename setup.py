@@ -47,9 +47,16 @@ setup(
     include_package_data = True,
     install_requires     = [
         'etcd3==0.6.2',
+        'netaddr==0.7.19',
         'romana-python-etcd==0.1.1',
         'vpcrouter>=1.8.11'
     ],
+    extras_require       = {
+        'streaming' : ['ijson==2.6.1'],
+        'fast_json' : ['ujson==1.35'],
+        'msgpack'   : ['msgpack==0.6.2'],
+        'zstd'      : ['zstandard==0.14.1']
+    },
     classifiers          = [
         'Programming Language :: Python',
         'Development Status :: 5 - Stable',
@@ -0,0 +1,146 @@
+"""
+Copyright 2017 Pani Networks Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+#
+# Aggregation of route entries, to keep the number of VPC route table entries
+# small.
+#
+
+import collections
+
+from .compact import pack_ip, unpack_ip
+
+
+class _Node(object):
+    """
+    A node of the binary prefix tree: The hosts of the route entry for its
+    prefix (if there is one) and its two child nodes.
+
+    """
+    __slots__ = ("hosts", "children")
+
+    def __init__(self):
+        self.hosts    = None
+        self.children = [None, None]
+
+
+def _parse_cidr(cidr):
+    """
+    Return a tuple with the network address (as integer) and the prefix
+    length of an IPv4 CIDR, or None if it isn't one in canonical form (host
+    bits cleared).
+
+    """
+    addr, sep, prefix_len = cidr.partition("/")
+    net = pack_ip(addr)
+    if not sep or type(net) not in (int, long) or not prefix_len.isdigit():
+        return None
+    prefix_len = int(prefix_len)
+    if prefix_len > 32 or net & ((1 << (32 - prefix_len)) - 1):
+        return None
+    return net, prefix_len
+
+
+def _insert(root, net, prefix_len, hosts):
+    """
+    Add a route entry to the prefix tree.
+
+    """
+    node = root
+    for i in range(prefix_len):
+        bit   = (net >> (31 - i)) & 1
+        child = node.children[bit]
+        if child is None:
+            child = node.children[bit] = _Node()
+        node = child
+    node.hosts = hosts
+
+
+def _aggregate(node, net, prefix_len, inherited):
+    """
+    Return the aggregated route entries (a list of (net, prefix length,
+    hosts)) for the subtree of a node.
+
+    'inherited' are the hosts of the closest route entry above the node,
+    which applies to all addresses of the subtree not covered by a more
+    specific entry.
+
+    """
+    effective = node.hosts if node.hosts is not None else inherited
+    entries   = []
+    covered   = []     # hosts for each fully covered child prefix, or None
+    for bit in (0, 1):
+        child = node.children[bit]
+        if child is None:
+            covered.append(None)
+            continue
+        child_net     = net | (bit << (31 - prefix_len))
+        child_entries = _aggregate(child, child_net, prefix_len + 1,
+                                   effective)
+        if len(child_entries) == 1 and \
+                child_entries[0][:2] == (child_net, prefix_len + 1):
+            covered.append(child_entries[0][2])
+        else:
+            covered.append(None)
+        entries.extend(child_entries)
+
+    if covered[0] is not None and covered[0] == covered[1]:
+        # Both halves go to the same hosts: One entry for the whole prefix.
+        # Any entry of our own would be shadowed by them anyway.
+        entries = [(net, prefix_len, covered[0])]
+    elif node.hosts is not None:
+        entries.append((net, prefix_len, node.hosts))
+
+    if entries and entries[-1][:2] == (net, prefix_len) and \
+            entries[-1][2] == inherited:
+        # Same hosts as the enclosing entry, which covers it already
+        entries.pop()
+    return entries
+
+
+def aggregate_routes(route_spec):
+    """
+    Return a route spec with fewer entries, which routes every address to
+    the same hosts as the given one.
+
+    Adjacent CIDRs with identical host lists are combined into the covering
+    prefix, and CIDRs with the same host list as the closest enclosing CIDR
+    are dropped. The entries are arranged in a binary prefix tree, which is
+    simplified bottom up, so the cost grows linearly with the number of
+    entries.
+
+    Host lists are only compared as a whole, they need to be sorted (as in a
+    validated route spec). Entries, which aren't IPv4 CIDRs, are left as
+    they are. If there is an IPv4 CIDR with host bits set, the route spec is
+    returned unchanged, since the covered addresses would be ambiguous.
+
+    """
+    root   = _Node()
+    result = {}
+    for cidr, hosts in route_spec.items():
+        parsed = _parse_cidr(cidr)
+        if parsed is None:
+            if ":" not in cidr:
+                return route_spec
+            result[cidr] = hosts
+        else:
+            _insert(root, parsed[0], parsed[1], tuple(hosts))
+
+    for net, prefix_len, hosts in _aggregate(root, 0, 0, None):
+        result["%s/%d" % (unpack_ip(net), prefix_len)] = list(hosts)
+    return collections.OrderedDict((cidr, result[cidr])
+                                   for cidr in sorted(result))
@@ -0,0 +1,175 @@
+"""
+Copyright 2017 Pani Networks Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+#
+# Coalescing of bursts of change notifications, so that expensive reloads
+# are only performed once per burst.
+#
+
+import logging
+import threading
+import time
+
+
+class EventCoalescer(object):
+    """
+    Collects change notifications and calls a function at most once per
+    debounce window.
+
+    After a notification, the worker waits until no further notification has
+    arrived for 'debounce_time' seconds and then calls the function once.
+    If notifications keep arriving, the function is called anyway once
+    'max_delay' seconds have passed since the first notification of the
+    burst, so that updates are never starved.
+
+    A notification may carry data (for example the new value of a key). The
+    function is called with the data of the last notification of the burst,
+    or with None if that notification didn't carry any.
+
+    The function is only ever called from the single worker thread, so calls
+    never overlap and are made in the order of the notifications.
+
+    """
+    def __init__(self, func, debounce_time, max_delay,
+                 name="RomanaCoalescer"):
+        self.func             = func
+        self.debounce_time    = debounce_time
+        self.max_delay        = max_delay
+        self.name             = name
+        self.cond             = threading.Condition()
+        self.keep_running     = True
+        self.thread           = None
+        self.first_event_time = None   # first notification of current burst
+        self.last_event_time  = None   # last notification of current burst
+        self.pending_data     = None   # data of the last notification
+        self.immediate        = False  # process burst without waiting
+        self.num_bursts_taken = 0
+        self.num_bursts_done  = 0
+        self.num_events       = 0
+        self.num_calls        = 0
+
+    def _add_notification(self, data):
+        # Record a notification. Needs to be called with the lock held.
+        now = time.time()
+        if self.first_event_time is None:
+            self.first_event_time = now
+        self.last_event_time = now
+        self.pending_data    = data
+        self.num_events += 1
+        self.cond.notify_all()
+
+    def notify(self, data=None):
+        """
+        Record a change notification and wake up the worker.
+
+        """
+        with self.cond:
+            self._add_notification(data)
+
+    def flush(self, data=None):
+        """
+        Record a notification and have it processed by the worker right away,
+        without waiting for the debounce time.
+
+        Blocks until the function has been called for this notification.
+        If the worker isn't running, the function is called directly.
+
+        """
+        with self.cond:
+            if self.thread:
+                self._add_notification(data)
+                self.immediate = True
+                burst = self.num_bursts_taken + 1
+                while self.keep_running and self.num_bursts_done < burst:
+                    self.cond.wait()
+                return
+        self.num_calls += 1
+        self.func(data)
+
+    def _wait_for_burst(self):
+        """
+        Block until a burst of notifications is complete or has reached the
+        maximum delay.
+
+        Return a tuple with a flag, which is False if the coalescer was
+        stopped in the meantime, and the data of the last notification.
+
+        """
+        with self.cond:
+            while self.keep_running and self.first_event_time is None:
+                self.cond.wait()
+            while self.keep_running and not self.immediate:
+                deadline = min(self.last_event_time + self.debounce_time,
+                               self.first_event_time + self.max_delay)
+                now = time.time()
+                if now >= deadline:
+                    break
+                self.cond.wait(deadline - now)
+            data                  = self.pending_data
+            self.first_event_time = None
+            self.last_event_time  = None
+            self.pending_data     = None
+            self.immediate        = False
+            self.num_bursts_taken += 1
+            return self.keep_running, data
+
+    def _burst_done(self):
+        # Wake up anyone who waits for the processing of a burst.
+        with self.cond:
+            self.num_bursts_done = self.num_bursts_taken
+            self.cond.notify_all()
+
+    def _run(self):
+        """
+        Worker loop: Call the function once for every burst.
+
+        """
+        while True:
+            keep_running, data = self._wait_for_burst()
+            if not keep_running:
+                break
+            self.num_calls += 1
+            try:
+                self.func(data)
+            except Exception as e:
+                logging.error("Error while processing coalesced events: %s" %
+                              str(e))
+            self._burst_done()
+
+    def start(self):
+        """
+        Start the worker thread.
+
+        """
+        self.keep_running = True
+        self.thread = threading.Thread(target = self._run,
+                                       name   = self.name,
+                                       kwargs = {})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the worker thread. Pending notifications are discarded.
+
+        """
+        with self.cond:
+            self.keep_running = False
+            self.cond.notify_all()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
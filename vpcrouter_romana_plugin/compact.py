@@ -0,0 +1,96 @@
+"""
+Copyright 2017 Pani Networks Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+#
+# Compact representation of route entries, for the ones we keep in memory.
+#
+
+import socket
+import struct
+
+
+_IPV4 = struct.Struct("!I")
+
+
+def pack_ip(ip):
+    """
+    Return a compact form of an IP address: An IPv4 address as an integer,
+    anything else unchanged.
+
+    Only the strict dotted quad notation is packed, so that unpacking
+    restores exactly the same string. Raises ValueError if the address isn't
+    a string at all.
+
+    """
+    if type(ip) not in (str, unicode):
+        raise ValueError("Invalid host IP '%s'" % str(ip))
+    try:
+        return _IPV4.unpack(socket.inet_pton(socket.AF_INET, ip))[0]
+    except (socket.error, ValueError, UnicodeError):
+        return ip
+
+
+def unpack_ip(packed):
+    """
+    Return the string form of an IP address packed by pack_ip().
+
+    """
+    if type(packed) in (int, long):
+        return socket.inet_ntop(socket.AF_INET, _IPV4.pack(packed))
+    return packed
+
+
+def intern_ip(ip):
+    """
+    Return a compact form of an IP address, which still is a string: An ASCII
+    address as an interned byte string, anything else unchanged.
+
+    An interned byte string takes less than half the memory of the unicode
+    string the JSON decoders return, and every route entry with the same
+    address shares it. Unlike pack_ip(), nothing needs to be unpacked when
+    the entry is used.
+
+    """
+    if type(ip) is unicode:
+        try:
+            ip = ip.encode("ascii")
+        except UnicodeError:
+            return ip
+    if type(ip) is str:
+        return intern(ip)
+    return ip
+
+
+def pack_routes(routes):
+    """
+    Return a compact form of route entries (CIDR to list of host IPs).
+
+    The host lists become sorted tuples of packed addresses, without
+    duplicates. Sorting and removing duplicates doesn't change the meaning
+    of a host list, vpc-router does the same.
+
+    """
+    return dict((cidr, tuple(sorted(set(pack_ip(ip) for ip in hosts))))
+                for cidr, hosts in routes.items())
+
+
+def unpack_hosts(packed_hosts):
+    """
+    Return a plain list of host IP strings for a packed host tuple.
+
+    """
+    return [unpack_ip(ip) for ip in packed_hosts]
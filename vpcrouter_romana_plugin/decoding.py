@@ -0,0 +1,350 @@
+"""
+Copyright 2017 Pani Networks Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+#
+# Decoding of the raw Romana topology data.
+#
+
+import importlib
+import io
+import json
+import logging
+import re
+import zlib
+
+try:
+    import msgpack      # optional, for msgpack encoded values
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard    # optional, for zstd compressed values
+except ImportError:
+    zstandard = None
+
+
+# ijson (optional) is used for streaming decode, but only with one of its
+# compiled backends. Its pure Python backend is slower than the stdlib
+# decoder with a pruning hook, which we use in that case.
+ijson         = None
+ijson_backend = None
+for ijson_backend in ["yajl2_c", "yajl2_cffi", "yajl2"]:
+    try:
+        ijson = importlib.import_module("ijson.backends." + ijson_backend)
+        break
+    except ImportError:
+        ijson_backend = None
+
+
+# The only keys of the topology data we need to assemble a route spec. In
+# addition, the keys of the 'networks' map (the network names) are kept.
+ROUTING_KEYS = frozenset(["networks", "host_groups", "groups", "hosts",
+                          "cidr", "ip"])
+
+
+# Supported JSON backends for decoding the complete topology data, fastest
+# first.
+JSON_BACKENDS = ["orjson", "ujson", "simplejson", "json"]
+
+
+def get_json_backend(backend="auto"):
+    """
+    Return a tuple with the name and the decode function of a JSON backend.
+
+    With 'auto', the fastest installed backend is picked. If the requested
+    backend isn't installed, we fall back to the stdlib 'json' module.
+
+    """
+    names = JSON_BACKENDS if backend == "auto" else [backend]
+    for name in names:
+        try:
+            return name, importlib.import_module(name).loads
+        except ImportError:
+            pass
+    logging.warning("Romana watcher plugin: JSON backend '%s' is not "
+                    "available, using 'json'" % backend)
+    return "json", json.loads
+
+
+# JSON backends, whose decoder can decode a value at any position of the text
+# and tell where it ends
+KEYED_JSON_BACKENDS = ["simplejson", "json"]
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+class Networks(dict):
+    """
+    The decoded 'networks' map of the topology data, with a key for the raw
+    text of every network.
+
+    The key of a network changes whenever its raw text does, so it tells
+    whether a network may have changed, without looking at its data.
+
+    """
+    raw_keys = None     # network name -> key
+
+
+def _decode_object(text, idx, decode_member):
+    """
+    Decode the JSON object at the given index of the text, with a function,
+    which decodes the value of a member (from its name and the index of the
+    value) and returns it with the index after the value.
+
+    Returns a tuple with the members (as list of pairs) and the index after
+    the object.
+
+    """
+    if text[idx:idx + 1] != "{":
+        raise ValueError("Expecting object at char %d" % idx)
+    members = []
+    idx     = _WHITESPACE.match(text, idx + 1).end()
+    if text[idx:idx + 1] == "}":
+        return members, idx + 1
+    while True:
+        name, idx = decode_member(None, idx)
+        idx       = _WHITESPACE.match(text, idx).end()
+        if not isinstance(name, basestring) or text[idx:idx + 1] != ":":
+            raise ValueError("Expecting property name at char %d" % idx)
+        value, idx = decode_member(name,
+                                   _WHITESPACE.match(text, idx + 1).end())
+        members.append((name, value))
+        idx = _WHITESPACE.match(text, idx).end()
+        if text[idx:idx + 1] == "}":
+            return members, idx + 1
+        if text[idx:idx + 1] != ",":
+            raise ValueError("Expecting ',' delimiter at char %d" % idx)
+        idx = _WHITESPACE.match(text, idx + 1).end()
+
+
+def _decode_keyed(text, decoder):
+    """
+    Decode JSON topology data, with the 'networks' map as Networks object,
+    which has the hash of every network's raw text as its key. Decoding the
+    networks one by one costs no more than decoding the data at once, and
+    hashing the raw text is much cheaper than walking a network's groups.
+
+    """
+    raw_decode = decoder.raw_decode
+    raw_keys   = {}
+
+    def _network(name, idx):
+        if name is None:
+            return raw_decode(text, idx)
+        value, end     = raw_decode(text, idx)
+        raw_keys[name] = hash(text[idx:end])
+        return value, end
+
+    def _member(name, idx):
+        if name != "networks" or text[idx:idx + 1] != "{":
+            return raw_decode(text, idx)
+        members, end      = _decode_object(text, idx, _network)
+        networks          = Networks(members)
+        networks.raw_keys = raw_keys
+        return networks, end
+
+    idx = _WHITESPACE.match(text).end()
+    if text[idx:idx + 1] != "{":
+        # Not what we expect, the route spec assembly reports it
+        return decoder.decode(text)
+    members, idx = _decode_object(text, idx, _member)
+    if _WHITESPACE.match(text, idx).end() != len(text):
+        raise ValueError("Extra data at char %d" % idx)
+    return dict(members)
+
+
+def get_keyed_decoder(backend):
+    """
+    Return a decode function for JSON topology data with the given backend,
+    which keys the raw text of every network (see Networks), or None if the
+    backend doesn't support it.
+
+    """
+    if backend not in KEYED_JSON_BACKENDS:
+        return None
+    decoder = importlib.import_module(backend).JSONDecoder()
+    return lambda data: _decode_keyed(data, decoder)
+
+
+def _prune_pairs(pairs):
+    """
+    object_pairs_hook for the JSON decoder, which drops all keys that aren't
+    needed for routing.
+
+    Objects are decoded bottom up, so the name of a network can't be told
+    from any other key. A network is recognized by its (already pruned)
+    contents instead.
+
+    """
+    return dict((k, v) for k, v in pairs
+                if k in ROUTING_KEYS or
+                (type(v) is dict and "host_groups" in v))
+
+
+_START_EVENTS = ("start_map", "start_array")
+_END_EVENTS   = ("end_map", "end_array")
+
+
+def _skip_container(events):
+    """
+    Consume the events of a map or array, whose start event was just seen.
+
+    """
+    level = 1
+    for event, value in events:
+        if event in _START_EVENTS:
+            level += 1
+        elif event in _END_EVENTS:
+            level -= 1
+            if not level:
+                return
+
+
+def _decode_events(events):
+    """
+    Build the pruned topology from a stream of ijson parser events.
+
+    Only values under routing keys (and under the network names) are built.
+    Any other value, no matter how big, is skipped without creating any
+    objects for it.
+
+    """
+    events = iter(events)
+    root   = None
+    stack  = []     # (container, key under which it was found)
+    key    = None   # last map key seen
+    for event, value in events:
+        if event == "map_key":
+            key = value
+            continue
+        if event in _END_EVENTS:
+            stack.pop()
+            continue
+
+        # A value starts. List items inherit the context key of their list.
+        parent, context = stack[-1] if stack else (None, None)
+        if type(parent) is dict:
+            if key not in ROUTING_KEYS and context != "networks":
+                if event in _START_EVENTS:
+                    _skip_container(events)
+                continue
+            context = key
+
+        if event == "start_map":
+            obj = {}
+        elif event == "start_array":
+            obj = []
+        else:
+            obj = value
+
+        if parent is None:
+            root = obj
+        elif type(parent) is dict:
+            parent[key] = obj
+        else:
+            parent.append(obj)
+        if event in _START_EVENTS:
+            stack.append((obj, context))
+    return root
+
+
+def decode_topology_streaming(data):
+    """
+    Decode only the parts of the topology data, which are needed for
+    routing: The networks, their host groups, CIDRs and host IPs.
+
+    With ijson installed, the data is parsed incrementally and the full
+    object tree is never built. Without it, the stdlib decoder is used with
+    a hook, which prunes every object as soon as it has been decoded.
+
+    """
+    if ijson is None:
+        return json.loads(data, object_pairs_hook=_prune_pairs)
+    if type(data) is unicode:
+        data = data.encode("utf-8")
+    return _decode_events(ijson.basic_parse(io.BytesIO(data)))
+
+
+def streaming_parser_name():
+    """
+    Return the name of the parser used for streaming decode.
+
+    """
+    if ijson is not None:
+        return "ijson (%s)" % ijson_backend
+    return "json (pruning)"
+
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+def _is_msgpack(data):
+    """
+    Return True if the data looks like a msgpack encoded map.
+
+    JSON text starts with '{' or whitespace, while a msgpack map starts with
+    a fixmap (0x80 - 0x8f), map16 (0xde) or map32 (0xdf) marker.
+
+    """
+    first = ord(data[0])
+    return 0x80 <= first <= 0x8f or first in (0xde, 0xdf)
+
+
+def _decompress(data):
+    """
+    Return the name of the compression and the decompressed data, or None
+    and the unchanged data if it isn't compressed.
+
+    """
+    if data.startswith(GZIP_MAGIC):
+        return "gzip", zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    if data.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise ValueError("Topology data is zstd compressed, but the "
+                             "'zstandard' module is not installed")
+        return "zstd", zstandard.ZstdDecompressor().decompressobj() \
+                                                   .decompress(data)
+    return None, data
+
+
+def decode_value(data, decode):
+    """
+    Decode a topology value, which may be compressed (gzip or zstd) and may
+    be encoded as JSON or msgpack. The format is detected automatically.
+
+    JSON is decoded with the given decode function.
+
+    Returns a tuple with the name of the detected format (for example
+    'gzip+json') and the decoded data.
+
+    """
+    if not data or type(data) is unicode:
+        # Text can only be plain JSON
+        return "json", decode(data)
+
+    compression, data = _decompress(data)
+    if _is_msgpack(data):
+        if msgpack is None:
+            raise ValueError("Topology data is msgpack encoded, but the "
+                             "'msgpack' module is not installed")
+        encoding, obj = "msgpack", msgpack.unpackb(data, raw=False)
+    else:
+        encoding, obj = "json", decode(data)
+    if compression:
+        return "%s+%s" % (compression, encoding), obj
+    return encoding, obj
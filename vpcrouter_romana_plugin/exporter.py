@@ -0,0 +1,95 @@
+"""
+Copyright 2017 Pani Networks Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+#
+# HTTP endpoint for scraping the plugin's metrics with Prometheus.
+#
+
+import BaseHTTPServer
+import logging
+import threading
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers GET requests for /metrics with the rendered metrics.
+
+    """
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        try:
+            body = self.server.render()
+        except Exception as e:
+            logging.error("Romana watcher plugin: Cannot render metrics: %s" %
+                          str(e))
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("Metrics request: " + format % args)
+
+
+class MetricsServer(object):
+    """
+    A small HTTP server, which serves the metrics on /metrics in a thread of
+    its own.
+
+    The render function is called for every request and returns the metrics
+    in the Prometheus text format.
+
+    """
+    def __init__(self, addr, port, render):
+        self.server        = BaseHTTPServer.HTTPServer((addr, port),
+                                                       _MetricsHandler)
+        self.server.render = render
+        self.thread        = None
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        """
+        Start serving requests.
+
+        """
+        self.thread = threading.Thread(target = self.server.serve_forever,
+                                       name   = "RomanaMetrics",
+                                       kwargs = {})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop serving requests and close the socket.
+
+        """
+        if self.thread:
+            self.server.shutdown()
+            self.thread.join()
+            self.thread = None
+        self.server.server_close()
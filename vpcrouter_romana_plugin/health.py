@@ -0,0 +1,280 @@
+"""
+Copyright 2017 Pani Networks Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+#
+# Tracking the health of the connection to etcd, and scheduling of health
+# checks and reconnects.
+#
+
+import random
+import time
+
+
+class HealthMonitor(object):
+    """
+    Keeps track of the health of the etcd connection.
+
+    Liveness is derived from two sources: Explicit health probes, whose
+    latency is recorded, and activity on the watch. While watch events are
+    flowing, the connection is known to be alive and probes can be skipped.
+
+    """
+    def __init__(self):
+        self.last_activity_time = None
+        self.last_probe_latency = None
+        self.max_probe_latency  = None
+        self.num_probes         = 0
+        self.num_probes_skipped = 0
+        self.num_probe_failures = 0
+
+    def record_activity(self):
+        """
+        Record that we have just received something on the watch.
+
+        """
+        self.last_activity_time = time.time()
+
+    def recently_active(self, window):
+        """
+        Return True if there was watch activity within the last 'window'
+        seconds.
+
+        """
+        return self.last_activity_time is not None and \
+            time.time() - self.last_activity_time < window
+
+    def record_probe(self, latency):
+        """
+        Record the latency (in seconds) of a successful probe.
+
+        """
+        self.num_probes        += 1
+        self.last_probe_latency = latency
+        self.max_probe_latency  = max(latency, self.max_probe_latency)
+
+    def record_probe_failure(self):
+        """
+        Record a failed probe.
+
+        """
+        self.num_probes         += 1
+        self.num_probe_failures += 1
+
+    def get_stats(self):
+        """
+        Return the health stats as a dictionary, latencies in milliseconds.
+
+        """
+        def _ms(latency):
+            return round(latency * 1000, 3) if latency is not None else None
+
+        return {
+            "probes"                : self.num_probes,
+            "probes_skipped"        : self.num_probes_skipped,
+            "probe_failures"        : self.num_probe_failures,
+            "last_probe_latency_ms" : _ms(self.last_probe_latency),
+            "max_probe_latency_ms"  : _ms(self.max_probe_latency)
+        }
+
+
+class Backoff(object):
+    """
+    Capped exponential backoff with jitter.
+
+    The base delay doubles with every attempt, up to the maximum. The actual
+    delay is picked at random between half the base delay and the full base
+    delay, so that many clients, which lost their connection at the same
+    time, don't all retry in lockstep.
+
+    """
+    def __init__(self, min_delay, max_delay, factor=2.0):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.factor    = factor
+        self.attempts  = 0
+
+    def next_delay(self):
+        """
+        Return the delay before the next attempt.
+
+        """
+        base = min(self.max_delay, self.min_delay * self.factor**self.attempts)
+        self.attempts += 1
+        return random.uniform(base / 2.0, base)
+
+    def reset(self):
+        """
+        Start again with the minimum delay.
+
+        """
+        self.attempts = 0
+
+
+class AdaptiveInterval(object):
+    """
+    A check interval, which grows while things are stable and drops back to
+    the minimum after a failure.
+
+    """
+    def __init__(self, min_interval, max_interval, factor=1.5):
+        self.minimum = min_interval
+        self.maximum = max_interval
+        self.factor  = factor
+        self.current = min_interval
+
+    def grow(self):
+        """
+        Lengthen the interval after a successful check.
+
+        """
+        self.current = min(self.maximum, self.current * self.factor)
+
+    def reset(self):
+        """
+        Go back to the minimum interval.
+
+        """
+        self.current = self.minimum
+
+
+class Endpoint(object):
+    """
+    One etcd cluster member, with its observed latency and failures.
+
+    """
+    def __init__(self, host, port):
+        self.host              = host
+        self.port              = port
+        self.latency           = None   # moving average, in seconds
+        self.num_failures      = 0
+        self.last_failure_time = None
+
+    def __str__(self):
+        return "%s:%d" % (self.host, self.port)
+
+    def recently_failed(self, retry_time):
+        """
+        Return True if the endpoint failed within the last 'retry_time'
+        seconds.
+
+        """
+        return self.last_failure_time is not None and \
+            time.time() - self.last_failure_time < retry_time
+
+
+class EndpointSet(object):
+    """
+    The etcd cluster members we can connect to, ranked by health.
+
+    Members, which did not fail within the last 'retry_time' seconds, are
+    preferred, in the configured order. If all members failed recently, the
+    one that failed longest ago is picked.
+
+    Latency is only observed for the member we are connected to, so it is
+    reported in the stats, but not used for the ranking.
+
+    """
+    LATENCY_WEIGHT = 0.3    # weight of a new sample in the moving average
+
+    def __init__(self, addresses, retry_time):
+        self.endpoints  = [Endpoint(host, port) for host, port in addresses]
+        self.retry_time = retry_time
+
+    def _rank(self, index):
+        ep = self.endpoints[index]
+        if ep.recently_failed(self.retry_time):
+            return (1, ep.last_failure_time, index)
+        return (0, 0, index)
+
+    def select(self):
+        """
+        Return the best endpoint to connect to.
+
+        """
+        best = min(range(len(self.endpoints)), key=self._rank)
+        return self.endpoints[best]
+
+    def has_healthy(self):
+        """
+        Return True if there is an endpoint, which did not fail recently.
+
+        """
+        return any(not ep.recently_failed(self.retry_time)
+                   for ep in self.endpoints)
+
+    def record_latency(self, endpoint, latency):
+        """
+        Add a latency sample (in seconds) for an endpoint.
+
+        """
+        if endpoint.latency is None:
+            endpoint.latency = latency
+        else:
+            endpoint.latency += self.LATENCY_WEIGHT * \
+                                            (latency - endpoint.latency)
+
+    def record_failure(self, endpoint, failure_time=None):
+        """
+        Record a failure of an endpoint, by default at the current time.
+
+        """
+        endpoint.num_failures     += 1
+        endpoint.last_failure_time = failure_time or time.time()
+
+    def get_stats(self):
+        """
+        Return a list with the stats of all endpoints, latency in
+        milliseconds.
+
+        """
+        def _ms(latency):
+            return round(latency * 1000, 3) if latency is not None else None
+
+        return [
+            {
+                "endpoint"   : str(ep),
+                "latency_ms" : _ms(ep.latency),
+                "failures"   : ep.num_failures,
+                "healthy"    : not ep.recently_failed(self.retry_time)
+            }
+            for ep in self.endpoints
+        ]
+
+
+def parse_endpoints(addr, default_port):
+    """
+    Parse a comma separated list of etcd addresses, each optionally with a
+    port ('host:port', or '[v6-address]:port').
+
+    Returns a list of (host, port) tuples. Raises ValueError for invalid
+    ports.
+
+    """
+    endpoints = []
+    for elem in addr.split(","):
+        elem = elem.strip()
+        if not elem:
+            continue
+        host, sep, port = elem.rpartition(":")
+        if not sep or (":" in host and not host.endswith("]")):
+            # No port given (possibly a plain IPv6 address)
+            host, port = elem, default_port
+        port = int(port)
+        if not 0 < port < 65535:
+            raise ValueError("Invalid port '%d'" % port)
+        endpoints.append((host.strip("[]"), port))
+    return endpoints
@@ -0,0 +1,237 @@
+"""
+Copyright 2017 Pani Networks Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+#
+# Counters and latency histograms for the processing of topology updates.
+#
+
+import bisect
+import collections
+import contextlib
+import math
+import threading
+import time
+
+
+def _format_number(value):
+    """
+    Format a number for the Prometheus text format.
+
+    """
+    if type(value) is float:
+        return repr(value)
+    return str(int(value))
+
+
+class Histogram(object):
+    """
+    The latency distribution of an operation.
+
+    Count, sum and maximum cover all samples. The samples are also counted
+    in fixed buckets, for export. Percentiles are computed on demand from
+    the most recent samples only.
+
+    """
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+               1.0, 2.5, 5.0, 10.0)     # upper bounds, in seconds
+    WINDOW  = 1024                      # samples kept for the percentiles
+
+    def __init__(self):
+        self.count         = 0
+        self.sum           = 0.0
+        self.max           = None
+        self.bucket_counts = [0] * (len(self.BUCKETS) + 1)   # last: +Inf
+        self.samples       = collections.deque(maxlen=self.WINDOW)
+
+    def observe(self, value):
+        """
+        Add a sample (in seconds).
+
+        """
+        self.count += 1
+        self.sum   += value
+        self.max    = max(value, self.max)
+        self.bucket_counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.samples.append(value)
+
+    def percentiles(self, *percents):
+        """
+        Return the given percentiles (nearest rank) of the recent samples, or
+        None for each if there are no samples.
+
+        """
+        samples = sorted(self.samples)
+        if not samples:
+            return [None for p in percents]
+        return [samples[max(0, int(math.ceil(p / 100.0 * len(samples))) - 1)]
+                for p in percents]
+
+    def get_stats(self):
+        """
+        Return the latency stats as a dictionary, in milliseconds.
+
+        """
+        def _ms(latency):
+            return round(latency * 1000, 3) if latency is not None else None
+
+        p50, p95, p99 = self.percentiles(50, 95, 99)
+        return {
+            "count"  : self.count,
+            "p50_ms" : _ms(p50),
+            "p95_ms" : _ms(p95),
+            "p99_ms" : _ms(p99),
+            "max_ms" : _ms(self.max)
+        }
+
+
+class Metrics(object):
+    """
+    Named counters and latency histograms.
+
+    Counters and histograms are created when they are first used. Updates
+    may come from any thread.
+
+    In addition, the time of the first change notification, which wasn't
+    processed yet, is tracked, so that the latency from a change in etcd to
+    the route spec update can be measured.
+
+    """
+    def __init__(self):
+        self.lock             = threading.Lock()
+        self.counters         = {}
+        self.histograms       = {}
+        self.first_event_time = None
+
+    def inc(self, name, value=1):
+        """
+        Increment a counter.
+
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def get_counter(self, name):
+        """
+        Return the current value of a counter.
+
+        """
+        with self.lock:
+            return self.counters.get(name, 0)
+
+    def observe(self, name, latency):
+        """
+        Add a latency sample (in seconds) to a histogram.
+
+        """
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(latency)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """
+        Context manager, which adds the time spent in it to a histogram.
+
+        """
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start_time)
+
+    def record_event(self):
+        """
+        Count a change notification and remember its time, unless an earlier
+        one is still waiting to be processed.
+
+        """
+        with self.lock:
+            self.counters["watch_events"] = \
+                                self.counters.get("watch_events", 0) + 1
+            if self.first_event_time is None:
+                self.first_event_time = time.time()
+
+    def take_event_time(self):
+        """
+        Return the time of the first unprocessed change notification (or
+        None) and start over.
+
+        """
+        with self.lock:
+            event_time, self.first_event_time = self.first_event_time, None
+        return event_time
+
+    def render_text(self, prefix, counters=None, gauges=None):
+        """
+        Return the counters and histograms in the Prometheus text exposition
+        format.
+
+        Further counters and gauges (name to value) may be passed in, for
+        values that are kept elsewhere. Gauges with value None are left out.
+        All histograms are exported as a single metric, with the name of the
+        histogram as 'stage' label.
+
+        """
+        with self.lock:
+            all_counters = dict(self.counters)
+            histograms   = [(name, list(h.bucket_counts), h.sum, h.count)
+                            for name, h in sorted(self.histograms.items())]
+        all_counters.update(counters or {})
+
+        lines = []
+        for name, value in sorted(all_counters.items()):
+            metric = "%s%s_total" % (prefix, name)
+            lines.append("# TYPE %s counter" % metric)
+            lines.append("%s %s" % (metric, _format_number(value)))
+        for name, value in sorted((gauges or {}).items()):
+            if value is None:
+                continue
+            metric = prefix + name
+            lines.append("# TYPE %s gauge" % metric)
+            lines.append("%s %s" % (metric, _format_number(value)))
+        if histograms:
+            metric = prefix + "stage_duration_seconds"
+            lines.append("# HELP %s Duration of the processing stages." %
+                         metric)
+            lines.append("# TYPE %s histogram" % metric)
+            bounds = [repr(b) for b in Histogram.BUCKETS] + ["+Inf"]
+            for name, bucket_counts, total, count in histograms:
+                cumulative = 0
+                for bound, bucket_count in zip(bounds, bucket_counts):
+                    cumulative += bucket_count
+                    lines.append('%s_bucket{stage="%s",le="%s"} %d' %
+                                 (metric, name, bound, cumulative))
+                lines.append('%s_sum{stage="%s"} %s' %
+                             (metric, name, _format_number(total)))
+                lines.append('%s_count{stage="%s"} %d' %
+                             (metric, name, count))
+        return "\n".join(lines) + "\n"
+
+    def get_stats(self):
+        """
+        Return the counters and latency stats as a dictionary.
+
+        """
+        with self.lock:
+            return {
+                "counters"  : dict(self.counters),
+                "latencies" : dict((name, histogram.get_stats())
+                                   for name, histogram
+                                   in self.histograms.items())
+            }
@@ -0,0 +1,159 @@
+"""
+Copyright 2017 Pani Networks Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+#
+# On-demand profiling of topology updates.
+#
+
+import cProfile
+import datetime
+import logging
+import os
+import pstats
+import time
+import urllib
+
+try:
+    import tracemalloc  # only available in Python 3 (or patched Python 2)
+except ImportError:
+    tracemalloc = None
+
+
+DEFAULT_PROFILE_UPDATES = 5
+
+# Number of entries listed in the text reports
+REPORT_LINES = 40
+
+
+class UpdateProfiler(object):
+    """
+    Runs the next few topology updates under cProfile (and tracemalloc, if
+    available) once it is armed, and writes the results to a directory.
+
+    For every profiled update, a subdirectory with the profile (in pstats
+    format and as text report), the allocation report and the raw topology
+    payload that was processed is created.
+
+    """
+    def __init__(self, directory, num_updates=DEFAULT_PROFILE_UPDATES):
+        self.directory    = directory
+        self.num_updates  = num_updates
+        self.remaining    = 0
+        self.running      = False
+        self.payloads     = {}      # name -> raw data
+        self.num_profiled = 0
+        self.last_dump    = None
+
+    def arm(self):
+        """
+        Have the next 'num_updates' updates profiled. May be called from any
+        thread, or from a signal handler, so no lock is taken: The counter is
+        only ever set here and decremented by the update worker.
+
+        """
+        self.remaining = self.num_updates
+
+    def is_armed(self):
+        """
+        Return True if the next update should be profiled.
+
+        """
+        return self.remaining > 0
+
+    def record_payload(self, name, data):
+        """
+        Keep the raw data processed by the update that is being profiled.
+
+        """
+        if self.running:
+            self.payloads[name] = data
+
+    def run(self, func, *args):
+        """
+        Call the function under the profiler and dump the results.
+
+        """
+        self.remaining = max(0, self.remaining - 1)
+        self.payloads  = {}
+        self.running   = True
+        profile        = cProfile.Profile()
+        if tracemalloc:
+            tracemalloc.start()
+        start_time = time.time()
+        try:
+            profile.runcall(func, *args)
+        finally:
+            elapsed  = time.time() - start_time
+            snapshot = None
+            if tracemalloc:
+                snapshot = tracemalloc.take_snapshot()
+                tracemalloc.stop()
+            self.running = False
+            try:
+                self.dump(profile, snapshot, elapsed)
+            except Exception as e:
+                logging.error("Romana watcher plugin: Cannot write profile "
+                              "to '%s': %s" % (self.directory, str(e)))
+
+    def dump(self, profile, snapshot, elapsed):
+        """
+        Write the profile, allocation report and payloads of an update into
+        a new subdirectory.
+
+        """
+        self.num_profiled += 1
+        path = os.path.join(self.directory, "update-%s-%d" %
+                            (datetime.datetime.now().strftime(
+                                                    "%Y%m%d-%H%M%S"),
+                             self.num_profiled))
+        os.makedirs(path)
+
+        profile.dump_stats(os.path.join(path, "profile.pstats"))
+        with open(os.path.join(path, "profile.txt"), "w") as f:
+            f.write("Update took %.3f seconds\n\n" % elapsed)
+            stats = pstats.Stats(profile, stream=f)
+            stats.sort_stats("cumulative").print_stats(REPORT_LINES)
+
+        if snapshot is not None:
+            with open(os.path.join(path, "allocations.txt"), "w") as f:
+                for stat in snapshot.statistics("lineno")[:REPORT_LINES]:
+                    f.write("%s\n" % stat)
+
+        for name, data in self.payloads.items():
+            if data is None:
+                continue
+            fname = "payload-" + urllib.quote(name, safe="")
+            with open(os.path.join(path, fname), "wb") as f:
+                f.write(data.encode("utf-8") if type(data) is unicode
+                        else data)
+        self.payloads  = {}
+        self.last_dump = path
+        logging.info("Romana watcher plugin: Wrote profile of topology "
+                     "update to '%s'" % path)
+
+    def get_stats(self):
+        """
+        Return the profiling stats as a dictionary.
+
+        """
+        return {
+            "directory"        : self.directory,
+            "tracemalloc"      : tracemalloc is not None,
+            "updates_pending"  : self.remaining,
+            "updates_profiled" : self.num_profiled,
+            "last_dump"        : self.last_dump
+        }
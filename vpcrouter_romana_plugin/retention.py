@@ -0,0 +1,98 @@
+"""
+Copyright 2017 Pani Networks Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+#
+# What we retain of the raw topology data for reporting.
+#
+
+import collections
+import datetime
+
+
+# Retention modes for the raw topology data:
+#
+# full    - The complete decoded topology data.
+# summary - Only counts, size, revision and fingerprint of the data.
+# diffs   - A bounded list of the most recent route spec changes.
+RETENTION_MODES   = ["full", "summary", "diffs"]
+DEFAULT_RETENTION = "full"
+DEFAULT_MAX_DIFFS = 10
+
+
+def summarize_topology(route_spec, size, revision, raw_fingerprint,
+                       num_networks=None, num_shards=None, num_groups=None):
+    """
+    Return a small summary of the topology data and the route spec that was
+    assembled from it.
+
+    """
+    return {
+        "networks"      : num_networks,
+        "shards"        : num_shards,
+        "groups"        : num_groups,
+        "route_entries" : len(route_spec),
+        "hosts"         : sum(len(hosts) for hosts in route_spec.values()),
+        "size"          : size,
+        "revision"      : revision,
+        "fingerprint"   : raw_fingerprint
+    }
+
+
+def route_spec_diff(old, new):
+    """
+    Return the differences between two route specs, as a dictionary with the
+    added and changed entries and the removed CIDRs.
+
+    """
+    old = old or {}
+    return {
+        "added"   : dict((cidr, hosts) for cidr, hosts in new.items()
+                         if cidr not in old),
+        "changed" : dict((cidr, hosts) for cidr, hosts in new.items()
+                         if cidr in old and old[cidr] != hosts),
+        "removed" : sorted(cidr for cidr in old if cidr not in new)
+    }
+
+
+class RouteSpecDiffs(object):
+    """
+    A ring buffer of the most recent route spec changes.
+
+    Only the last route spec is kept in full, to compute the next diff.
+
+    """
+    def __init__(self, max_diffs=DEFAULT_MAX_DIFFS):
+        self.diffs           = collections.deque(maxlen=max_diffs)
+        self.last_route_spec = None
+
+    def record(self, route_spec, revision):
+        """
+        Record a new route spec.
+
+        """
+        diff = route_spec_diff(self.last_route_spec, route_spec)
+        diff["time"]     = datetime.datetime.now().isoformat()
+        diff["revision"] = revision
+        self.diffs.append(diff)
+        self.last_route_spec = route_spec
+
+    def get_diffs(self):
+        """
+        Return the recorded diffs, oldest first.
+
+        """
+        return list(self.diffs)
@@ -20,18 +20,115 @@ limitations under the License.
 # maintained by Romana 2.0 in etcd.
 #
 
+import collections
 import datetime
 import etcd      # etcd APIv2 support
 import etcd3     # etcd APIv3 support
+import grpc      # used by etcd3
 import json
 import logging
+import os
+import Queue
+import signal
 import threading
 import time
 
+from etcd3.client      import _handle_errors as handle_etcd3_errors
+
+from vpcrouter         import utils
 from vpcrouter.errors  import ArgsError
 from vpcrouter.watcher import common
 
 from . import __version__
+from .aggregation import aggregate_routes
+from .coalescer import EventCoalescer
+from .decoding  import (JSON_BACKENDS, decode_topology_streaming,
+                        decode_value, get_json_backend,
+                        get_keyed_decoder, streaming_parser_name)
+from .exporter  import MetricsServer
+from .health    import (AdaptiveInterval, Backoff, EndpointSet,
+                        HealthMonitor, parse_endpoints)
+from .metrics   import Metrics
+from .profiling import DEFAULT_PROFILE_UPDATES, UpdateProfiler
+from .retention import (DEFAULT_MAX_DIFFS, DEFAULT_RETENTION,
+                        RETENTION_MODES, RouteSpecDiffs, summarize_topology)
+from .selection import NetworkSelector, parse_list
+from .topology  import (DEFAULT_MAX_GROUP_DEPTH, DEFAULT_MAX_GROUPS,
+                        RouteSpecCache, ShardCache, build_route_spec,
+                        fingerprint)
+from .validation import RouteSpecValidator
+
+
+DEFAULT_DEBOUNCE_TIME    = 0.5
+DEFAULT_MAX_UPDATE_DELAY = 5.0
+DEFAULT_MIN_CHECK_TIME   = 5.0
+DEFAULT_MAX_CHECK_TIME   = 60.0
+DEFAULT_MIN_BACKOFF_TIME = 5.0
+DEFAULT_MAX_BACKOFF_TIME = 60.0
+
+# Maximum time an APIv2 watch request blocks. A stopped watch thread ends
+# after at most this time.
+V2_WATCH_POLL_TIME       = 10
+
+DEFAULT_METRICS_ADDR     = "localhost"
+METRICS_PREFIX           = "vpcrouter_romana_"
+
+# Signal, which arms the profiling of the next few topology updates
+PROFILE_SIGNAL           = signal.SIGUSR2
+
+# Options for the network selectors, in the order of the NetworkSelector
+# arguments.
+SELECTOR_OPTIONS = ["include_networks", "exclude_networks",
+                    "include_cidrs", "exclude_cidrs"]
+
+
+# Raw topology data, tagged with the etcd revision of the change (mod_revision
+# for APIv3, modifiedIndex for APIv2).
+TopologyUpdate = collections.namedtuple("TopologyUpdate", ["data", "revision"])
+
+
+def _is_watch_timeout_v2(e):
+    """
+    Return True if the exception indicates that an APIv2 watch request just
+    timed out without any change.
+
+    """
+    return isinstance(e, etcd.EtcdWatchTimedOut) or \
+        getattr(e, 'message', None) == "Just timed out"
+
+
+def _is_not_found_v2(e):
+    """
+    Return True if the exception is an APIv2 reply with status 404 (not
+    found).
+
+    Without a JSON error body, as for an unknown endpoint, python-etcd only
+    passes the reply's text on, which then starts with the status.
+
+    """
+    if isinstance(e, etcd.EtcdKeyNotFound):
+        return True
+    payload = e.payload if type(getattr(e, 'payload', None)) is dict else {}
+    return payload.get("status") == 404 or \
+        str(payload.get("cause", "")).startswith("404")
+
+
+def _is_connection_error(e):
+    """
+    Return True if the exception indicates that we lost the connection to
+    the etcd server (rather than, for example, a missing key).
+
+    A failed APIv3 watch reports the plain gRPC error, which we check for
+    the same conditions the etcd3 client translates into its connection
+    errors.
+
+    """
+    if isinstance(e, grpc.RpcError) and hasattr(e, "code"):
+        return e.code() in (grpc.StatusCode.UNAVAILABLE,
+                            grpc.StatusCode.DEADLINE_EXCEEDED)
+    return isinstance(e, (etcd.EtcdConnectionFailed,
+                          etcd3.exceptions.ConnectionFailedError,
+                          etcd3.exceptions.ConnectionTimeoutError))
 
 
 class Romana(common.WatcherPlugin):
@@ -49,9 +146,35 @@ class Romana(common.WatcherPlugin):
         self.etcd_latest_raw_time = None
         self.etcd_connect_time    = None
 
+        # Fingerprints of the last processed raw topology data and of the last
+        # route spec we sent out. Used to suppress redundant updates.
+        self.last_raw_fingerprint        = None
+        self.last_route_spec_fingerprint = None
+        self.num_updates_published       = 0
+        self.num_updates_unchanged_raw   = 0
+        self.num_updates_unchanged_spec  = 0
+
+        # The etcd revision of the last topology data we processed. Older
+        # updates that arrive late are dropped.
+        self.last_revision               = None
+        self.num_updates_stale           = 0
+        self.num_route_specs_superseded  = 0
+        self.num_initial_reads_skipped   = 0
+
+        # Format (compression and encoding) and size of the last topology
+        # value we decoded
+        self.topology_format             = None
+        self.topology_value_size         = None
+
         self.watch_id             = None   # used for etcd APIv3
         self.watch_thread_v2      = None   # used for etcd APIv2
+        self.watch_stop_v2        = None   # set to stop the APIv2 thread
+        self.etcd_index_v2        = None   # etcd index of last APIv2 read
         self.watch_broken         = False
+        self.endpoint_failed      = False  # connection to etcd member failed
+        self.wakeup               = threading.Event()
+        self.health               = HealthMonitor()
+        self.num_reconnects       = 0
 
         super(Romana, self).__init__(*args, **kwargs)
 
@@ -60,6 +183,139 @@ class Romana(common.WatcherPlugin):
         else:
             self.v2 = False
 
+        # The interval between connection checks grows while the connection
+        # is stable. Reconnect attempts back off exponentially. If not
+        # configured, both start at the connect check time.
+        self.check_interval = AdaptiveInterval(
+                            self.conf.get('min_check_time',
+                                          self.connect_check_time),
+                            self.conf.get('max_check_time',
+                                          DEFAULT_MAX_CHECK_TIME))
+        self.backoff        = Backoff(
+                            self.conf.get('min_backoff_time',
+                                          self.connect_check_time),
+                            self.conf.get('max_backoff_time',
+                                          DEFAULT_MAX_BACKOFF_TIME))
+
+        # The etcd address may list several cluster members. We connect to
+        # the first healthy one and fail over to another one if it fails. A
+        # failed member is avoided for the max backoff time.
+        self.endpoints        = EndpointSet(
+                            parse_endpoints(self.conf.get('etcd_addr',
+                                                          "localhost"),
+                                            int(self.conf.get('etcd_port',
+                                                              2379))),
+                            self.backoff.max_delay)
+        self.current_endpoint = None
+        self.num_failovers    = 0
+
+        # Route entries of each network, so that only changed networks need
+        # to be walked again. The group trees are walked only down to a
+        # limited depth and size. If network selectors are configured, only
+        # the selected networks are used.
+        selectors           = [parse_list(self.conf.get(name))
+                               for name in SELECTOR_OPTIONS]
+        self.selector_lists = dict(zip(SELECTOR_OPTIONS, selectors))
+        self.selector       = None
+        if any(selectors):
+            self.selector = NetworkSelector(*selectors)
+        self.route_cache = RouteSpecCache(
+                            self.conf.get('max_group_depth',
+                                          DEFAULT_MAX_GROUP_DEPTH),
+                            self.conf.get('max_groups', DEFAULT_MAX_GROUPS),
+                            self.selector)
+
+        # Route spec entries, which were validated before, are not checked
+        # again.
+        self.validator = RouteSpecValidator()
+
+        # Optionally, adjacent and nested CIDRs with the same hosts are
+        # combined, to save route table entries.
+        self.aggregate_routes     = bool(self.conf.get('aggregate_routes'))
+        self.num_entries_received = None   # before aggregation
+        self.num_entries_sent     = None   # after aggregation
+
+        # In streaming mode, only the parts of the topology data needed for
+        # routing are decoded. Otherwise, the complete data is decoded with
+        # the selected (or fastest available) JSON backend. If the backend
+        # supports it, the networks are decoded one by one, with a key for
+        # each network's raw text, so that unchanged networks aren't walked.
+        self.streaming_decode = bool(self.conf.get('streaming_decode'))
+        self.json_backend     = self.conf.get('json_backend', "auto")
+        if self.streaming_decode:
+            self.decode      = decode_topology_streaming
+            self.parser_name = streaming_parser_name()
+        else:
+            self.parser_name, self.decode = \
+                                        get_json_backend(self.json_backend)
+            self.decode = get_keyed_decoder(self.parser_name) or self.decode
+
+        # What we keep of the raw topology data for reporting: The complete
+        # decoded data, a summary or the recent route spec changes.
+        self.raw_retention    = self.conf.get('raw_topology_retention',
+                                              DEFAULT_RETENTION)
+        if self.raw_retention == "diffs":
+            self.route_spec_diffs = RouteSpecDiffs(
+                            self.conf.get('raw_topology_diffs',
+                                          DEFAULT_MAX_DIFFS))
+        else:
+            self.route_spec_diffs = None
+
+        # The topology may be sharded over the keys under a prefix, rather
+        # than stored under a single key. In that case, we watch the prefix
+        # and cache every shard.
+        self.prefix = self.conf.get('topology_prefix')
+        if self.prefix:
+            self.watch_key = self.prefix
+            self.shards    = ShardCache(self.parse_shard)
+            self.load_func = self.load_shards_send_route_spec
+        else:
+            self.watch_key = self.key
+            self.shards    = None
+            self.load_func = self.load_topology_send_route_spec
+
+        # Counters and latency histograms for the processing stages. The time
+        # of the change notification, which caused the update we're working
+        # on, is kept for the end-to-end latency.
+        self.metrics    = Metrics()
+        self.event_time = None
+
+        # The metrics may also be served for Prometheus on a local port. The
+        # size of the last route spec is exported as well.
+        self.metrics_addr     = self.conf.get('metrics_addr',
+                                              DEFAULT_METRICS_ADDR)
+        self.metrics_port     = self.conf.get('metrics_port')
+        self.metrics_server   = None
+        self.route_spec_cidrs = None
+        self.route_spec_hosts = None
+
+        # If a profile directory is configured, the next few updates are
+        # profiled after a signal (or right from the start, if requested).
+        self.profiler = None
+        if self.conf.get('profile_dir'):
+            self.profiler = UpdateProfiler(
+                                self.conf['profile_dir'],
+                                self.conf.get('profile_updates',
+                                              DEFAULT_PROFILE_UPDATES))
+            if self.conf.get('profile_at_start'):
+                self.profiler.arm()
+
+        # In 'latest only' mode, a route spec that was not yet consumed is
+        # replaced by a newer one.
+        self.latest_route_spec_only = \
+                            bool(self.conf.get('latest_route_spec_only'))
+
+        # Watch events are not processed directly. Instead, bursts of events
+        # are coalesced into a single reload of the topology. All topology
+        # processing, including the initial read, is done by the single
+        # worker thread of the coalescer.
+        self.coalescer = EventCoalescer(
+                            self.process_update,
+                            self.conf.get('debounce_time',
+                                          DEFAULT_DEBOUNCE_TIME),
+                            self.conf.get('max_update_delay',
+                                          DEFAULT_MAX_UPDATE_DELAY))
+
     def get_plugin_name(self):
         return "vpcrouter_romana_plugin.romana"
 
@@ -68,158 +324,681 @@ class Romana(common.WatcherPlugin):
         Return stats and information about the plugin.
 
         """
+        if self.current_endpoint:
+            current_endpoint = str(self.current_endpoint)
+        else:
+            current_endpoint = None
+        shard_stats = self.shards.get_stats() if self.shards else None
+        if self.selector:
+            selection_stats = self.selector.get_stats()
+        else:
+            selection_stats = None
+        if self.profiler:
+            profiling_stats = self.profiler.get_stats()
+        else:
+            profiling_stats = None
+        if self.route_spec_diffs:
+            raw_data = self.route_spec_diffs.get_diffs()
+        else:
+            raw_data = self.etcd_latest_raw
         return {
             self.get_plugin_name() : {
                 "version" : self.get_version(),
                 "params" : {
-                    "etcd_addr"  : self.conf['etcd_addr'],
-                    "etcd_port"  : self.conf['etcd_port'],
-                    "ca_cert"    : self.conf['ca_cert'],
-                    "priv_key"   : self.conf['priv_key'],
-                    "cert_chain" : self.conf['cert_chain'],
+                    "etcd_addr"              : self.conf['etcd_addr'],
+                    "etcd_port"              : self.conf['etcd_port'],
+                    "ca_cert"                : self.conf['ca_cert'],
+                    "priv_key"               : self.conf['priv_key'],
+                    "cert_chain"             : self.conf['cert_chain'],
+                    "debounce_time"          : self.coalescer.debounce_time,
+                    "max_update_delay"       : self.coalescer.max_delay,
+                    "latest_route_spec_only" : self.latest_route_spec_only,
+                    "min_check_time"         : self.check_interval.minimum,
+                    "max_check_time"         : self.check_interval.maximum,
+                    "min_backoff_time"       : self.backoff.min_delay,
+                    "max_backoff_time"       : self.backoff.max_delay,
+                    "max_group_depth"        : self.route_cache.max_depth,
+                    "max_groups"             : self.route_cache.max_groups,
+                    "streaming_decode"       : self.streaming_decode,
+                    "json_backend"           : self.json_backend,
+                    "topology_prefix"        : self.prefix,
+                    "json_parser"            : self.parser_name,
+                    "aggregate_routes"       : self.aggregate_routes,
+                    "network_selectors"      : self.selector_lists,
+                    "metrics_addr"           : self.metrics_addr,
+                    "metrics_port"           : self.metrics_port,
+                    "profile_dir"            : self.conf.get('profile_dir')
                 },
                 "raw_topology" : {
-                    "time" : self.etcd_latest_raw_time,
-                    "data" : self.etcd_latest_raw
+                    "time"      : self.etcd_latest_raw_time,
+                    "retention" : self.raw_retention,
+                    "data"      : raw_data
                 },
                 "stats" : {
-                    "etcd_connect_time" : self.etcd_connect_time
+                    "etcd_connect_time"      : self.etcd_connect_time,
+                    "watch_events"           : self.metrics.get_counter(
+                                                            "watch_events"),
+                    "coalescer_submissions"  : self.coalescer.num_events,
+                    "topology_reloads"       : self.coalescer.num_calls,
+                    "updates_published"      : self.num_updates_published,
+                    "updates_skipped"        : {
+                        "unchanged_raw"  : self.num_updates_unchanged_raw,
+                        "unchanged_spec" : self.num_updates_unchanged_spec,
+                        "stale"          : self.num_updates_stale
+                    },
+                    "last_revision"          : self.last_revision,
+                    "initial_reads_skipped"  : self.num_initial_reads_skipped,
+                    "route_specs_superseded" : self.num_route_specs_superseded,
+                    "etcd_health"            : self.health.get_stats(),
+                    "etcd_reconnects"        : self.num_reconnects,
+                    "check_interval"         : self.check_interval.current,
+                    "etcd_endpoint"          : current_endpoint,
+                    "etcd_endpoints"         : self.endpoints.get_stats(),
+                    "etcd_failovers"         : self.num_failovers,
+                    "route_cache"            : self.route_cache.get_stats(),
+                    "topology_format"        : self.topology_format,
+                    "topology_value_size"    : self.topology_value_size,
+                    "topology_shards"        : shard_stats,
+                    "route_spec_validation"  : self.validator.get_stats(),
+                    "network_selection"      : selection_stats,
+                    "metrics"                : self.metrics.get_stats(),
+                    "profiling"              : profiling_stats,
+                    "route_aggregation"      : {
+                        "entries_before" : self.num_entries_received,
+                        "entries_after"  : self.num_entries_sent
+                    }
                 }
             }
         }
 
-    def stop_watches(self):
+    def get_metrics_text(self):
+        """
+        Return the metrics of the plugin in the Prometheus text format.
+
+        Besides the counters and latency histograms of the metrics registry,
+        this includes the update counters and sizes, which the plugin keeps
+        itself.
+
+        """
+        counters = {
+            "updates_published"      : self.num_updates_published,
+            "updates_unchanged_raw"  : self.num_updates_unchanged_raw,
+            "updates_unchanged_spec" : self.num_updates_unchanged_spec,
+            "updates_stale"          : self.num_updates_stale,
+            "route_specs_superseded" : self.num_route_specs_superseded,
+            "initial_reads_skipped"  : self.num_initial_reads_skipped,
+            "etcd_failovers"         : self.num_failovers,
+            "etcd_probes"            : self.health.num_probes,
+            "etcd_probe_failures"    : self.health.num_probe_failures
+        }
+        gauges = {
+            "topology_value_bytes"   : self.topology_value_size,
+            "route_spec_cidrs"       : self.route_spec_cidrs,
+            "route_spec_hosts"       : self.route_spec_hosts,
+            "last_revision"          : self.last_revision,
+            "etcd_connected"         : int(self.etcd is not None)
+        }
+        return self.metrics.render_text(METRICS_PREFIX, counters, gauges)
+
+    def stop_watches(self, wait=False):
         """
         Depending on which watches was configured (callback for v3 or thread
         for v2, issues necessary instructions to stop those.
 
+        The v2 watch thread ends after its current watch request has returned.
+        If 'wait' is set, we wait for that.
+
         """
         if self.watch_id:
-            logging.debug("Cancel watch for etcd APIv3 on '%s'" % self.key)
-            self.etcd.cancel_watch(self.watch_id)
+            logging.debug("Cancel watch for etcd APIv3 on '%s'" %
+                          self.watch_key)
+            if self.etcd:
+                self.etcd.cancel_watch(self.watch_id)
             self.watch_id = None
         if self.watch_thread_v2:
             logging.debug("Stop watch thread for etcd APIv2 on '%s'" %
-                          self.key)
-            # I'm not really stopping this thread, because that thread sits in
-            # a block watch statement. TODO
+                          self.watch_key)
+            self.watch_stop_v2.set()
+            if wait:
+                self.watch_thread_v2.join()
             self.watch_thread_v2 = None
+            self.watch_stop_v2   = None
+
+    def read_topology_data(self):
+        """
+        Read the raw topology data from etcd.
+
+        Returns a TopologyUpdate.
 
-    def load_topology_send_route_spec(self):
+        """
+        with self.metrics.timer("etcd_read"):
+            if self.v2:
+                res = self.etcd.get(self.key)
+                self.etcd_index_v2 = res.etcd_index
+                return TopologyUpdate(res.value, res.modifiedIndex)
+            else:
+                value, meta = self.etcd.get(self.key)
+                return TopologyUpdate(value,
+                                      meta.mod_revision if meta else None)
+
+    def read_topology_shards(self):
+        """
+        Read the raw data of all topology shards under the prefix from etcd.
+
+        Returns a tuple with a dictionary of key to (data, revision) and the
+        etcd revision (or index for APIv2) the data is current at.
+
+        """
+        shards = {}
+        if self.v2:
+            try:
+                res = self.etcd.read(self.prefix, recursive=True)
+            except etcd.EtcdKeyNotFound as e:
+                self.etcd_index_v2 = e.payload.get('index') \
+                                                    if e.payload else None
+                return shards, self.etcd_index_v2
+            self.etcd_index_v2 = res.etcd_index
+            for node in res.leaves:
+                if not node.dir and node.key:
+                    shards[node.key] = (node.value, node.modifiedIndex)
+            return shards, self.etcd_index_v2
+
+        response = self.range_topology_v3(keys_only=False)
+        for kv in response.kvs:
+            shards[kv.key] = (kv.value, kv.mod_revision)
+        return shards, response.header.revision
+
+    @handle_etcd3_errors
+    def range_topology_v3(self, keys_only):
+        """
+        Send a range request for the topology key, or all keys under the
+        topology prefix, and return the response.
+
+        We send the range request ourselves, since the etcd3 client neither
+        offers keys-only reads nor returns the etcd revision of the data.
+
+        """
+        request           = etcd3.etcdrpc.RangeRequest()
+        request.key       = self.watch_key
+        request.keys_only = keys_only
+        if self.prefix:
+            request.range_end = etcd3.utils.increment_last_byte(self.prefix)
+        return self.etcd.kvstub.Range(request, self.etcd.timeout)
+
+    def read_topology_revisions_v3(self):
+        """
+        Return the current etcd revision and a dictionary with the revision
+        of the last change to the topology key, or to every key under the
+        topology prefix.
+
+        This is a keys-only read, so the topology data itself is not
+        transferred.
+
+        """
+        response = self.range_topology_v3(keys_only=True)
+        return (response.header.revision,
+                dict((kv.key, kv.mod_revision) for kv in response.kvs))
+
+    def initial_data_read(self):
+        """
+        Read and process the topology data after (re)connecting to etcd.
+
+        Returns the etcd revision (or index for APIv2) at which the watch
+        should start, or None if it should start at the current revision.
+
+        For APIv3 we first get the current etcd revision and the revision of
+        the last change to the topology key, without reading the data. If the
+        topology is unchanged since we processed it last (after a reconnect,
+        for example) then the full read is skipped. The watch starts right
+        after the current revision, so that no change is missed, while a
+        compacted revision can never be requested.
+
+        """
+        if self.v2:
+            logging.debug("Initial data read")
+            self.etcd_index_v2 = None
+            if self.shards:
+                self.shards.request_full_reload()
+            self.coalescer.flush()
+            if self.etcd_index_v2 is None:
+                return None
+            return self.etcd_index_v2 + 1
+
+        etcd_revision, key_revisions = self.read_topology_revisions_v3()
+        if self.shards:
+            unchanged = key_revisions == self.shards.key_revisions()
+        else:
+            key_revision = key_revisions.get(self.key)
+            unchanged    = key_revision is not None and \
+                                        key_revision == self.last_revision
+        if unchanged:
+            if self.shards:
+                # Changes seen before are already in the cached shards
+                self.shards.clear_pending()
+            self.num_initial_reads_skipped += 1
+            logging.debug("Topology data unchanged since revision %s, "
+                          "skipping initial read" % self.last_revision)
+        else:
+            logging.debug("Initial data read")
+            if self.shards:
+                self.shards.request_full_reload()
+            self.coalescer.flush()
+        return etcd_revision + 1
+
+    def is_stale_update(self, update):
+        """
+        Return True if the update is older than the data we processed last.
+
+        """
+        if update.revision is None or self.last_revision is None or \
+                update.revision >= self.last_revision:
+            return False
+        self.num_updates_stale += 1
+        logging.debug("Dropping stale topology data (revision %d, already "
+                      "processed revision %d)" %
+                      (update.revision, self.last_revision))
+        return True
+
+    def send_route_spec(self, route_spec):
+        """
+        Put a new route spec on the route spec queue.
+
+        In 'latest only' mode, any route specs that are still waiting on the
+        queue are obsolete and removed first, so that the consumer doesn't
+        need to process them.
+
+        """
+        if self.latest_route_spec_only:
+            while True:
+                try:
+                    self.q_route_spec.get_nowait()
+                    self.num_route_specs_superseded += 1
+                except Queue.Empty:
+                    break
+        self.q_route_spec.put(route_spec)
+
+    def load_topology_send_route_spec(self, update=None):
         """
         Retrieve latest topology info from Romana topology store and send
         new spec.
 
-        The topology information may contain recursive definitions of groups.
-        Those need to be traversed and the host information for each group
-        collected.
-
-        * A group may either have another group (child group) or a list of
-          hosts.
-        * A group always has a CIDR.
-
-        """
-        def _parse_one_group(elem, route_spec):
-            # Recursive helper function to descend into the nested group
-            # definitions and append to the route-spec any more CIDRs and host
-            # lists that we may find.
-            # At any given level, we may have more groups, hosts or both. We
-            # should have a CIDR as well, especially if we have hosts.
-            groups = elem.get("groups")
-            hosts  = elem.get("hosts")
-            cidr   = elem.get("cidr")
-            if groups and type(groups) is list:
-                for group in groups:
-                    # Call one level deeper for every group we find
-                    route_spec = _parse_one_group(group, route_spec)
-            if cidr and hosts and type(hosts) is list:
-                # Use the hosts and cidr to add an entry to the route spec
-                host_ips = [h['ip'] for h in hosts]
-                route_spec[cidr] = host_ips
-            return route_spec
-
-        # Get the topology data from etcd and parse it
+        If the raw topology data is passed in as a TopologyUpdate (because it
+        was delivered with a watch event) then it is used directly, without
+        reading it from etcd. It is dropped if its revision is older than that
+        of the data we processed last. Data read from etcd is always current
+        and therefore accepted.
+
+        This should only ever be called from the worker thread of the
+        coalescer, so that updates are processed one at a time and in order.
+
+        If the raw topology data is identical to what we processed last time,
+        we don't even parse it. If the assembled route spec is the same as the
+        one we sent last time (only non-routing fields changed), no update is
+        sent.
+
+        The last revision only advances once the data has been processed, so
+        that after a failure the data is read again on the next reconnect.
+
+        """
+        # Get the topology data from etcd (unless we have it already) and
+        # parse it
         try:
-            if self.v2:
-                data = self.etcd.get(self.key).value
-            else:
-                data = self.etcd.get(self.key)[0]
-            d = json.loads(data)
-            self.etcd_latest_raw      = d
-            self.etcd_latest_raw_time = datetime.datetime.now().isoformat()
-
-            route_spec = {}
-            # We have separate topology data for different networks
-            for net_name, net_data in d['networks'].items():
-                # Top level element is always 'groups' (not a list), while
-                # further down 'groups' will be a list of groups.
-                groups = net_data.get('host_groups')
-                if groups and type(groups) is dict:
-                    route_spec = _parse_one_group(groups, route_spec)
-            # Sanity checking on the assembled route spec
-            common.parse_route_spec_config(route_spec)
-            # Sending the new route spec out on our message queue
-            logging.debug("Sending route spec for routes: %s" %
-                          route_spec.keys())
-            self.q_route_spec.put(route_spec)
+            if update is None:
+                update = self.read_topology_data()
+            elif self.is_stale_update(update):
+                return
+            data = update.data
+            if self.profiler:
+                self.profiler.record_payload(self.key, data)
+
+            raw_fingerprint = fingerprint(data)
+            if raw_fingerprint == self.last_raw_fingerprint:
+                self.num_updates_unchanged_raw += 1
+                self.advance_revision(update.revision)
+                logging.debug("Romana topology data unchanged, "
+                              "no route spec update")
+                return
+
+            # The value may be compressed and/or msgpack encoded
+            self.topology_value_size  = len(data) if data else 0
+            with self.metrics.timer("parse"):
+                self.topology_format, d = decode_value(data, self.decode)
+
+            with self.metrics.timer("build_route_spec"):
+                route_spec = self.route_cache.build_route_spec(d)
+            self.retain_topology(d, route_spec, update.revision,
+                                 self.topology_value_size, raw_fingerprint)
+            self.publish_route_spec(route_spec, update.revision)
+            self.last_raw_fingerprint = raw_fingerprint
+            self.advance_revision(update.revision)
+
+        except Exception as e:
+            self.handle_load_error(e)
+
+    def process_update(self, update=None):
+        """
+        Process a burst of topology changes (called by the coalescer).
+
+        Loads the topology with the load function for our mode (single key or
+        prefix) and records how long that took, overall and, once the route
+        spec is sent, since the first change notification of the burst.
+
+        If profiling was requested, the load runs under the profiler.
+
+        """
+        self.metrics.inc("loads")
+        self.event_time = self.metrics.take_event_time()
+        try:
+            with self.metrics.timer("load"):
+                if self.profiler and self.profiler.is_armed():
+                    self.profiler.run(self.load_func, update)
+                else:
+                    self.load_func(update)
+        finally:
+            self.event_time = None
+
+    def parse_shard(self, data):
+        """
+        Decode the raw data of a topology shard and collect its route
+        entries.
+
+        Returns a tuple with the decoded data (None, unless we retain the
+        full topology data), the route entries and the number of groups they
+        came from.
+
+        """
+        _, d          = decode_value(data, self.decode)
+        walk_stats    = self.route_cache.walk_stats
+        groups_before = walk_stats.groups_visited
+        routes        = build_route_spec(d, self.route_cache.max_depth,
+                                         self.route_cache.max_groups,
+                                         walk_stats, self.selector)
+        return (d if self.raw_retention == "full" else None, routes,
+                walk_stats.groups_visited - groups_before)
+
+    def load_shards_send_route_spec(self, update=None):
+        """
+        Apply the recorded changes to the topology shards and send a new
+        route spec, if needed.
+
+        If a full reload was requested (after connecting, or if the watch
+        missed changes), all shards are read from etcd first, and only the
+        recorded changes newer than that data are applied on top of it. Only
+        shards whose data changed are parsed again.
+
+        Like load_topology_send_route_spec(), this should only ever be called
+        from the worker thread of the coalescer. The update argument isn't
+        used, the changes are kept in the shard cache.
+
+        """
+        full_reload, changes = self.shards.take_pending()
+        try:
+            changed = False
+            if self.profiler:
+                for key, (data, _) in changes.items():
+                    self.profiler.record_payload(key, data)
+            if full_reload:
+                with self.metrics.timer("etcd_read"):
+                    shards, revision = self.read_topology_shards()
+                if self.profiler:
+                    for key, (data, _) in shards.items():
+                        self.profiler.record_payload(key, data)
+                with self.metrics.timer("parse"):
+                    changed = self.shards.apply(shards, complete=True,
+                                                revision=revision)
+                # Changes recorded before the read are part of its data
+                changes = dict((key, (data, key_revision))
+                               for key, (data, key_revision)
+                               in changes.items()
+                               if None not in (revision, key_revision) and
+                               key_revision > revision)
+            with self.metrics.timer("parse"):
+                changed = self.shards.apply(changes) or changed
+            if not changed:
+                self.num_updates_unchanged_raw += 1
+                logging.debug("Romana topology shards unchanged, "
+                              "no route spec update")
+                return
+
+            revision = self.shards.max_revision()
+            with self.metrics.timer("build_route_spec"):
+                route_spec = self.shards.build_route_spec()
+            self.retain_topology(self.shards.get_data(), route_spec, revision)
+            self.publish_route_spec(route_spec, revision)
+            self.advance_revision(revision)
 
         except Exception as e:
-            logging.error("Cannot load Romana topology data at '%s': %s" %
-                          (self.key, str(e)))
+            if full_reload:
+                self.shards.request_full_reload()
+            self.handle_load_error(e)
+
+    def advance_revision(self, revision):
+        """
+        Record the revision of the topology data we have processed.
+
+        """
+        if revision is not None:
+            self.last_revision = revision
+
+    def retain_topology(self, d, route_spec, revision, size=None,
+                        raw_fingerprint=None):
+        """
+        Keep what the retention mode asks for of the decoded topology data.
+
+        In 'summary' mode, only counts (including the groups walked for the
+        route spec), size, revision and fingerprint are kept. In 'diffs'
+        mode, nothing is kept here, the route spec changes are recorded once
+        they are sent.
+
+        """
+        self.etcd_latest_raw_time = datetime.datetime.now().isoformat()
+        if self.raw_retention == "full":
+            self.etcd_latest_raw = d
+        elif self.raw_retention == "summary":
+            if self.shards:
+                num_networks, num_shards = None, len(self.shards.shards)
+                num_groups               = self.shards.num_groups()
+            else:
+                num_networks, num_shards = len(d['networks']), None
+                num_groups               = self.route_cache.num_groups
+            self.etcd_latest_raw = summarize_topology(
+                                        route_spec, size, revision,
+                                        raw_fingerprint, num_networks,
+                                        num_shards, num_groups)
+
+    def publish_route_spec(self, route_spec, revision=None):
+        """
+        Check a new route spec and send it, unless it's the same as the one
+        we sent last time.
+
+        Invalid entries and hosts are dropped from the route spec. Raises
+        ValueError if none of its entries are valid.
+
+        """
+        # Sanity checking on the assembled route spec, only for new or
+        # changed entries. This also brings it into canonical form (ordered
+        # entries, sorted host lists), so that the fingerprint is stable.
+        with self.metrics.timer("validate"):
+            route_spec = self.validator.validate(route_spec)
+        if self.aggregate_routes:
+            self.num_entries_received = len(route_spec)
+            with self.metrics.timer("aggregate"):
+                route_spec = aggregate_routes(route_spec)
+            self.num_entries_sent     = len(route_spec)
+
+        self.route_spec_cidrs = len(route_spec)
+        self.route_spec_hosts = sum(len(hosts)
+                                    for hosts in route_spec.values())
+
+        spec_fingerprint = fingerprint(json.dumps(route_spec))
+        if spec_fingerprint == self.last_route_spec_fingerprint:
+            self.num_updates_unchanged_spec += 1
+            logging.debug("Route spec unchanged, no route spec update")
+            return
+
+        # Sending the new route spec out on our message queue
+        logging.debug("Sending route spec for routes: %s" % route_spec.keys())
+        with self.metrics.timer("queue_put"):
+            self.send_route_spec(route_spec)
+        if self.event_time is not None:
+            self.metrics.observe("event_to_publish",
+                                 time.time() - self.event_time)
+        self.last_route_spec_fingerprint = spec_fingerprint
+        self.num_updates_published += 1
+        if self.route_spec_diffs:
+            self.route_spec_diffs.record(route_spec, revision)
+
+    def handle_load_error(self, e):
+        """
+        Log an error while loading the topology data. If we lost the
+        connection to etcd, have it re-established (possibly with another
+        cluster member).
+
+        """
+        self.metrics.inc("load_errors")
+        logging.error("Cannot load Romana topology data at '%s': %s" %
+                      (self.watch_key, str(e)))
+        if _is_connection_error(e):
+            self.set_watch_broken(endpoint_failed=True)
 
     def event_callback_v3(self, event):
         """
         Event handler function for watch on Romana IPAM data.
 
         This is called when we use the APIv3 client and whenever there is an
-        update to that data detected.
+        update to that data detected. The actual reload of the topology is
+        done by the coalescer.
+
+        A put event already carries the new value, which is handed on, so
+        that it doesn't need to be read again. For any other event (delete),
+        the data is read from etcd.
+
+        If the watch itself failed, the event is an exception. In that case
+        we flag the watch as broken, so that it is re-established.
 
         """
+        if isinstance(event, Exception):
+            logging.warning("Romana watcher plugin: Watch failed: %s" %
+                            str(event))
+            self.metrics.inc("watch_failures")
+            self.set_watch_broken(_is_connection_error(event))
+            return
+        self.health.record_activity()
+        self.metrics.record_event()
         logging.info("Romana watcher plugin: Detected topology change in "
                      "Romana topology data")
-        self.load_topology_send_route_spec()
+        if self.shards:
+            if isinstance(event, etcd3.events.PutEvent):
+                self.shards.record_change(event.key, event.value,
+                                          event.mod_revision)
+            else:
+                self.shards.record_change(event.key, None, event.mod_revision)
+            self.coalescer.notify()
+        elif isinstance(event, etcd3.events.PutEvent) and event.value:
+            self.coalescer.notify(TopologyUpdate(event.value,
+                                                 event.mod_revision))
+        else:
+            self.coalescer.notify()
 
-    def watch_loop_v2(self):
+    def watch_loop_v2(self, client, next_index, stop_event):
         """
-        Establishes a watch for changes on the Romana IPAM data.
+        Long-poll watch for changes on the Romana IPAM data.
 
         This is called when we use the APIv2 client and runs in an extra
-        thread.
+        thread. The client is passed in, since after a reconnect self.etcd
+        is already a new client, while this thread may still be finishing
+        its last watch request.
+
+        The wait index is carried from one watch request to the next, so no
+        change is missed and no read is needed to restart the watch. Only if
+        etcd has already cleared the history at our wait index do we request
+        a full read of the topology.
+
+        The loop ends once the stop event is set. If the watch fails, the
+        watch_broken flag is set, so that the connection is re-established.
 
         """
-        while True:
+        # A prefix is watched recursively
+        watch_kwargs = {"recursive" : True} if self.shards else {}
+        while not stop_event.is_set():
             try:
-                # By the time we get here, an update may have happened. So, get
-                # the latest index from the latest result and start our watch
-                # there, setting the value so that the first watch immediately
-                # returns and we can send a route spec update.
-                res        = self.etcd.get(self.key)
-                # First watch immediately finds this
-                next_index = res.etcd_index
+                res = client.watch(self.watch_key, index=next_index,
+                                   timeout=V2_WATCH_POLL_TIME, **watch_kwargs)
+            except etcd.EtcdEventIndexCleared as e:
+                # We missed some changes: Continue the watch at the current
+                # index and read the data again.
+                logging.debug("Watch index %s cleared, re-reading topology" %
+                              next_index)
+                next_index = e.payload['index'] + 1 if e.payload else None
+                if not stop_event.is_set():
+                    if self.shards:
+                        self.shards.request_full_reload()
+                    self.coalescer.notify()
+                continue
             except Exception as e:
-                # If the etcd isn't healthy, or our data isn't there, then we
-                # need to end this thread and try again. We use the
-                # watch_broken flag to indicate failure of this thread.
-                logging.warning("Romana watcher plugin: Cannot start watch "
-                                "loop: %s" % str(e))
-                self.watch_broken = True
+                if _is_watch_timeout_v2(e):
+                    continue
+                if not stop_event.is_set():
+                    logging.warning("Romana watcher plugin: Watch failed: %s" %
+                                    str(e))
+                    self.metrics.inc("watch_failures")
+                    self.set_watch_broken(_is_connection_error(e))
                 return
 
-            try:
-                watch_res = self.etcd.watch(self.key,
-                                            timeout=60,
-                                            index=next_index)
-                if watch_res:
-                    next_index = watch_res.etcd_index + 1
-                self.load_topology_send_route_spec()
+            if stop_event.is_set():
+                break
+            self.health.record_activity()
+            self.metrics.record_event()
+            next_index = res.modifiedIndex + 1
+            logging.info("Romana watcher plugin: Detected topology change in "
+                         "Romana topology data")
+            is_put = res.action in ["set", "update", "create",
+                                    "compareAndSwap"]
+            if self.shards:
+                self.shards.record_change(res.key,
+                                          res.value if is_put else None,
+                                          res.modifiedIndex)
+                self.coalescer.notify()
+            elif is_put and res.value:
+                self.coalescer.notify(TopologyUpdate(res.value,
+                                                     res.modifiedIndex))
+            else:
+                self.coalescer.notify()
 
-            except Exception as e:
-                if hasattr(e, 'message') and e.message == "Just timed out":
-                    logging.debug("Scheduled watch re-establishment")
-                else:
-                    # Something wrong? We'll attempt to re-establish the watch
-                    # after a little wait.
-                    time.sleep(2)
+    def probe_etcd_v2(self):
+        """
+        Lightweight health probe for etcd APIv2.
+
+        Asks for etcd's health, rather than reading any keys. Older etcd
+        versions don't have the health endpoint (they reply with 404), in
+        which case we ask for the version instead. Any other error reply,
+        such as the 503 of an unhealthy member, fails the probe.
+
+        """
+        try:
+            res    = self.etcd.api_execute("/health", "GET")
+            health = json.loads(res.data.decode("utf-8"))
+        except etcd.EtcdConnectionFailed:
+            raise
+        except etcd.EtcdException as e:
+            if not _is_not_found_v2(e):
+                raise
+            self.etcd.api_execute("/version", "GET")
+            return
+        if health.get("health") not in [True, "true"]:
+            raise Exception("etcd reports bad health: %s" % health)
+
+    @handle_etcd3_errors
+    def probe_etcd_v3(self):
+        """
+        Lightweight health probe for etcd APIv3.
+
+        Sends a single status request. The client's status() function would
+        also list all cluster members and doesn't apply a timeout.
+
+        """
+        self.etcd.maintenancestub.Status(etcd3.etcdrpc.StatusRequest(),
+                                         self.etcd.timeout)
 
     def etcd_check_status(self):
         """
@@ -227,17 +1006,30 @@ class Romana(common.WatcherPlugin):
 
         Return False if there are any issues.
 
+        If we saw activity on the watch during the last check interval, we
+        know that the connection is alive and don't need to send a probe.
+
         """
         if self.etcd:
+            if self.health.recently_active(self.check_interval.current):
+                self.health.num_probes_skipped += 1
+                return True
             try:
+                start_time = time.time()
                 if self.v2:
-                    res = self.etcd.get("/")
-                    if res is None:
-                        raise Exception("empty status result from etcd")
+                    self.probe_etcd_v2()
                 else:
-                    self.etcd.status()
+                    self.probe_etcd_v3()
+                latency = time.time() - start_time
+                self.health.record_probe(latency)
+                self.metrics.observe("etcd_probe", latency)
+                if self.current_endpoint:
+                    self.endpoints.record_latency(self.current_endpoint,
+                                                  latency)
                 return True
             except Exception as e:
+                self.health.record_probe_failure()
+                self.endpoint_failed = True
                 logging.debug("Cannot get status from etcd: %s" % str(e))
 
         else:
@@ -249,23 +1041,31 @@ class Romana(common.WatcherPlugin):
         """
         Get connection to ectd and install a watch for Romana topology data.
 
+        If several etcd cluster members are configured, we connect to the
+        first one that didn't fail recently.
+
         """
         self.stop_watches()    # just in case this is a re-establishment
         if not self.etcd or not self.etcd_check_status() or \
                     (self.watch_id is None and self.watch_thread_v2 is None):
+            start_time            = time.time()
+            self.current_endpoint = endpoint = self.endpoints.select()
+            if len(self.endpoints.endpoints) > 1:
+                logging.info("Romana watcher plugin: Using etcd endpoint %s" %
+                             endpoint)
             try:
                 if self.v2:
                     logging.debug("Attempting to connect to etcd (APIv2)")
                     self.etcd = etcd.client.Client(
-                                        host=self.conf['etcd_addr'],
-                                        port=int(self.conf['etcd_port']),
+                                        host=endpoint.host,
+                                        port=endpoint.port,
                                         read_timeout=self.etcd_timeout_time)
 
                 else:
                     logging.debug("Attempting to connect to etcd (APIv3)")
                     self.etcd = etcd3.client(
-                                        host=self.conf['etcd_addr'],
-                                        port=int(self.conf['etcd_port']),
+                                        host=endpoint.host,
+                                        port=endpoint.port,
                                         timeout=self.etcd_timeout_time,
                                         ca_cert=self.conf.get('ca_cert'),
                                         cert_key=self.conf.get('priv_key'),
@@ -273,22 +1073,31 @@ class Romana(common.WatcherPlugin):
 
                 self.etcd_connect_time = datetime.datetime.now().isoformat()
 
-                logging.debug("Initial data read")
-                self.load_topology_send_route_spec()
+                start_revision = self.initial_data_read()
+                self.metrics.observe("connect", time.time() - start_time)
 
                 logging.debug("Attempting to establish watch on '%s'" %
-                              self.key)
+                              self.watch_key)
                 if self.v2:
+                    self.watch_stop_v2   = threading.Event()
                     self.watch_thread_v2 = threading.Thread(
-                                                target = self.watch_loop_v2,
-                                                name   = "RomanaMonV2",
-                                                kwargs = {})
+                                target = self.watch_loop_v2,
+                                name   = "RomanaMonV2",
+                                kwargs = {"client"     : self.etcd,
+                                          "next_index" : start_revision,
+                                          "stop_event" : self.watch_stop_v2})
                     self.watch_thread_v2.daemon = True
                     self.watch_thread_v2.start()
                     self.watch_id = None
                 else:
+                    watch_kwargs = {"start_revision" : start_revision}
+                    if self.prefix:
+                        watch_kwargs["range_end"] = \
+                                etcd3.utils.increment_last_byte(self.prefix)
                     self.watch_id = self.etcd.add_watch_callback(
-                                            self.key, self.event_callback_v3)
+                                            self.watch_key,
+                                            self.event_callback_v3,
+                                            **watch_kwargs)
                     self.watch_thread_v2 = None
 
                 logging.info("Romana watcher plugin: Established etcd "
@@ -296,9 +1105,25 @@ class Romana(common.WatcherPlugin):
             except Exception as e:
                 logging.error("Cannot establish connection to etcd: %s" %
                               str(e))
+                if _is_connection_error(e):
+                    self.endpoint_failed = True
                 self.etcd     = None
                 self.watch_id = None
 
+    def set_watch_broken(self, endpoint_failed=False):
+        """
+        Flag the watch as broken and wake up the connection check, so that
+        the connection is re-established right away.
+
+        The endpoint_failed flag tells whether the watch broke because the
+        connection to the etcd member failed, rather than for example being
+        cancelled by the server. Only then is the member avoided afterwards.
+
+        """
+        self.endpoint_failed = self.endpoint_failed or endpoint_failed
+        self.watch_broken    = True
+        self.wakeup.set()
+
     def watch_etcd(self):
         """
         Start etcd connection, establish watch and do initial read of data.
@@ -306,20 +1131,41 @@ class Romana(common.WatcherPlugin):
         Regularly re-checks the status of the connection. In case of problems,
         re-establishes a new connection and watch.
 
+        The check interval grows while the connection is stable and is reset
+        after a reconnect. Reconnect attempts back off exponentially (with
+        jitter) while they keep failing. If the connection to the etcd
+        cluster member failed (a connection or transport error, or a failed
+        health probe) and another member is still healthy, we fail over to
+        it right away.
+
         """
         while self.keep_running:
             self.etcd = None
 
-            self.watch_broken = False
+            self.watch_broken    = False
+            self.endpoint_failed = False
+            self.wakeup.clear()
             self.establish_etcd_connection_and_watch()
 
             # Slowly loop as long as the connection status is fine.
-            while self.etcd_check_status() and self.keep_running \
-                                and not self.watch_broken:
-                time.sleep(self.connect_check_time)
+            self.check_interval.reset()
+            while self.keep_running and not self.watch_broken \
+                                and self.etcd_check_status():
+                self.backoff.reset()
+                self.wakeup.wait(self.check_interval.current)
+                self.check_interval.grow()
 
             logging.warning("Romana watcher plugin: Lost etcd connection.")
-            time.sleep(self.connect_check_time)
+            self.num_reconnects += 1
+            self.metrics.inc("reconnects")
+            if not self.keep_running:
+                break
+            if self.endpoint_failed and self.current_endpoint:
+                self.endpoints.record_failure(self.current_endpoint)
+                if self.endpoints.has_healthy():
+                    self.num_failovers += 1
+                    continue
+            self.wakeup.wait(self.backoff.next_delay())
 
     def start(self):
         """
@@ -328,6 +1174,11 @@ class Romana(common.WatcherPlugin):
         """
         logging.info("Romana watcher plugin: "
                      "Starting to watch for topology updates...")
+        self.coalescer.start()
+        if self.metrics_port is not None:
+            self.start_metrics_server()
+        if self.profiler:
+            self.install_profile_signal()
         self.observer_thread = threading.Thread(target = self.watch_etcd,
                                                 name   = "RomanaMon",
                                                 kwargs = {})
@@ -335,6 +1186,46 @@ class Romana(common.WatcherPlugin):
         self.observer_thread.daemon = True
         self.observer_thread.start()
 
+    def start_metrics_server(self):
+        """
+        Serve the metrics for Prometheus on the configured port.
+
+        If the port can't be used, this is logged, but the plugin keeps
+        running without it.
+
+        """
+        try:
+            self.metrics_server = MetricsServer(self.metrics_addr,
+                                                self.metrics_port,
+                                                self.get_metrics_text)
+        except Exception as e:
+            logging.error("Romana watcher plugin: Cannot serve metrics on "
+                          "%s:%s: %s" % (self.metrics_addr, self.metrics_port,
+                                         str(e)))
+            return
+        self.metrics_server.start()
+        logging.info("Romana watcher plugin: Serving metrics on "
+                     "http://%s:%d/metrics" %
+                     (self.metrics_addr, self.metrics_server.port))
+
+    def install_profile_signal(self):
+        """
+        Have the profiling of the next few updates armed by a signal.
+
+        Signal handlers can only be installed from the main thread. If we
+        were started from another one, profiling is only available with
+        --profile_at_start.
+
+        """
+        def _arm_profiler(signum, frame):
+            self.profiler.arm()
+
+        try:
+            signal.signal(PROFILE_SIGNAL, _arm_profiler)
+        except ValueError as e:
+            logging.warning("Romana watcher plugin: Cannot install signal "
+                            "handler for profiling: %s" % str(e))
+
     def stop(self):
         """
         Stop the config change monitoring thread.
@@ -343,7 +1234,13 @@ class Romana(common.WatcherPlugin):
         # self.stop_watches()
         logging.debug("Sending stop signal to etcd watcher thread")
         self.keep_running = False
+        self.wakeup.set()
         self.observer_thread.join()
+        self.stop_watches(wait=True)
+        self.coalescer.stop()
+        if self.metrics_server:
+            self.metrics_server.stop()
+            self.metrics_server = None
         logging.info("Romana watcher plugin: Stopped")
 
     @classmethod
@@ -365,7 +1262,9 @@ class Romana(common.WatcherPlugin):
         """
         parser.add_argument('--etcd_addr', dest="etcd_addr",
                             default="localhost",
-                            help="etcd's address to connect to "
+                            help="etcd's address to connect to, or a comma "
+                                 "separated list of cluster members, each "
+                                 "optionally as address:port "
                                  "(only in Romana mode, default: localhost)")
         parser.add_argument('--etcd_port', dest="etcd_port",
                             default="2379", type=int,
@@ -386,8 +1285,173 @@ class Romana(common.WatcherPlugin):
                             help="Filename of PEM encoded cert chain file "
                                  "(do not set for plain http connection "
                                  "to etcd)")
+        parser.add_argument('--debounce_time', dest="debounce_time",
+                            default=DEFAULT_DEBOUNCE_TIME, type=float,
+                            help="Seconds without further topology change "
+                                 "events before a burst of events is "
+                                 "processed (only in Romana mode, "
+                                 "default: %s)" % DEFAULT_DEBOUNCE_TIME)
+        parser.add_argument('--max_update_delay', dest="max_update_delay",
+                            default=DEFAULT_MAX_UPDATE_DELAY, type=float,
+                            help="Maximum seconds a topology change may be "
+                                 "delayed by the debounce time (only in "
+                                 "Romana mode, default: %s)" %
+                                 DEFAULT_MAX_UPDATE_DELAY)
+        parser.add_argument('--latest_route_spec_only',
+                            dest="latest_route_spec_only",
+                            action='store_true',
+                            help="Replace a route spec, which was not yet "
+                                 "processed, with a newer one, rather than "
+                                 "queueing it (only in Romana mode)")
+        parser.add_argument('--min_check_time', dest="min_check_time",
+                            default=DEFAULT_MIN_CHECK_TIME, type=float,
+                            help="Initial seconds between etcd connection "
+                                 "checks, which grows while the connection "
+                                 "is stable (only in Romana mode, "
+                                 "default: %s)" % DEFAULT_MIN_CHECK_TIME)
+        parser.add_argument('--max_check_time', dest="max_check_time",
+                            default=DEFAULT_MAX_CHECK_TIME, type=float,
+                            help="Maximum seconds between etcd connection "
+                                 "checks (only in Romana mode, default: %s)" %
+                                 DEFAULT_MAX_CHECK_TIME)
+        parser.add_argument('--min_backoff_time', dest="min_backoff_time",
+                            default=DEFAULT_MIN_BACKOFF_TIME, type=float,
+                            help="Initial seconds to wait before reconnecting "
+                                 "to etcd, doubled for every failed attempt "
+                                 "(only in Romana mode, default: %s)" %
+                                 DEFAULT_MIN_BACKOFF_TIME)
+        parser.add_argument('--max_backoff_time', dest="max_backoff_time",
+                            default=DEFAULT_MAX_BACKOFF_TIME, type=float,
+                            help="Maximum seconds to wait before reconnecting "
+                                 "to etcd (only in Romana mode, default: %s)" %
+                                 DEFAULT_MAX_BACKOFF_TIME)
+        parser.add_argument('--max_group_depth', dest="max_group_depth",
+                            default=DEFAULT_MAX_GROUP_DEPTH, type=int,
+                            help="Maximum nesting depth of host groups in "
+                                 "the topology, deeper groups are ignored "
+                                 "(only in Romana mode, default: %s)" %
+                                 DEFAULT_MAX_GROUP_DEPTH)
+        parser.add_argument('--max_groups', dest="max_groups",
+                            default=DEFAULT_MAX_GROUPS, type=int,
+                            help="Maximum number of host groups per network "
+                                 "in the topology, further groups are "
+                                 "ignored (only in Romana mode, "
+                                 "default: %s)" % DEFAULT_MAX_GROUPS)
+        parser.add_argument('--streaming_decode', dest="streaming_decode",
+                            action='store_true',
+                            help="Only decode the parts of the topology data "
+                                 "needed for routing, without building the "
+                                 "full document (uses ijson if installed) "
+                                 "(only in Romana mode)")
+        parser.add_argument('--json_backend', dest="json_backend",
+                            default="auto",
+                            choices=["auto"] + JSON_BACKENDS,
+                            help="JSON decoder for the topology data, 'auto' "
+                                 "picks the fastest installed one (only in "
+                                 "Romana mode, default: auto)")
+        parser.add_argument('--topology_prefix', dest="topology_prefix",
+                            default=None,
+                            help="Read the topology from all keys under this "
+                                 "etcd prefix, each holding a topology "
+                                 "document with one or more networks, "
+                                 "instead of the single topology key (only "
+                                 "in Romana mode)")
+        parser.add_argument('--raw_topology_retention',
+                            dest="raw_topology_retention",
+                            default=DEFAULT_RETENTION,
+                            choices=RETENTION_MODES,
+                            help="What to keep and report of the raw "
+                                 "topology data: The full data, a summary or "
+                                 "the recent route spec changes (only in "
+                                 "Romana mode, default: %s)" %
+                                 DEFAULT_RETENTION)
+        parser.add_argument('--raw_topology_diffs', dest="raw_topology_diffs",
+                            default=DEFAULT_MAX_DIFFS, type=int,
+                            help="Number of route spec changes to keep in "
+                                 "'diffs' retention mode (only in Romana "
+                                 "mode, default: %s)" % DEFAULT_MAX_DIFFS)
+        parser.add_argument('--aggregate_routes', dest="aggregate_routes",
+                            action='store_true',
+                            help="Combine adjacent and nested CIDRs with the "
+                                 "same hosts into fewer route entries (only "
+                                 "in Romana mode)")
+        parser.add_argument('--include_networks', dest="include_networks",
+                            default=None,
+                            help="Comma separated list of patterns (with "
+                                 "'*' and '?') for the names of the "
+                                 "topology networks to use, all others are "
+                                 "ignored (only in Romana mode)")
+        parser.add_argument('--exclude_networks', dest="exclude_networks",
+                            default=None,
+                            help="Comma separated list of patterns for the "
+                                 "names of topology networks to ignore "
+                                 "(only in Romana mode)")
+        parser.add_argument('--include_cidrs', dest="include_cidrs",
+                            default=None,
+                            help="Comma separated list of CIDRs: Only "
+                                 "topology networks within one of them are "
+                                 "used (only in Romana mode)")
+        parser.add_argument('--exclude_cidrs', dest="exclude_cidrs",
+                            default=None,
+                            help="Comma separated list of CIDRs: Topology "
+                                 "networks within one of them are ignored "
+                                 "(only in Romana mode)")
+        parser.add_argument('--metrics_port', dest="metrics_port",
+                            default=None, type=int,
+                            help="Serve metrics for Prometheus on this port, "
+                                 "at /metrics (only in Romana mode, default: "
+                                 "not served)")
+        parser.add_argument('--metrics_addr', dest="metrics_addr",
+                            default=DEFAULT_METRICS_ADDR,
+                            help="Address to serve the metrics on (only in "
+                                 "Romana mode, default: %s)" %
+                                 DEFAULT_METRICS_ADDR)
+        parser.add_argument('--profile_dir', dest="profile_dir",
+                            default=None,
+                            help="Enable profiling of topology updates: "
+                                 "After a SIGUSR2, the next updates are "
+                                 "profiled and the profiles and topology "
+                                 "data are written to this directory (only "
+                                 "in Romana mode)")
+        parser.add_argument('--profile_updates', dest="profile_updates",
+                            default=DEFAULT_PROFILE_UPDATES, type=int,
+                            help="Number of updates profiled after a signal "
+                                 "(only in Romana mode, default: %s)" %
+                                 DEFAULT_PROFILE_UPDATES)
+        parser.add_argument('--profile_at_start', dest="profile_at_start",
+                            action='store_true',
+                            help="Profile the first updates after the start, "
+                                 "without waiting for a signal (only in "
+                                 "Romana mode)")
         return ["etcd_addr", "etcd_port", "usev2",
-                "ca_cert", "priv_key", "cert_chain"]
+                "ca_cert", "priv_key", "cert_chain",
+                "debounce_time", "max_update_delay",
+                "latest_route_spec_only",
+                "min_check_time", "max_check_time",
+                "min_backoff_time", "max_backoff_time",
+                "max_group_depth", "max_groups", "streaming_decode",
+                "json_backend", "topology_prefix",
+                "raw_topology_retention", "raw_topology_diffs",
+                "aggregate_routes", "metrics_port",
+                "metrics_addr", "profile_dir", "profile_updates",
+                "profile_at_start"] + SELECTOR_OPTIONS
+
+    @classmethod
+    def _check_time_range(cls, conf, name):
+        """
+        Sanity check a pair of 'min_<name>_time' and 'max_<name>_time'
+        options.
+
+        """
+        min_time = conf.get('min_%s_time' % name)
+        max_time = conf.get('max_%s_time' % name)
+        if min_time is not None and min_time <= 0:
+            raise ArgsError("Invalid min %s time '%s' for Romana mode." %
+                            (name, min_time))
+        if None not in [min_time, max_time] and max_time < min_time:
+            raise ArgsError("The max %s time cannot be less than the "
+                            "min %s time (--max_%s_time parameter)" %
+                            (name, name, name))
 
     @classmethod
     def check_arguments(cls, conf):
@@ -404,6 +1468,74 @@ class Romana(common.WatcherPlugin):
         if not 0 < conf['etcd_port'] < 65535:
             raise ArgsError("Invalid etcd port '%d' for Romana mode." %
                             conf['etcd_port'])
+        try:
+            endpoints = parse_endpoints(conf['etcd_addr'], conf['etcd_port'])
+        except ValueError as e:
+            raise ArgsError("Invalid etcd address '%s' for Romana mode: %s" %
+                            (conf['etcd_addr'], str(e)))
+        if not endpoints:
+            raise ArgsError("The etcd address needs to be specified "
+                            "(--etcd_addr parameter)")
+        debounce_time    = conf.get('debounce_time', DEFAULT_DEBOUNCE_TIME)
+        max_update_delay = conf.get('max_update_delay',
+                                    DEFAULT_MAX_UPDATE_DELAY)
+        if debounce_time < 0:
+            raise ArgsError("Invalid debounce time '%s' for Romana mode." %
+                            debounce_time)
+        if max_update_delay < debounce_time:
+            raise ArgsError("The max update delay cannot be less than the "
+                            "debounce time (--max_update_delay parameter)")
+        for name in ["check", "backoff"]:
+            cls._check_time_range(conf, name)
+        if conf.get('profile_dir') and \
+                os.path.exists(conf['profile_dir']) and \
+                not os.path.isdir(conf['profile_dir']):
+            raise ArgsError("Invalid profile directory '%s' for Romana mode, "
+                            "it is not a directory." % conf['profile_dir'])
+        if conf.get('metrics_port') is not None and \
+                not 0 < conf['metrics_port'] < 65535:
+            raise ArgsError("Invalid metrics port '%d' for Romana mode." %
+                            conf['metrics_port'])
+        cls._check_topology_arguments(conf)
+        cls._check_cert_arguments(conf)
+
+    @classmethod
+    def _check_topology_arguments(cls, conf):
+        """
+        Sanity check the options for processing the topology data.
+
+        """
+        for name in ["max_group_depth", "max_groups", "raw_topology_diffs",
+                     "profile_updates"]:
+            if conf.get(name, 1) < 1:
+                raise ArgsError("Invalid %s '%s' for Romana mode." %
+                                (name.replace("_", " "), conf[name]))
+        if conf.get('json_backend', "auto") not in ["auto"] + JSON_BACKENDS:
+            raise ArgsError("Invalid JSON backend '%s' for Romana mode." %
+                            conf['json_backend'])
+        if conf.get('raw_topology_retention', DEFAULT_RETENTION) not in \
+                                                        RETENTION_MODES:
+            raise ArgsError("Invalid raw topology retention '%s' for Romana "
+                            "mode." % conf['raw_topology_retention'])
+        for name in ["include_cidrs", "exclude_cidrs"]:
+            for cidr in parse_list(conf.get(name)):
+                try:
+                    utils.ip_check(cidr, netmask_expected=True)
+                except ArgsError as e:
+                    raise ArgsError("Invalid %s for Romana mode: %s" %
+                                    (name.replace("_", " "), str(e)))
+        if conf.get('topology_prefix') is not None and \
+                not conf['topology_prefix'].startswith("/"):
+            raise ArgsError("Invalid topology prefix '%s' for Romana mode, "
+                            "it needs to start with '/'." %
+                            conf['topology_prefix'])
+
+    @classmethod
+    def _check_cert_arguments(cls, conf):
+        """
+        Sanity check the SSL auth options.
+
+        """
         cert_args = [conf.get('ca_cert'), conf.get('priv_key'),
                      conf.get('cert_chain')]
         if any(cert_args):
@@ -0,0 +1,126 @@
+"""
+Copyright 2017 Pani Networks Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+#
+# Selection of the networks in the topology, which are relevant for us.
+#
+
+import fnmatch
+
+import netaddr
+
+
+def parse_list(value):
+    """
+    Return the elements of a comma separated list, without empty ones.
+
+    """
+    if not value:
+        return []
+    return [elem.strip() for elem in value.split(",") if elem.strip()]
+
+
+def network_cidr(net_data):
+    """
+    Return the CIDR of a network in the topology (from the network itself
+    or its top level host group), or None if it has none.
+
+    """
+    cidr = net_data.get("cidr")
+    if not cidr:
+        host_groups = net_data.get("host_groups")
+        if type(host_groups) is dict:
+            cidr = host_groups.get("cidr")
+    return cidr if isinstance(cidr, basestring) else None
+
+
+class NetworkSelector(object):
+    """
+    Decides which networks of the topology are used for the route spec.
+
+    Networks are selected by name (shell style patterns) and by their CIDR,
+    which needs to be within one of the given ranges. If include patterns or
+    ranges are given, a network needs to match one of them. A network, which
+    matches an exclude pattern or range, is skipped.
+
+    The decision for a network only depends on its name and CIDR, so it is
+    remembered for as long as neither changes.
+
+    """
+    MAX_CACHED = 10000
+
+    def __init__(self, include_names=None, exclude_names=None,
+                 include_cidrs=None, exclude_cidrs=None):
+        self.include_names = include_names or []
+        self.exclude_names = exclude_names or []
+        self.include_cidrs = [netaddr.IPNetwork(c)
+                              for c in include_cidrs or []]
+        self.exclude_cidrs = [netaddr.IPNetwork(c)
+                              for c in exclude_cidrs or []]
+        self.decisions     = {}   # (name, cidr) -> selected
+        self.num_selected  = 0
+        self.num_skipped   = 0
+
+    def _in_ranges(self, cidr, ranges):
+        if not cidr:
+            return False
+        try:
+            net = netaddr.IPNetwork(cidr)
+        except (netaddr.AddrFormatError, TypeError, ValueError):
+            return False
+        return any(net.version == r.version and net in r for r in ranges)
+
+    def _decide(self, name, cidr):
+        if self.include_names and \
+                not any(fnmatch.fnmatchcase(name, pattern)
+                        for pattern in self.include_names):
+            return False
+        if any(fnmatch.fnmatchcase(name, pattern)
+               for pattern in self.exclude_names):
+            return False
+        if self.include_cidrs and \
+                not self._in_ranges(cidr, self.include_cidrs):
+            return False
+        return not self._in_ranges(cidr, self.exclude_cidrs)
+
+    def selects(self, name, net_data):
+        """
+        Return True if the network should be used.
+
+        """
+        cidr     = network_cidr(net_data) if type(net_data) is dict else None
+        key      = (name, cidr)
+        selected = self.decisions.get(key)
+        if selected is None:
+            if len(self.decisions) >= self.MAX_CACHED:
+                self.decisions = {}
+            selected = self.decisions[key] = self._decide(name, cidr)
+        if selected:
+            self.num_selected += 1
+        else:
+            self.num_skipped += 1
+        return selected
+
+    def get_stats(self):
+        """
+        Return the selection stats as a dictionary.
+
+        """
+        return {
+            "networks_selected" : self.num_selected,
+            "networks_skipped"  : self.num_skipped
+        }
@@ -0,0 +1,76 @@
+"""
+Copyright 2017 Pani Networks Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+#
+# Unit tests for the aggregation of route entries
+#
+
+import unittest
+
+from vpcrouter_romana_plugin.aggregation import aggregate_routes
+
+
+class TestAggregation(unittest.TestCase):
+
+    def test_adjacent(self):
+        spec = {"10.1.0.0/26"   : ["1.1.1.1"],
+                "10.1.0.64/26"  : ["1.1.1.1"],
+                "10.1.0.128/25" : ["1.1.1.1"],
+                "10.2.0.0/25"   : ["1.1.1.1"],
+                "10.2.0.128/25" : ["2.2.2.2"]}
+        self.assertEqual(aggregate_routes(spec),
+                         {"10.1.0.0/24"   : ["1.1.1.1"],
+                          "10.2.0.0/25"   : ["1.1.1.1"],
+                          "10.2.0.128/25" : ["2.2.2.2"]})
+        # A shadowed entry for the covering prefix is replaced
+        spec = {"10.1.0.0/24"   : ["2.2.2.2"],
+                "10.1.0.0/25"   : ["1.1.1.1"],
+                "10.1.0.128/25" : ["1.1.1.1"]}
+        self.assertEqual(aggregate_routes(spec),
+                         {"10.1.0.0/24" : ["1.1.1.1"]})
+
+    def test_nested(self):
+        spec = {"10.0.0.0/8"  : ["1.1.1.1"],
+                "10.1.0.0/16" : ["1.1.1.1"],
+                "10.2.0.0/16" : ["2.2.2.2"],
+                "10.2.1.0/24" : ["1.1.1.1"],
+                "10.2.2.0/24" : ["2.2.2.2"]}
+        # Only entries with the same hosts as the closest enclosing entry are
+        # dropped
+        self.assertEqual(aggregate_routes(spec),
+                         {"10.0.0.0/8"  : ["1.1.1.1"],
+                          "10.2.0.0/16" : ["2.2.2.2"],
+                          "10.2.1.0/24" : ["1.1.1.1"]})
+
+    def test_ordering(self):
+        spec   = {"10.2.0.0/16" : ["1.1.1.1"], "10.1.0.0/16" : ["2.2.2.2"],
+                  "fe80::/64"   : ["3.3.3.3"]}
+        result = aggregate_routes(spec)
+        self.assertEqual(result.keys(),
+                         ["10.1.0.0/16", "10.2.0.0/16", "fe80::/64"])
+
+    def test_not_canonical(self):
+        # Host bits set: Left alone
+        spec = {"10.1.0.5/25" : ["1.1.1.1"], "10.1.0.128/25" : ["1.1.1.1"]}
+        self.assertEqual(aggregate_routes(spec), spec)
+
+    def test_many(self):
+        spec = dict(("10.%d.%d.0/24" % (i / 256, i % 256),
+                     ["192.168.0.%d" % (i / 64)]) for i in range(4096))
+        result = aggregate_routes(spec)
+        self.assertEqual(len(result), 64)
+        self.assertEqual(result["10.0.0.0/18"], ["192.168.0.0"])
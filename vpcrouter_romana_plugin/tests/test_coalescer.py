@@ -0,0 +1,61 @@
+"""
+Copyright 2017 Pani Networks Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+
+#
+# Unit tests for the event coalescer
+#
+
+import time
+import unittest
+
+from vpcrouter_romana_plugin.coalescer import EventCoalescer
+
+
+class TestEventCoalescer(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+    def _func(self, data):
+        self.calls.append((time.time(), data))
+
+    def test_burst_is_coalesced(self):
+        c = EventCoalescer(self._func, 0.2, 5.0)
+        c.start()
+        for i in range(100):
+            c.notify(i)
+        time.sleep(0.5)
+        c.stop()
+        self.assertEqual(len(self.calls), 1)
+        # Called with the data of the last notification
+        self.assertEqual(self.calls[0][1], 99)
+        self.assertEqual(c.num_events, 100)
+        self.assertEqual(c.num_calls, 1)
+
+    def test_max_delay(self):
+        # Constant stream of events, which never leaves a quiet debounce
+        # window: We still get called once the max delay is reached.
+        c = EventCoalescer(self._func, 0.2, 0.3)
+        c.start()
+        start = time.time()
+        while time.time() - start < 1.0:
+            c.notify()
+            time.sleep(0.02)
+        c.stop()
+        self.assertTrue(len(self.calls) >= 2)
+        self.assertTrue(self.calls[0][0] - start < 0.5)
@@ -0,0 +1,56 @@
+"""
+Copyright 2017 Pani Networks Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+#
+# Unit tests for the compact representation of route entries
+#
+
+import unittest
+
+from vpcrouter_romana_plugin.compact import (intern_ip, pack_ip,
+                                             pack_routes, unpack_hosts,
+                                             unpack_ip)
+
+
+class TestCompact(unittest.TestCase):
+
+    def test_pack_ip(self):
+        self.assertEqual(pack_ip(u"10.0.0.1"), 0x0a000001)
+        self.assertEqual(unpack_ip(pack_ip("192.168.1.255")), "192.168.1.255")
+        # Anything that isn't a strict IPv4 address is kept as is, so that
+        # it can still be rejected by the route spec validation.
+        for ip in ["10.1", "fe80::1", "foo", ""]:
+            self.assertEqual(unpack_ip(pack_ip(ip)), ip)
+        for ip in [None, 17]:
+            self.assertRaises(ValueError, pack_ip, ip)
+
+    def test_pack_routes(self):
+        packed = pack_routes({"10.0.0.0/8" : ["10.0.0.2", "10.0.0.1",
+                                              "10.0.0.2", "bad"]})
+        self.assertEqual(packed, {"10.0.0.0/8" : (0x0a000001, 0x0a000002,
+                                                  "bad")})
+        self.assertEqual(unpack_hosts(packed["10.0.0.0/8"]),
+                         ["10.0.0.1", "10.0.0.2", "bad"])
+
+    def test_intern_ip(self):
+        ip = intern_ip(u"10.0.0.1")
+        self.assertEqual(type(ip), str)
+        self.assertEqual(ip, "10.0.0.1")
+        self.assertTrue(intern_ip(u"10.0.0.1") is ip)
+        # Anything else is kept as is, for the route spec validation.
+        for ip in [u"10.0.0.\xe9", None, 17]:
+            self.assertEqual(intern_ip(ip), ip)
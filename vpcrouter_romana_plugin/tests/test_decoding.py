@@ -0,0 +1,186 @@
+"""
+Copyright 2017 Pani Networks Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+#
+# Unit tests for decoding the topology data
+#
+
+import gzip
+import io
+import json
+import unittest
+
+from vpcrouter_romana_plugin          import decoding
+from vpcrouter_romana_plugin.topology import build_route_spec
+
+
+TOPOLOGY = json.dumps({
+    "networks" : {
+        "net-a" : {
+            "name"        : "net-a",
+            "cidr"        : "10.0.0.0/8",
+            "host_groups" : {
+                "groups" : [
+                    {
+                        "cidr"   : "10.1.0.0/16",
+                        "labels" : {"cidr" : "not-this-one", "x" : [1, 2]},
+                        "hosts"  : [{"ip" : "192.168.1.1", "name" : "h1",
+                                     "agent_port" : 9604}]
+                    },
+                    {
+                        "groups" : [
+                            {
+                                "cidr"  : "10.2.0.0/16",
+                                "hosts" : [{"ip" : "192.168.1.2"}],
+                                "revision" : 7
+                            }
+                        ]
+                    }
+                ]
+            }
+        },
+        "net-b" : {
+            "host_groups" : {
+                "cidr"  : "10.3.0.0/16",
+                "hosts" : [{"ip" : "192.168.1.3", "tags" : [{"a" : "b"}]}]
+            }
+        }
+    },
+    "revision" : 12,
+    "tenants"  : [{"name" : "t1", "cidr" : "10.9.0.0/16"}]
+})
+
+PRUNED = {
+    "networks" : {
+        "net-a" : {
+            "cidr"        : "10.0.0.0/8",
+            "host_groups" : {
+                "groups" : [
+                    {
+                        "cidr"   : "10.1.0.0/16",
+                        "hosts"  : [{"ip" : "192.168.1.1"}]
+                    },
+                    {
+                        "groups" : [
+                            {
+                                "cidr"  : "10.2.0.0/16",
+                                "hosts" : [{"ip" : "192.168.1.2"}]
+                            }
+                        ]
+                    }
+                ]
+            }
+        },
+        "net-b" : {
+            "host_groups" : {
+                "cidr"  : "10.3.0.0/16",
+                "hosts" : [{"ip" : "192.168.1.3"}]
+            }
+        }
+    }
+}
+
+
+class TestDecoding(unittest.TestCase):
+
+    def test_pruning_hook(self):
+        d = json.loads(TOPOLOGY, object_pairs_hook=decoding._prune_pairs)
+        self.assertEqual(d, PRUNED)
+        self.assertEqual(build_route_spec(d),
+                         build_route_spec(json.loads(TOPOLOGY)))
+
+    @unittest.skipIf(decoding.ijson is None, "ijson not installed")
+    def test_ijson(self):
+        self.assertEqual(decoding.decode_topology_streaming(TOPOLOGY), PRUNED)
+        self.assertEqual(
+                decoding.decode_topology_streaming(TOPOLOGY.decode("utf-8")),
+                PRUNED)
+
+    def test_json_backends(self):
+        name, loads = decoding.get_json_backend("json")
+        self.assertEqual((name, loads), ("json", json.loads))
+        name, loads = decoding.get_json_backend("auto")
+        self.assertIn(name, decoding.JSON_BACKENDS)
+        self.assertEqual(loads(TOPOLOGY), json.loads(TOPOLOGY))
+
+        # Fall back to stdlib if the backend can't be imported
+        name, loads = decoding.get_json_backend("no_such_json_module")
+        self.assertEqual((name, loads), ("json", json.loads))
+
+    def test_keyed_decoder(self):
+        self.assertIsNone(decoding.get_keyed_decoder("ujson"))
+        changed = TOPOLOGY.replace("192.168.1.3", "192.168.1.9")
+        for backend in decoding.KEYED_JSON_BACKENDS:
+            decode = decoding.get_keyed_decoder(backend)
+            d1, d2 = decode(TOPOLOGY), decode(changed)
+            self.assertEqual(d1, json.loads(TOPOLOGY))
+            self.assertEqual(d2, json.loads(changed))
+
+            # Only the key of the changed network differs
+            keys1 = d1['networks'].raw_keys
+            keys2 = d2['networks'].raw_keys
+            self.assertEqual(keys1['net-a'], keys2['net-a'])
+            self.assertNotEqual(keys1['net-b'], keys2['net-b'])
+
+            self.assertEqual(decode(" [1] "), [1])
+            for bad in ['{"networks" : {"a" : 1,}}', '{"a" : 1} x']:
+                self.assertRaises(ValueError, decode, bad)
+
+
+def _gzip(data):
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode="wb") as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+class TestValueFormats(unittest.TestCase):
+
+    def test_json(self):
+        self.assertEqual(decoding.decode_value(TOPOLOGY, json.loads),
+                         ("json", json.loads(TOPOLOGY)))
+        self.assertEqual(decoding.decode_value(TOPOLOGY.decode("utf-8"),
+                                               json.loads),
+                         ("json", json.loads(TOPOLOGY)))
+
+    def test_gzip(self):
+        self.assertEqual(decoding.decode_value(_gzip(TOPOLOGY), json.loads),
+                         ("gzip+json", json.loads(TOPOLOGY)))
+
+    @unittest.skipIf(decoding.zstandard is None, "zstandard not installed")
+    def test_zstd(self):
+        data = decoding.zstandard.ZstdCompressor().compress(TOPOLOGY)
+        self.assertEqual(decoding.decode_value(data, json.loads),
+                         ("zstd+json", json.loads(TOPOLOGY)))
+
+    @unittest.skipIf(decoding.msgpack is None, "msgpack not installed")
+    def test_msgpack(self):
+        data = decoding.msgpack.packb(json.loads(TOPOLOGY),
+                                      use_bin_type=True)
+        self.assertEqual(decoding.decode_value(data, json.loads),
+                         ("msgpack", json.loads(TOPOLOGY)))
+        self.assertEqual(decoding.decode_value(_gzip(data), json.loads),
+                         ("gzip+msgpack", json.loads(TOPOLOGY)))
+
+    def test_missing_module(self):
+        msgpack, decoding.msgpack = decoding.msgpack, None
+        try:
+            self.assertRaisesRegexp(ValueError, "'msgpack' module",
+                                    decoding.decode_value, b"\x81\xa1a\x01",
+                                    json.loads)
+        finally:
+            decoding.msgpack = msgpack
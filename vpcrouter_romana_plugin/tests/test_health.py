@@ -0,0 +1,85 @@
+"""
+Copyright 2017 Pani Networks Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+#
+# Unit tests for the health check and reconnect scheduling
+#
+
+import time
+import unittest
+
+from vpcrouter_romana_plugin.health import (AdaptiveInterval, Backoff,
+                                            EndpointSet, parse_endpoints)
+
+
+class TestScheduling(unittest.TestCase):
+
+    def test_backoff(self):
+        b = Backoff(1.0, 10.0)
+        for base in [1.0, 2.0, 4.0, 8.0, 10.0, 10.0]:
+            delay = b.next_delay()
+            self.assertTrue(base / 2.0 <= delay <= base)
+        b.reset()
+        self.assertTrue(0.5 <= b.next_delay() <= 1.0)
+
+    def test_adaptive_interval(self):
+        i = AdaptiveInterval(2.0, 5.0)
+        self.assertEqual(i.current, 2.0)
+        i.grow()
+        self.assertEqual(i.current, 3.0)
+        i.grow()
+        i.grow()
+        self.assertEqual(i.current, 5.0)
+        i.reset()
+        self.assertEqual(i.current, 2.0)
+
+
+class TestEndpoints(unittest.TestCase):
+
+    def test_parse_endpoints(self):
+        self.assertEqual(parse_endpoints("localhost", 2379),
+                         [("localhost", 2379)])
+        self.assertEqual(parse_endpoints("10.0.0.1:2380, 10.0.0.2,", 2379),
+                         [("10.0.0.1", 2380), ("10.0.0.2", 2379)])
+        self.assertEqual(parse_endpoints("[fe80::1]:2380,fe80::2", 2379),
+                         [("fe80::1", 2380), ("fe80::2", 2379)])
+        self.assertRaises(ValueError, parse_endpoints, "foo:bar", 2379)
+        self.assertRaises(ValueError, parse_endpoints, "foo:99999", 2379)
+
+    def test_endpoint_ranking(self):
+        es = EndpointSet([("a", 1), ("b", 2), ("c", 3)], 10.0)
+        a, b, c = es.endpoints
+        # Configured order, regardless of the observed latency
+        es.record_latency(a, 0.5)
+        es.record_latency(b, 0.1)
+        self.assertIs(es.select(), a)
+        es.record_latency(b, 1.1)
+        self.assertAlmostEqual(b.latency, 0.4)
+
+        # Failed members are avoided
+        now = time.time()
+        es.record_failure(b, now - 2)
+        self.assertIs(es.select(), a)
+        es.record_failure(a, now - 1)
+        self.assertIs(es.select(), c)
+        self.assertTrue(es.has_healthy())
+
+        # All failed: The one that failed longest ago
+        es.record_failure(c, now)
+        self.assertFalse(es.has_healthy())
+        self.assertIs(es.select(), b)
+        self.assertEqual([s['failures'] for s in es.get_stats()], [1, 1, 1])
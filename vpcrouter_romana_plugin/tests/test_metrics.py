@@ -0,0 +1,115 @@
+"""
+Copyright 2017 Pani Networks Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+#
+# Unit tests for the counters and latency histograms
+#
+
+import unittest
+import urllib2
+
+from vpcrouter_romana_plugin.exporter import MetricsServer
+from vpcrouter_romana_plugin.metrics  import Histogram, Metrics
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_histogram(self):
+        h = Histogram()
+        self.assertEqual(h.get_stats(),
+                         {"count" : 0, "p50_ms" : None, "p95_ms" : None,
+                          "p99_ms" : None, "max_ms" : None})
+        for i in range(1, 101):
+            h.observe(i / 1000.0)
+        self.assertEqual(h.get_stats(),
+                         {"count" : 100, "p50_ms" : 50.0, "p95_ms" : 95.0,
+                          "p99_ms" : 99.0, "max_ms" : 100.0})
+        self.assertEqual(sum(h.bucket_counts), 100)
+        self.assertEqual(h.bucket_counts[0], 1)     # up to 1ms
+        self.assertEqual(h.bucket_counts[6], 50)    # 50ms to 100ms
+
+        # Percentiles only cover the recent samples, the max all of them
+        for i in range(h.WINDOW):
+            h.observe(0.001)
+        stats = h.get_stats()
+        self.assertEqual(stats['p99_ms'], 1.0)
+        self.assertEqual(stats['max_ms'], 100.0)
+        self.assertEqual(stats['count'], 100 + h.WINDOW)
+
+    def test_metrics(self):
+        m = Metrics()
+        m.inc("loads")
+        m.inc("loads", 2)
+        with m.timer("load"):
+            pass
+        self.assertIsNone(m.take_event_time())
+        m.record_event()
+        first = m.first_event_time
+        m.record_event()
+        self.assertEqual(m.take_event_time(), first)
+        self.assertIsNone(m.take_event_time())
+
+        stats = m.get_stats()
+        self.assertEqual(stats['counters'],
+                         {"loads" : 3, "watch_events" : 2})
+        self.assertEqual(stats['latencies']['load']['count'], 1)
+        self.assertEqual(m.get_counter("watch_events"), 2)
+        self.assertEqual(m.get_counter("reconnects"), 0)
+
+    def test_render_text(self):
+        m = Metrics()
+        m.inc("loads", 2)
+        m.observe("load", 0.003)
+        m.observe("load", 20.0)
+        text = m.render_text("test_", counters={"updates_published" : 1},
+                             gauges={"route_spec_cidrs" : 5,
+                                     "last_revision"    : None})
+        lines = text.splitlines()
+        self.assertIn("# TYPE test_loads_total counter", lines)
+        self.assertIn("test_loads_total 2", lines)
+        self.assertIn("test_updates_published_total 1", lines)
+        self.assertIn("# TYPE test_route_spec_cidrs gauge", lines)
+        self.assertIn("test_route_spec_cidrs 5", lines)
+        self.assertNotIn("last_revision", text)
+        self.assertIn("# TYPE test_stage_duration_seconds histogram", lines)
+        self.assertIn('test_stage_duration_seconds_bucket{stage="load",'
+                      'le="0.0025"} 0', lines)
+        self.assertIn('test_stage_duration_seconds_bucket{stage="load",'
+                      'le="0.005"} 1', lines)
+        self.assertIn('test_stage_duration_seconds_bucket{stage="load",'
+                      'le="10.0"} 1', lines)
+        self.assertIn('test_stage_duration_seconds_bucket{stage="load",'
+                      'le="+Inf"} 2', lines)
+        self.assertIn('test_stage_duration_seconds_sum{stage="load"} 20.003',
+                      lines)
+        self.assertIn('test_stage_duration_seconds_count{stage="load"} 2',
+                      lines)
+
+    def test_server(self):
+        server = MetricsServer("localhost", 0, lambda: "test_loads_total 1\n")
+        server.start()
+        try:
+            url = "http://localhost:%d/" % server.port
+            res = urllib2.urlopen(url + "metrics")
+            self.assertEqual(res.read(), "test_loads_total 1\n")
+            self.assertTrue(res.info()["Content-Type"].startswith(
+                                                            "text/plain"))
+            with self.assertRaises(urllib2.HTTPError) as cm:
+                urllib2.urlopen(url + "foo")
+            self.assertEqual(cm.exception.code, 404)
+        finally:
+            server.stop()
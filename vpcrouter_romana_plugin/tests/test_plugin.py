@@ -19,8 +19,20 @@ limitations under the License.
 # Unit tests for the Romana watcher plugin
 #
 
+import collections
+import etcd
 import etcd3
+import etcd3.etcdrpc
+import etcd3.etcdrpc.kv_pb2
+import etcd3.events
+import grpc
+import json
 import logging
+import os
+import shutil
+import signal
+import tempfile
+import threading
 import time
 import unittest
 
@@ -29,7 +41,7 @@ from testfixtures                   import LogCapture
 from vpcrouter.errors               import ArgsError
 from vpcrouter.tests                import test_common
 
-from vpcrouter_romana_plugin.romana import Romana
+from vpcrouter_romana_plugin.romana import Romana, TopologyUpdate
 
 
 class TestPluginBase(unittest.TestCase):
@@ -65,6 +77,51 @@ class TestPluginConf(TestPluginBase):
         self.assertRaises(ArgsError, Romana.check_arguments, conf)
         conf['etcd_port'] = 123
         Romana.check_arguments(conf)
+        conf['etcd_addr'] = "10.0.0.1:2379,10.0.0.2:foo"
+        self.assertRaisesRegexp(ArgsError, 'Invalid etcd address',
+                                Romana.check_arguments, conf)
+        conf['etcd_addr'] = " , "
+        self.assertRaisesRegexp(ArgsError, 'etcd address needs to be',
+                                Romana.check_arguments, conf)
+        conf['etcd_addr'] = "10.0.0.1:2379,10.0.0.2"
+        Romana.check_arguments(conf)
+        conf['debounce_time'] = -1
+        self.assertRaisesRegexp(ArgsError, 'Invalid debounce time',
+                                Romana.check_arguments, conf)
+        conf['debounce_time'] = 2.0
+        conf['max_update_delay'] = 1.0
+        self.assertRaisesRegexp(ArgsError, 'max update delay cannot be less',
+                                Romana.check_arguments, conf)
+        conf['max_update_delay'] = 5.0
+        Romana.check_arguments(conf)
+        conf['min_backoff_time'] = 0
+        self.assertRaisesRegexp(ArgsError, 'Invalid min backoff time',
+                                Romana.check_arguments, conf)
+        conf['min_backoff_time'] = 10.0
+        conf['max_backoff_time'] = 5.0
+        self.assertRaisesRegexp(ArgsError, 'max backoff time cannot be less',
+                                Romana.check_arguments, conf)
+        conf['max_backoff_time'] = 60.0
+        Romana.check_arguments(conf)
+        conf['max_group_depth'] = 0
+        self.assertRaisesRegexp(ArgsError, 'Invalid max group depth',
+                                Romana.check_arguments, conf)
+        conf['max_group_depth'] = 10
+        conf['json_backend'] = "foo"
+        self.assertRaisesRegexp(ArgsError, 'Invalid JSON backend',
+                                Romana.check_arguments, conf)
+        conf['json_backend'] = "json"
+        Romana.check_arguments(conf)
+        conf['exclude_cidrs'] = "10.0.0.0/8, 10.1.0.0"
+        self.assertRaisesRegexp(ArgsError, 'Invalid exclude cidrs',
+                                Romana.check_arguments, conf)
+        conf['exclude_cidrs'] = "10.0.0.0/8, 10.1.0.0/16"
+        Romana.check_arguments(conf)
+        conf['metrics_port'] = 70000
+        self.assertRaisesRegexp(ArgsError, 'Invalid metrics port',
+                                Romana.check_arguments, conf)
+        conf['metrics_port'] = 9100
+        Romana.check_arguments(conf)
         conf['ca_cert'] = "foo-cert"
         self.assertRaisesRegexp(ArgsError, 'Either set all SSL auth options',
                                 Romana.check_arguments, conf)
@@ -89,17 +146,12 @@ class TestPluginConf(TestPluginBase):
              'Romana watcher plugin: Starting to watch for '
              'topology updates...'),
             ('root', 'DEBUG', 'Attempting to connect to etcd (APIv3)'),
-            ('root', 'DEBUG', 'Initial data read'),
-            ('root', 'ERROR',
-             "Cannot load Romana topology data at '/romana/ipam/data': "),
-            ('root', 'DEBUG',
-             "Attempting to establish watch on '/romana/ipam/data'"),
             ('root', 'ERROR', 'Cannot establish connection to etcd: '),
             ('root', 'DEBUG', 'Cannot get status from etcd, no connection'),
             ('root', 'WARNING',
              'Romana watcher plugin: Lost etcd connection.'),
             ('root', 'DEBUG', 'Attempting to connect to etcd (APIv3)'),
-            ('root', 'DEBUG', 'Initial data read'))
+            ('root', 'ERROR', 'Cannot establish connection to etcd: '))
 
         plugin.stop()
         time.sleep(0.5)
@@ -123,10 +175,7 @@ class TestPluginMockEtcd(TestPluginBase):
 
         # Mocking the etcd client
 
-        class MockClient(object):
-
-            def add_watch_callback(self, key, func):
-                pass
+        class MockClient(MockEtcd3Client):
 
             def status(self):
                 return True
@@ -390,7 +439,7 @@ class TestPluginMockEtcd(TestPluginBase):
                 ('root', 'DEBUG', 'Initial data read'),
                 ('root', 'DEBUG',
                  "Sending route spec for routes: %s" %
-                 [unicode(i) for i in expected_route_spec.keys()]),
+                 [unicode(i) for i in sorted(expected_route_spec)]),
                 ('root', 'DEBUG',
                  "Attempting to establish watch on '/romana/ipam/data'"),
                 ('root', 'INFO',
@@ -400,6 +449,8 @@ class TestPluginMockEtcd(TestPluginBase):
                  'Sending stop signal to etcd watcher thread'),
                 ('root', 'WARNING',
                  'Romana watcher plugin: Lost etcd connection.'),
+                ('root', 'DEBUG',
+                 "Cancel watch for etcd APIv3 on '/romana/ipam/data'"),
                 ('root', 'INFO', 'Romana watcher plugin: Stopped'))
             self.lc.clear()
 
@@ -407,3 +458,839 @@ class TestPluginMockEtcd(TestPluginBase):
             is_route_spec = q.get()
             self.assertEqual(is_route_spec, expected_route_spec)
             time.sleep(0.5)
+
+
+MockKVMetadata = collections.namedtuple("MockKVMetadata",
+                                        ["mod_revision", "key"])
+MockKVMetadata.__new__.__defaults__ = (None,)
+
+
+class MockEtcd3Client(object):
+    """
+    Minimal stand-in for the etcd APIv3 client, which returns whatever data
+    was last set.
+
+    """
+    def __init__(self, data=None, revision=1, etcd_revision=None):
+        self.data            = data
+        self.revision        = revision        # of the topology key
+        self.etcd_revision   = etcd_revision or revision
+        self.timeout         = None
+        self.kvstub          = self            # we answer range requests
+        self.maintenancestub = self            # ... and status requests
+        self.watch_kwargs    = None
+        self.allow_read      = True
+        self.num_status      = 0
+
+    def get(self, key):
+        if self.data is None or not self.allow_read:
+            raise Exception("unexpected read")
+        return (self.data, MockKVMetadata(self.revision))
+
+    def Range(self, request, timeout):
+        response = etcd3.etcdrpc.RangeResponse()
+        response.header.revision = self.etcd_revision
+        if self.data is not None:
+            response.kvs.add(key=request.key, mod_revision=self.revision)
+            response.count = 1
+        return response
+
+    def Status(self, request, timeout):
+        self.num_status += 1
+        return etcd3.etcdrpc.StatusResponse()
+
+    def add_watch_callback(self, key, func, **kwargs):
+        self.watch_kwargs = kwargs
+        return 1
+
+    def cancel_watch(self, watch_id):
+        pass
+
+
+class MockEtcd2Client(object):
+    """
+    Minimal stand-in for the etcd APIv2 client, which returns a list of
+    prepared watch results (or raises them, if they are exceptions).
+
+    Once all results are used up, the stop event is set.
+
+    """
+    def __init__(self, results, stop_event):
+        self.results    = list(results)
+        self.stop_event = stop_event
+        self.indexes    = []
+
+    def watch(self, key, index=None, timeout=None, recursive=False):
+        self.indexes.append(index)
+        self.recursive = recursive
+        if not self.results:
+            self.stop_event.set()
+            raise Exception("Just timed out")
+        res = self.results.pop(0)
+        if isinstance(res, Exception):
+            raise res
+        return res
+
+
+class MockShardedEtcd3Client(MockEtcd3Client):
+    """
+    Stand-in for the etcd APIv3 client with topology shards under a prefix.
+
+    """
+    def __init__(self, shards, etcd_revision):
+        super(MockShardedEtcd3Client, self).__init__(None, 1, etcd_revision)
+        self.shards = shards    # key -> (value, revision)
+
+    def Range(self, request, timeout):
+        response = etcd3.etcdrpc.RangeResponse()
+        response.header.revision = self.etcd_revision
+        for key, (value, revision) in sorted(self.shards.items()):
+            response.kvs.add(key=key, mod_revision=revision,
+                             value=b"" if request.keys_only else value)
+        response.count = len(self.shards)
+        return response
+
+
+def make_put_event(value, revision=1, key=b"/romana/ipam/data"):
+    """
+    Create an etcd APIv3 put event, by default for the Romana topology key.
+
+    """
+    kv_pb2 = etcd3.etcdrpc.kv_pb2
+    kv     = kv_pb2.KeyValue(key=key, value=value, mod_revision=revision)
+    return etcd3.events.new_event(kv_pb2.Event(type=kv_pb2.Event.PUT, kv=kv))
+
+
+def make_delete_event(key, revision=1):
+    """
+    Create an etcd APIv3 delete event.
+
+    """
+    kv_pb2 = etcd3.etcdrpc.kv_pb2
+    kv     = kv_pb2.KeyValue(key=key, mod_revision=revision)
+    return etcd3.events.new_event(kv_pb2.Event(type=kv_pb2.Event.DELETE,
+                                               kv=kv))
+
+
+TEST_CONF = {
+    "etcd_port"  : 59999,
+    "etcd_addr"  : "localhost",
+    "ca_cert"    : None,
+    "priv_key"   : None,
+    "cert_chain" : None
+}
+
+
+SIMPLE_TOPOLOGY = """
+    {
+        "networks": {
+            "net1": {
+                "cidr": "10.0.0.0/8",
+                "host_groups": {
+                    "cidr": "10.0.0.0/8",
+                    "groups": null,
+                    "hosts": [
+                        { "ip": "192.168.99.10", "%s": "%s" },
+                        { "ip": "192.168.99.11" }
+                    ]
+                }
+            }
+        }
+    }
+"""
+
+
+SIMPLE_DATA = SIMPLE_TOPOLOGY % ("foo", "bar")
+
+
+def two_networks(cidr):
+    """
+    Return the simple topology (decoded) with a second network, which is a
+    copy of the first one with the given host group CIDR, and that network.
+
+    """
+    topology = json.loads(SIMPLE_DATA)
+    net2     = json.loads(json.dumps(topology['networks']['net1']))
+    net2['host_groups']['cidr']  = cidr
+    topology['networks']['net2'] = net2
+    return topology, net2
+
+
+class TestPluginTopologyBase(TestPluginBase):
+    """
+    Base class for tests, which run the plugin against the mock etcd APIv3
+    client.
+
+    """
+    def make_plugin(self, data=SIMPLE_DATA, revision=1, etcd_revision=None,
+                    **conf):
+        """
+        Create a plugin with the test config plus the given options, and a
+        mock client, which serves the topology data (None fails any read).
+
+        Returns the plugin and its route spec queue.
+
+        """
+        plugin      = Romana(dict(TEST_CONF, **conf))
+        plugin.etcd = MockEtcd3Client(data, revision, etcd_revision)
+        return plugin, plugin.get_route_spec_queue()
+
+    def get_stats(self, plugin):
+        """
+        Return the stats part of the plugin info.
+
+        """
+        return plugin.get_info()[plugin.get_plugin_name()]['stats']
+
+
+class TestPluginChangeDetection(TestPluginTopologyBase):
+    """
+    Testing that unchanged topology data does not cause route spec updates.
+
+    """
+    def test_unchanged_topology(self):
+        plugin, q = self.make_plugin()
+
+        plugin.load_topology_send_route_spec()
+        self.assertEqual(q.get_nowait(),
+                         {'10.0.0.0/8': ['192.168.99.10', '192.168.99.11']})
+
+        # Identical raw data: Not even parsed
+        plugin.load_topology_send_route_spec()
+        self.assertTrue(q.empty())
+
+        # Only non-routing fields changed: Parsed, but nothing sent
+        plugin.etcd.data = SIMPLE_TOPOLOGY % ("foo", "baz")
+        plugin.load_topology_send_route_spec()
+        self.assertTrue(q.empty())
+
+        stats = self.get_stats(plugin)
+        self.assertEqual(stats['updates_published'], 1)
+        self.assertEqual(stats['updates_skipped'],
+                         {"unchanged_raw" : 1, "unchanged_spec" : 1,
+                          "stale" : 0})
+
+
+class TestPluginRouteCache(TestPluginTopologyBase):
+    """
+    Testing that only changed networks are walked again.
+
+    """
+    def test_route_cache(self):
+        topology, net2 = two_networks("10.1.0.0/16")
+        plugin, q      = self.make_plugin(json.dumps(topology),
+                                          json_backend="json")
+        plugin.load_topology_send_route_spec()
+        q.get_nowait()
+
+        net2['host_groups']['hosts'][0]['ip'] = "192.168.99.12"
+        plugin.etcd.data = json.dumps(topology)
+        plugin.load_topology_send_route_spec()
+        self.assertEqual(q.get_nowait(),
+                         {'10.0.0.0/8'  : ['192.168.99.10', '192.168.99.11'],
+                          '10.1.0.0/16' : ['192.168.99.11', '192.168.99.12']})
+        stats = self.get_stats(plugin)
+        self.assertEqual(stats['route_cache']['networks_parsed'], 3)
+        self.assertEqual(stats['route_cache']['networks_reused'], 1)
+
+
+class TestPluginStreamingDecode(TestPluginTopologyBase):
+    """
+    Testing the streaming decode of large topology values.
+
+    """
+    def test_streaming_decode(self):
+        plugin, q = self.make_plugin(streaming_decode=True)
+
+        plugin.load_topology_send_route_spec()
+        self.assertEqual(q.get_nowait(),
+                         {'10.0.0.0/8': ['192.168.99.10', '192.168.99.11']})
+        # Only the routing fields were decoded
+        host_groups = plugin.etcd_latest_raw['networks']['net1']['host_groups']
+        self.assertEqual(host_groups['hosts'][0], {'ip' : '192.168.99.10'})
+
+
+class TestPluginValidation(TestPluginTopologyBase):
+    """
+    Testing the validation of the assembled route spec.
+
+    """
+    def test_invalid_host(self):
+        plugin, q = self.make_plugin(SIMPLE_DATA.replace("192.168.99.11",
+                                                         "foo"))
+
+        # The invalid host is dropped, the rest of the route spec is sent
+        plugin.load_topology_send_route_spec()
+        self.assertEqual(q.get_nowait(), {'10.0.0.0/8': ['192.168.99.10']})
+        stats = self.get_stats(plugin)
+        self.assertEqual(stats['route_spec_validation']['invalid_entries'], 1)
+        self.assertEqual(stats['route_spec_validation']['invalid'][0]['cidr'],
+                         '10.0.0.0/8')
+
+
+class TestPluginAggregation(TestPluginTopologyBase):
+    """
+    Testing the optional aggregation of route entries.
+
+    """
+    def test_aggregate_routes(self):
+        # A second network, nested in the first one, with the same hosts
+        topology, _ = two_networks("10.1.0.0/16")
+        plugin, q   = self.make_plugin(json.dumps(topology),
+                                       aggregate_routes=True)
+
+        plugin.load_topology_send_route_spec()
+        self.assertEqual(q.get_nowait(),
+                         {'10.0.0.0/8': ['192.168.99.10', '192.168.99.11']})
+        stats = self.get_stats(plugin)
+        self.assertEqual(stats['route_aggregation'],
+                         {"entries_before" : 2, "entries_after" : 1})
+
+
+class TestPluginNetworkSelection(TestPluginTopologyBase):
+    """
+    Testing the selection of networks from the topology.
+
+    """
+    def test_network_selection(self):
+        topology, net2 = two_networks("10.1.0.0/16")
+        net2['cidr']   = "10.1.0.0/16"
+        net2['host_groups']['hosts'] = [{"ip" : "192.168.99.12"}]
+        plugin, q      = self.make_plugin(json.dumps(topology),
+                                          include_cidrs="10.1.0.0/16")
+
+        # The other network is skipped before it's walked
+        plugin.load_topology_send_route_spec()
+        self.assertEqual(q.get_nowait(), {'10.1.0.0/16': ['192.168.99.12']})
+        stats = self.get_stats(plugin)
+        self.assertEqual(stats['network_selection'],
+                         {"networks_selected" : 1, "networks_skipped" : 1})
+        self.assertEqual(stats['route_cache']['networks_parsed'], 1)
+
+
+class TestPluginRetention(TestPluginTopologyBase):
+    """
+    Testing the retention modes for the raw topology data.
+
+    """
+    def _load(self, conf, *values):
+        plugin, _ = self.make_plugin(None, **conf)
+        for i, value in enumerate(values):
+            plugin.etcd.data     = value
+            plugin.etcd.revision = i + 1
+            plugin.load_topology_send_route_spec()
+        return plugin.get_info()[plugin.get_plugin_name()]['raw_topology']
+
+    def test_summary(self):
+        raw = self._load({"raw_topology_retention" : "summary"}, SIMPLE_DATA)
+        self.assertEqual(raw['retention'], "summary")
+        self.assertEqual(raw['data']['networks'], 1)
+        self.assertEqual(raw['data']['groups'], 1)
+        self.assertEqual(raw['data']['route_entries'], 1)
+        self.assertEqual(raw['data']['hosts'], 2)
+        self.assertEqual(raw['data']['revision'], 1)
+        self.assertEqual(raw['data']['size'], len(SIMPLE_DATA))
+
+    def test_diffs(self):
+        raw = self._load({"raw_topology_retention" : "diffs",
+                          "raw_topology_diffs"     : 2},
+                         SIMPLE_DATA,
+                         SIMPLE_DATA.replace("192.168.99.11",
+                                             "192.168.99.12"),
+                         SIMPLE_DATA.replace("10.0.0.0/8", "10.1.0.0/16"))
+        self.assertEqual(raw['retention'], "diffs")
+        # Only the last two diffs are kept
+        self.assertEqual([(d['revision'], d['added'], d['changed'],
+                           d['removed']) for d in raw['data']],
+                         [(2, {}, {"10.0.0.0/8" : ["192.168.99.10",
+                                                   "192.168.99.12"]}, []),
+                          (3, {"10.1.0.0/16" : ["192.168.99.10",
+                                                "192.168.99.11"]}, {},
+                           ["10.0.0.0/8"])])
+
+
+class TestPluginWatchEvents(TestPluginTopologyBase):
+    """
+    Testing the handling of etcd APIv3 watch events.
+
+    """
+    def test_value_from_event(self):
+        plugin, q = self.make_plugin(None)    # fails any read
+
+        plugin.event_callback_v3(make_put_event(SIMPLE_DATA, 5))
+        self.assertEqual(plugin.coalescer.num_events, 1)
+        plugin.load_topology_send_route_spec(plugin.coalescer.pending_data)
+        self.assertEqual(q.get_nowait(),
+                         {'10.0.0.0/8': ['192.168.99.10', '192.168.99.11']})
+        self.assertEqual(plugin.last_revision, 5)
+
+    def test_event_counts(self):
+        plugin, _ = self.make_plugin(revision=5)
+        plugin.coalescer.start()
+        try:
+            plugin.event_callback_v3(make_put_event(SIMPLE_DATA, 5))
+            plugin.coalescer.flush()
+        finally:
+            plugin.coalescer.stop()
+
+        # The flush isn't a watch event, but it is submitted to the coalescer
+        stats = self.get_stats(plugin)
+        self.assertEqual(stats['watch_events'], 1)
+        self.assertEqual(stats['coalescer_submissions'], 2)
+
+    def test_stale_event(self):
+        plugin, q = self.make_plugin(revision=10)
+
+        plugin.load_topology_send_route_spec()
+        q.get_nowait()
+        self.assertEqual(plugin.last_revision, 10)
+
+        # An event for an older revision, arriving late, is dropped
+        plugin.event_callback_v3(make_put_event(SIMPLE_TOPOLOGY %
+                                                ("1.1.1.1", "bar"), 9))
+        plugin.load_topology_send_route_spec(plugin.coalescer.pending_data)
+        self.assertTrue(q.empty())
+        self.assertEqual(plugin.num_updates_stale, 1)
+        self.assertEqual(plugin.last_revision, 10)
+
+    def test_failed_watch(self):
+        plugin = Romana(TEST_CONF)
+        plugin.event_callback_v3(Exception("connection lost"))
+        self.assertTrue(plugin.watch_broken)
+        self.assertEqual(plugin.coalescer.num_events, 0)
+
+
+class TestPluginMetrics(TestPluginTopologyBase):
+    """
+    Testing the counters and latency histograms of the topology updates.
+
+    """
+    def test_metrics(self):
+        plugin, q = self.make_plugin(None)    # fails any read
+
+        plugin.event_callback_v3(make_put_event(SIMPLE_DATA, 5))
+        plugin.process_update(plugin.coalescer.pending_data)
+        q.get_nowait()
+        plugin.event_callback_v3(make_delete_event(b"/romana/ipam/data", 6))
+        plugin.process_update()
+        plugin.event_callback_v3(Exception("connection lost"))
+
+        metrics = self.get_stats(plugin)['metrics']
+        self.assertEqual(metrics['counters'],
+                         {"watch_events" : 2, "loads" : 2,
+                          "load_errors" : 1, "watch_failures" : 1})
+        latencies = metrics['latencies']
+        self.assertEqual(latencies['load']['count'], 2)
+        self.assertEqual(latencies['etcd_read']['count'], 1)
+        for stage in ["parse", "build_route_spec", "validate", "queue_put",
+                      "event_to_publish"]:
+            self.assertEqual(latencies[stage]['count'], 1)
+        self.assertNotIn("aggregate", latencies)
+
+        lines = plugin.get_metrics_text().splitlines()
+        self.assertIn("vpcrouter_romana_watch_events_total 2", lines)
+        self.assertIn("vpcrouter_romana_updates_published_total 1", lines)
+        self.assertIn("vpcrouter_romana_route_spec_cidrs 1", lines)
+        self.assertIn("vpcrouter_romana_route_spec_hosts 2", lines)
+        self.assertIn('vpcrouter_romana_stage_duration_seconds_count'
+                      '{stage="load"} 2', lines)
+
+
+class TestPluginProfiling(TestPluginTopologyBase):
+    """
+    Testing the on-demand profiling of topology updates.
+
+    """
+    def test_profiling(self):
+        directory = tempfile.mkdtemp()
+        try:
+            plugin, q = self.make_plugin(profile_dir=directory,
+                                         profile_updates=1,
+                                         profile_at_start=True)
+
+            # Only the first update is profiled, with its payload
+            plugin.process_update()
+            q.get_nowait()
+            plugin.etcd.data = SIMPLE_TOPOLOGY % ("foo", "baz")
+            plugin.process_update()
+            stats = self.get_stats(plugin)['profiling']
+            self.assertEqual(stats['updates_profiled'], 1)
+            self.assertEqual(stats['updates_pending'], 0)
+            self.assertEqual(sorted(os.listdir(stats['last_dump'])),
+                             ["payload-%2Fromana%2Fipam%2Fdata",
+                              "profile.pstats", "profile.txt"])
+
+            # Profiling is armed again by the signal
+            plugin.install_profile_signal()
+            os.kill(os.getpid(), signal.SIGUSR2)
+            self.assertTrue(plugin.profiler.is_armed())
+        finally:
+            signal.signal(signal.SIGUSR2, signal.SIG_DFL)
+            shutil.rmtree(directory)
+
+
+class TestPluginLatestOnly(TestPluginTopologyBase):
+    """
+    Testing the replacement of unconsumed route specs.
+
+    """
+    def test_latest_route_spec_only(self):
+        plugin, q = self.make_plugin(latest_route_spec_only=True)
+
+        plugin.load_topology_send_route_spec()
+        plugin.etcd.data = SIMPLE_TOPOLOGY.replace("192.168.99.11",
+                                                   "192.168.99.12")
+        plugin.load_topology_send_route_spec()
+
+        self.assertEqual(q.qsize(), 1)
+        self.assertEqual(q.get_nowait(),
+                         {'10.0.0.0/8': ['192.168.99.10', '192.168.99.12']})
+        self.assertEqual(plugin.num_route_specs_superseded, 1)
+        self.assertEqual(plugin.num_updates_published, 2)
+
+
+class TestPluginReconnect(TestPluginTopologyBase):
+    """
+    Testing the initial read after (re)connecting to etcd.
+
+    """
+    def test_skip_unchanged_initial_read(self):
+        plugin, q = self.make_plugin(revision=5, etcd_revision=20)
+
+        # First connect: Data is read, watch starts after current revision
+        self.assertEqual(plugin.initial_data_read(), 21)
+        q.get_nowait()
+        self.assertEqual(plugin.last_revision, 5)
+
+        # Reconnect, topology key unchanged: No read at all
+        plugin.etcd.allow_read    = False
+        plugin.etcd.etcd_revision = 30
+        self.assertEqual(plugin.initial_data_read(), 31)
+        self.assertEqual(plugin.num_initial_reads_skipped, 1)
+
+        # Reconnect, topology key changed in the meantime: Data is read
+        plugin.etcd = MockEtcd3Client(SIMPLE_TOPOLOGY % ("1.1.1.1", "bar"),
+                                      35, 40)
+        self.assertEqual(plugin.initial_data_read(), 41)
+        self.assertEqual(plugin.last_revision, 35)
+        self.assertEqual(plugin.num_initial_reads_skipped, 1)
+
+    def test_reread_after_failed_update(self):
+        plugin, q = self.make_plugin(revision=5)
+        plugin.initial_data_read()
+        q.get_nowait()
+
+        def _send_fails(route_spec):
+            raise Exception("queue broken")
+
+        # The update from a watch event can't be sent: Revision unchanged
+        changed                = SIMPLE_DATA.replace("192.168.99.11",
+                                                     "192.168.99.12")
+        send                   = plugin.send_route_spec
+        plugin.send_route_spec = _send_fails
+        plugin.load_topology_send_route_spec(TopologyUpdate(changed, 8))
+        self.assertEqual(plugin.last_revision, 5)
+
+        # So the data is read again after a reconnect
+        plugin.send_route_spec = send
+        plugin.etcd            = MockEtcd3Client(changed, 8, 10)
+        self.assertEqual(plugin.initial_data_read(), 11)
+        self.assertEqual(plugin.num_initial_reads_skipped, 0)
+        self.assertEqual(plugin.last_revision, 8)
+        self.assertEqual(q.get_nowait(),
+                         {'10.0.0.0/8': ['192.168.99.10', '192.168.99.12']})
+
+    def test_failover(self):
+        plugin   = Romana(dict(TEST_CONF, etcd_addr="10.0.0.1,10.0.0.2:2380"))
+        attempts = []
+
+        def _establish():
+            # Every connection attempt fails
+            plugin.current_endpoint = plugin.endpoints.select()
+            plugin.endpoint_failed  = True
+            attempts.append(str(plugin.current_endpoint))
+            if len(attempts) == 2:
+                plugin.keep_running = False
+
+        plugin.establish_etcd_connection_and_watch = _establish
+        plugin.watch_etcd()
+
+        # The second member is tried right away, without backing off
+        self.assertEqual(attempts, ["10.0.0.1:59999", "10.0.0.2:2380"])
+        self.assertEqual(plugin.num_failovers, 1)
+        self.assertEqual(plugin.backoff.attempts, 0)
+
+    def test_watch_cancelled(self):
+        class UnavailableError(grpc.RpcError):
+            def code(self):
+                return grpc.StatusCode.UNAVAILABLE
+
+        plugin   = Romana(dict(TEST_CONF, etcd_addr="10.0.0.1,10.0.0.2:2380"))
+        attempts = []
+        errors   = [Exception("watch cancelled"), UnavailableError()]
+
+        def _establish():
+            plugin.current_endpoint = plugin.endpoints.select()
+            attempts.append(str(plugin.current_endpoint))
+            if errors:
+                plugin.event_callback_v3(errors.pop(0))
+            else:
+                plugin.keep_running = False
+
+        plugin.establish_etcd_connection_and_watch = _establish
+        plugin.backoff.min_delay = plugin.backoff.max_delay = 0
+        plugin.watch_etcd()
+
+        # A watch, which was cancelled, is re-established with the same
+        # member. Only after the connection failed do we fail over.
+        self.assertEqual(attempts, ["10.0.0.1:59999", "10.0.0.1:59999",
+                                    "10.0.0.2:2380"])
+        self.assertEqual(plugin.num_failovers, 1)
+        self.assertEqual([s['failures'] for s in plugin.endpoints.get_stats()],
+                         [1, 0])
+
+    def test_read_connection_error(self):
+        class UnreachableClient(MockEtcd3Client):
+            def get(self, key):
+                raise etcd3.exceptions.ConnectionFailedError()
+
+        plugin, _   = self.make_plugin()
+        plugin.etcd = UnreachableClient()
+        plugin.load_topology_send_route_spec()
+        self.assertTrue(plugin.watch_broken)
+
+
+def _shard(cidr, ip):
+    return json.dumps({"networks" : {cidr : {"host_groups" : {
+        "cidr" : cidr, "hosts" : [{"ip" : ip}]}}}})
+
+
+class TestPluginShards(TestPluginTopologyBase):
+    """
+    Testing topology data sharded over the keys under a prefix.
+
+    """
+    def make_sharded_plugin(self, shards, etcd_revision):
+        """
+        Create a plugin in prefix mode, with a mock client, which serves the
+        given shards.
+
+        Returns the plugin and its route spec queue.
+
+        """
+        plugin, q   = self.make_plugin(topology_prefix="/romana/topo/")
+        plugin.etcd = MockShardedEtcd3Client(shards, etcd_revision)
+        return plugin, q
+
+    def test_sharded_topology(self):
+        plugin, q = self.make_sharded_plugin(
+                        {"/romana/topo/a" : (_shard("10.1.0.0/16", "1.1.1.1"),
+                                             5),
+                         "/romana/topo/b" : (_shard("10.2.0.0/16", "2.2.2.2"),
+                                             6)},
+                        10)
+
+        # Initial read of all shards
+        self.assertEqual(plugin.initial_data_read(), 11)
+        self.assertEqual(q.get_nowait(), {"10.1.0.0/16" : ["1.1.1.1"],
+                                          "10.2.0.0/16" : ["2.2.2.2"]})
+        self.assertEqual(plugin.last_revision, 6)
+
+        # Reconnect without changes: No read
+        self.assertEqual(plugin.initial_data_read(), 11)
+        self.assertEqual(plugin.num_initial_reads_skipped, 1)
+
+        # Watch events for several shards within one burst: Only the changed
+        # shards are parsed, and all changes are applied.
+        plugin.event_callback_v3(
+                make_put_event(_shard("10.2.0.0/16", "2.2.2.9"), 12,
+                               b"/romana/topo/b"))
+        plugin.event_callback_v3(
+                make_put_event(_shard("10.3.0.0/16", "3.3.3.3"), 13,
+                               b"/romana/topo/c"))
+        plugin.event_callback_v3(make_delete_event(b"/romana/topo/a", 14))
+        plugin.coalescer.flush()
+        self.assertEqual(q.get_nowait(), {"10.2.0.0/16" : ["2.2.2.9"],
+                                          "10.3.0.0/16" : ["3.3.3.3"]})
+        stats = self.get_stats(plugin)
+        self.assertEqual(stats['topology_shards']['shards'], 2)
+        self.assertEqual(stats['topology_shards']['shards_parsed'], 4)
+
+        # Late event for an older revision of a shard: Ignored
+        plugin.event_callback_v3(
+                make_put_event(_shard("10.2.0.0/16", "2.2.2.2"), 6,
+                               b"/romana/topo/b"))
+        plugin.coalescer.flush()
+        self.assertTrue(q.empty())
+        self.assertEqual(plugin.shards.num_shards_stale, 1)
+
+    def test_reconnect(self):
+        plugin, q = self.make_sharded_plugin(
+                        {"/romana/topo/a" : (_shard("10.1.0.0/16", "1.1.1.1"),
+                                             10)},
+                        10)
+        plugin.initial_data_read()
+        q.get_nowait()
+
+        # A change seen before the reconnect, while shard b was deleted (and
+        # a changed) by the time the data is read again
+        plugin.event_callback_v3(
+                make_put_event(_shard("10.2.0.0/16", "2.2.2.2"), 12,
+                               b"/romana/topo/b"))
+        plugin.etcd.shards        = {
+            "/romana/topo/a" : (_shard("10.1.0.0/16", "1.1.1.9"), 14)}
+        plugin.etcd.etcd_revision = 15
+        self.assertEqual(plugin.initial_data_read(), 16)
+        self.assertEqual(q.get_nowait(), {"10.1.0.0/16" : ["1.1.1.9"]})
+        self.assertEqual(sorted(plugin.shards.shards), ["/romana/topo/a"])
+
+        # A late event from before the read doesn't bring shard b back
+        plugin.event_callback_v3(
+                make_put_event(_shard("10.2.0.0/16", "2.2.2.2"), 13,
+                               b"/romana/topo/b"))
+        plugin.coalescer.flush()
+        self.assertTrue(q.empty())
+
+        # Reconnect without changes: Changes seen before are dropped
+        plugin.event_callback_v3(
+                make_put_event(_shard("10.2.0.0/16", "2.2.2.2"), 12,
+                               b"/romana/topo/b"))
+        self.assertEqual(plugin.initial_data_read(), 16)
+        self.assertEqual(plugin.shards.take_pending(), (False, {}))
+
+    def test_watch_prefix_v2(self):
+        def _result(key, value, index, action="set"):
+            return etcd.EtcdResult(action=action,
+                                   node={"key"           : key,
+                                         "value"         : value,
+                                         "modifiedIndex" : index})
+
+        stop_event = threading.Event()
+        client     = MockEtcd2Client(
+                        [_result("/romana/topo/a", "foo", 11),
+                         _result("/romana/topo/b", None, 12, "delete"),
+                         etcd.EtcdEventIndexCleared("cleared",
+                                                    payload={"index" : 20})],
+                        stop_event)
+        plugin     = Romana(dict(TEST_CONF, topology_prefix="/romana/topo/"))
+        plugin.watch_loop_v2(client, 10, stop_event)
+
+        self.assertTrue(client.recursive)
+        self.assertEqual(plugin.shards.take_pending(),
+                         (True, {"/romana/topo/a" : ("foo", 11),
+                                 "/romana/topo/b" : (None, 12)}))
+
+
+class TestPluginWatchV2(TestPluginTopologyBase):
+    """
+    Testing the etcd APIv2 watch loop.
+
+    """
+    def test_watch_loop(self):
+        def _result(value, index, action="set"):
+            return etcd.EtcdResult(action=action,
+                                   node={"key"           : "/romana/ipam/data",
+                                         "value"         : value,
+                                         "modifiedIndex" : index})
+
+        stop_event = threading.Event()
+        client     = MockEtcd2Client(
+                        [_result("foo", 11),
+                         Exception("Just timed out"),
+                         etcd.EtcdEventIndexCleared("cleared",
+                                                    payload={"index" : 20}),
+                         _result(None, 25, "delete")],
+                        stop_event)
+        plugin     = Romana(TEST_CONF)
+        plugin.watch_loop_v2(client, 10, stop_event)
+
+        # The wait index is carried across requests, and continued at the
+        # current index after the history was cleared.
+        self.assertEqual(client.indexes, [10, 12, 12, 21, 26])
+        self.assertEqual(plugin.coalescer.num_events, 3)
+        self.assertFalse(plugin.watch_broken)
+
+    def test_watch_loop_failure(self):
+        stop_event = threading.Event()
+        client     = MockEtcd2Client([etcd.EtcdConnectionFailed("down")],
+                                     stop_event)
+        plugin     = Romana(TEST_CONF)
+        plugin.watch_loop_v2(client, 10, stop_event)
+        self.assertTrue(plugin.watch_broken)
+
+
+class MockEtcd2HealthClient(object):
+    """
+    Stand-in for the etcd APIv2 client, which answers requests for the
+    given paths with a status and body, the way python-etcd does.
+
+    """
+    def __init__(self, replies):
+        self.replies  = replies     # path -> (status, body)
+        self.requests = []
+
+    def api_execute(self, path, method):
+        self.requests.append(path)
+        status, body = self.replies[path]
+        if status == 200:
+            return collections.namedtuple("Response", ["data"])(body)
+        try:
+            payload = dict(json.loads(body), status=status)
+        except ValueError:
+            payload = {"message" : "Bad response", "cause" : body}
+        etcd.EtcdError.handle(payload)
+
+
+class TestPluginHealth(TestPluginTopologyBase):
+    """
+    Testing the health checks of the etcd connection.
+
+    """
+    def test_probe_skipped_on_activity(self):
+        plugin, _ = self.make_plugin(min_check_time=0.2)
+
+        self.assertTrue(plugin.etcd_check_status())
+        self.assertEqual(plugin.etcd.num_status, 1)
+
+        # Watch events prove that the connection is alive
+        plugin.event_callback_v3(make_put_event(SIMPLE_TOPOLOGY %
+                                                ("foo", "baz")))
+        self.assertTrue(plugin.etcd_check_status())
+        self.assertEqual(plugin.etcd.num_status, 1)
+
+        # No more recent activity: Probe again
+        time.sleep(0.3)
+        self.assertTrue(plugin.etcd_check_status())
+        self.assertEqual(plugin.etcd.num_status, 2)
+
+        stats = self.get_stats(plugin)
+        self.assertEqual(stats['etcd_health']['probes'], 2)
+        self.assertEqual(stats['etcd_health']['probes_skipped'], 1)
+        self.assertEqual(stats['etcd_health']['probe_failures'], 0)
+        self.assertTrue(stats['etcd_health']['last_probe_latency_ms'] >= 0)
+
+    def test_probe_v2(self):
+        plugin    = Romana(dict(TEST_CONF, usev2=True))
+        not_found = (404, "404 page not found\n")
+
+        plugin.etcd = MockEtcd2HealthClient(
+                            {"/health" : (200, '{"health": "true"}')})
+        self.assertTrue(plugin.etcd_check_status())
+
+        # Older etcd without health endpoint: Fall back to the version
+        plugin.etcd = MockEtcd2HealthClient(
+                            {"/health"  : not_found,
+                             "/version" : (200, '{"etcdserver": "2.3.8"}')})
+        self.assertTrue(plugin.etcd_check_status())
+        self.assertEqual(plugin.etcd.requests, ["/health", "/version"])
+
+        # An unhealthy member replies with 503, which fails the probe
+        plugin.etcd = MockEtcd2HealthClient(
+                            {"/health"  : (503, '{"health": "false"}'),
+                             "/version" : (200, '{"etcdserver": "3.2.0"}')})
+        self.assertFalse(plugin.etcd_check_status())
+        self.assertEqual(plugin.etcd.requests, ["/health"])
+
+        stats = self.get_stats(plugin)
+        self.assertEqual(stats['etcd_health']['probes'], 3)
+        self.assertEqual(stats['etcd_health']['probe_failures'], 1)
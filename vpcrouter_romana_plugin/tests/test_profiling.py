@@ -0,0 +1,77 @@
+"""
+Copyright 2017 Pani Networks Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+#
+# Unit tests for the profiling of topology updates
+#
+
+import os
+import pstats
+import shutil
+import tempfile
+import unittest
+
+from vpcrouter_romana_plugin.profiling import UpdateProfiler
+
+
+class TestProfiling(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_profiler(self):
+        profiler = UpdateProfiler(self.directory, 2)
+        calls    = []
+
+        def _update(arg):
+            profiler.record_payload("/romana/ipam/data", u'{"networks": {}}')
+            calls.append(arg)
+
+        self.assertFalse(profiler.is_armed())
+        profiler.arm()
+        while profiler.is_armed():
+            profiler.run(_update, len(calls))
+        self.assertEqual(calls, [0, 1])
+        self.assertEqual(profiler.num_profiled, 2)
+
+        path = profiler.last_dump
+        self.assertEqual(os.path.dirname(path), self.directory)
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+        # The profile can be loaded with pstats
+        stats = pstats.Stats(os.path.join(path, "profile.pstats"))
+        self.assertTrue(stats.total_calls > 0)
+        self.assertIn("_update",
+                      open(os.path.join(path, "profile.txt")).read())
+        with open(os.path.join(path, "payload-%2Fromana%2Fipam%2Fdata")) as f:
+            self.assertEqual(f.read(), '{"networks": {}}')
+
+        # Payloads are only recorded while profiling
+        profiler.record_payload("foo", "bar")
+        self.assertEqual(profiler.payloads, {})
+
+    def test_dump_error(self):
+        profiler = UpdateProfiler(os.path.join(self.directory, "file"), 1)
+        open(profiler.directory, "w").close()
+        calls    = []
+        profiler.arm()
+        # The update itself still happens
+        profiler.run(calls.append, 1)
+        self.assertEqual(calls, [1])
+        self.assertIsNone(profiler.last_dump)
@@ -0,0 +1,67 @@
+"""
+Copyright 2017 Pani Networks Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+#
+# Unit tests for the selection of topology networks
+#
+
+import unittest
+
+from vpcrouter_romana_plugin.selection import (NetworkSelector, network_cidr,
+                                               parse_list)
+
+
+def _net(cidr):
+    return {"cidr" : cidr, "host_groups" : {"cidr" : cidr}}
+
+
+class TestSelection(unittest.TestCase):
+
+    def test_parse_list(self):
+        self.assertEqual(parse_list(None), [])
+        self.assertEqual(parse_list("a, b,,c "), ["a", "b", "c"])
+
+    def test_network_cidr(self):
+        self.assertEqual(network_cidr(_net("10.1.0.0/16")), "10.1.0.0/16")
+        self.assertEqual(network_cidr({"host_groups" :
+                                       {"cidr" : "10.2.0.0/16"}}),
+                         "10.2.0.0/16")
+        self.assertIsNone(network_cidr({"cidr" : ["foo"]}))
+
+    def test_names(self):
+        sel = NetworkSelector(include_names=["prod-*", "shared"],
+                              exclude_names=["prod-old*"])
+        self.assertTrue(sel.selects("prod-a", _net("10.1.0.0/16")))
+        self.assertTrue(sel.selects("shared", _net("10.1.0.0/16")))
+        self.assertFalse(sel.selects("prod-old-1", _net("10.1.0.0/16")))
+        self.assertFalse(sel.selects("test-a", _net("10.1.0.0/16")))
+        self.assertEqual(sel.get_stats(),
+                         {"networks_selected" : 2, "networks_skipped" : 2})
+
+    def test_cidrs(self):
+        sel = NetworkSelector(include_cidrs=["10.0.0.0/8"],
+                              exclude_cidrs=["10.99.0.0/16"])
+        self.assertTrue(sel.selects("a", _net("10.1.0.0/16")))
+        self.assertFalse(sel.selects("b", _net("10.99.1.0/24")))
+        self.assertFalse(sel.selects("c", _net("192.168.0.0/16")))
+        # Larger than the include range, or without CIDR
+        self.assertFalse(sel.selects("d", _net("0.0.0.0/0")))
+        self.assertFalse(sel.selects("e", {}))
+        self.assertFalse(sel.selects("f", _net("fe80::/64")))
+        # Decisions are remembered
+        self.assertTrue(sel.selects("a", _net("10.1.0.0/16")))
+        self.assertEqual(len(sel.decisions), 6)
@@ -0,0 +1,262 @@
+"""
+Copyright 2017 Pani Networks Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+#
+# Unit tests for assembling route specs from the topology data
+#
+
+import copy
+import json
+import unittest
+
+from vpcrouter_romana_plugin.decoding import get_keyed_decoder
+from vpcrouter_romana_plugin.topology import (RouteSpecCache, ShardCache,
+                                              WalkStats,
+                                              build_network_routes,
+                                              build_route_spec)
+
+
+def _network(cidr, *host_ips):
+    return {
+        "host_groups" : {
+            "groups" : [
+                {
+                    "cidr"  : cidr,
+                    "hosts" : [{"ip" : ip, "name" : "h-%s" % ip}
+                               for ip in host_ips]
+                }
+            ]
+        }
+    }
+
+
+TOPOLOGY = {
+    "networks" : {
+        "net-a" : _network("10.1.0.0/16", "192.168.1.1", "192.168.1.2"),
+        "net-b" : _network("10.2.0.0/16", "192.168.2.1"),
+        "net-c" : {}
+    }
+}
+
+
+def _deep_network(depth):
+    # A chain of nested groups, with an entry at every level
+    group = {}
+    root  = group
+    for i in range(depth):
+        group["cidr"]   = "10.%d.%d.0/24" % (i / 256, i % 256)
+        group["hosts"]  = [{"ip" : "192.168.0.1"}]
+        group["groups"] = [{}]
+        group           = group["groups"][0]
+    return {"host_groups" : root}
+
+
+class TestWalker(unittest.TestCase):
+
+    def test_entry_order(self):
+        # Child entries are added before their parent's, so the parent wins
+        # for a duplicate CIDR. Later siblings win over earlier ones.
+        net = {
+            "host_groups" : {
+                "cidr"   : "10.0.0.0/8",
+                "hosts"  : [{"ip" : "1.1.1.1"}],
+                "groups" : [
+                    {"cidr" : "10.0.0.0/8", "hosts" : [{"ip" : "2.2.2.2"}]},
+                    {"cidr" : "10.1.0.0/16", "hosts" : [{"ip" : "3.3.3.3"}]},
+                    {"cidr" : "10.1.0.0/16", "hosts" : [{"ip" : "4.4.4.4"}]}
+                ]
+            }
+        }
+        self.assertEqual(build_network_routes(net),
+                         {"10.0.0.0/8"  : ["1.1.1.1"],
+                          "10.1.0.0/16" : ["4.4.4.4"]})
+
+    def test_deep_tree(self):
+        # Much deeper than the recursion limit
+        stats  = WalkStats()
+        routes = build_network_routes(_deep_network(5000), max_depth=10000,
+                                      stats=stats)
+        self.assertEqual(len(routes), 5000)
+        self.assertEqual(stats.groups_visited, 5001)
+        self.assertEqual(stats.hosts_visited, 5000)
+
+    def test_limits(self):
+        stats  = WalkStats()
+        routes = build_network_routes(_deep_network(100), max_depth=9,
+                                      stats=stats)
+        self.assertEqual(len(routes), 10)
+        routes = build_network_routes(_deep_network(100), max_groups=5,
+                                      stats=stats)
+        self.assertEqual(len(routes), 5)
+        self.assertEqual(stats.limits_exceeded, 2)
+
+    def test_malformed_groups(self):
+        net = {
+            "host_groups" : {
+                "groups" : [
+                    "foo",
+                    {"cidr" : "10.1.0.0/16", "hosts" : [{"name" : "x"}]},
+                    {"cidr" : "10.2.0.0/16", "hosts" : ["1.1.1.1"]},
+                    {"cidr" : "10.3.0.0/16", "hosts" : [{"ip" : "3.3.3.3"}]},
+                    {"cidr" : "10.4.0.0/16", "hosts" : [{"ip" : 17}]},
+                    {"cidr" : ["x"], "hosts" : [{"ip" : "5.5.5.5"}]},
+                    {"cidr" : {"x" : 1}, "hosts" : [{"ip" : "6.6.6.6"}]}
+                ]
+            }
+        }
+        stats  = WalkStats()
+        routes = build_network_routes(net, stats=stats)
+        self.assertEqual(routes, {"10.3.0.0/16" : ["3.3.3.3"]})
+        self.assertEqual(stats.groups_skipped, 6)
+
+
+class TestRouteSpecCache(unittest.TestCase):
+
+    def test_build_route_spec(self):
+        self.assertEqual(build_route_spec(TOPOLOGY),
+                         {"10.1.0.0/16" : ["192.168.1.1", "192.168.1.2"],
+                          "10.2.0.0/16" : ["192.168.2.1"]})
+
+    def test_incremental(self):
+        decode = get_keyed_decoder("json")
+        cache  = RouteSpecCache()
+        self.assertEqual(cache.build_route_spec(decode(json.dumps(TOPOLOGY))),
+                         build_route_spec(TOPOLOGY))
+        self.assertEqual(cache.num_networks_parsed, 3)
+        self.assertEqual(cache.num_groups, 4)
+
+        # Modifying the returned route spec doesn't affect the cache
+        cache.build_route_spec(decode(json.dumps(TOPOLOGY)))[
+                                        "10.1.0.0/16"].append("1.1.1.1")
+        self.assertEqual(cache.num_networks_reused, 3)
+
+        # Only the changed network is walked again
+        topology = copy.deepcopy(TOPOLOGY)
+        topology["networks"]["net-b"] = _network("10.2.0.0/16", "192.168.2.9")
+        self.assertEqual(cache.build_route_spec(decode(json.dumps(topology))),
+                         {"10.1.0.0/16" : ["192.168.1.1", "192.168.1.2"],
+                          "10.2.0.0/16" : ["192.168.2.9"]})
+        self.assertEqual(cache.num_networks_parsed, 4)
+        self.assertEqual(cache.num_networks_reused, 5)
+        self.assertEqual(cache.num_groups, 4)
+
+        # Removed networks are dropped from the cache
+        del topology["networks"]["net-a"]
+        self.assertEqual(cache.build_route_spec(decode(json.dumps(topology))),
+                         {"10.2.0.0/16" : ["192.168.2.9"]})
+        self.assertEqual(cache.get_stats()["networks_cached"], 2)
+
+        # Without keys from the decoder, every network is walked
+        self.assertEqual(cache.build_route_spec(topology),
+                         {"10.2.0.0/16" : ["192.168.2.9"]})
+        self.assertEqual(cache.num_networks_parsed, 6)
+        self.assertEqual(cache.get_stats()["networks_cached"], 0)
+
+    def test_malformed_networks(self):
+        topology = {
+            "networks" : {
+                "net-a" : None,
+                "net-b" : _network("10.2.0.0/16", "192.168.2.1"),
+                "net-c" : ["foo"]
+            }
+        }
+        expected = {"10.2.0.0/16" : ["192.168.2.1"]}
+        cache    = RouteSpecCache()
+        self.assertEqual(cache.build_route_spec(topology), expected)
+        self.assertEqual(cache.get_stats()["networks_ignored"], 2)
+        self.assertEqual(build_route_spec(topology), expected)
+
+    def test_duplicate_cidrs(self):
+        topology = {
+            "networks" : {
+                "net-a" : _network("10.1.0.0/16", "192.168.1.2"),
+                "net-b" : _network("10.1.0.0/16", "192.168.1.1",
+                                   "192.168.1.2"),
+                "net-c" : _network("10.1.0.0/16", "192.168.1.10")
+            }
+        }
+        # Merged the same way, whatever the order of the networks
+        expected = {"10.1.0.0/16" : ["192.168.1.1", "192.168.1.10",
+                                     "192.168.1.2"]}
+        cache    = RouteSpecCache()
+        self.assertEqual(cache.build_route_spec(topology), expected)
+        self.assertEqual(cache.get_stats()["duplicate_cidrs"], 2)
+        self.assertEqual(sorted(build_route_spec(topology)["10.1.0.0/16"]),
+                         sorted(expected["10.1.0.0/16"]))
+
+
+class TestShardCache(unittest.TestCase):
+
+    def _parse(self, data):
+        if data == "bad":
+            raise ValueError("bad shard")
+        topology = {"networks" : {"net" : _network(*data.split())}}
+        stats    = WalkStats()
+        return (topology, build_route_spec(topology, stats=stats),
+                stats.groups_visited)
+
+    def test_apply(self):
+        cache = ShardCache(self._parse)
+        self.assertTrue(cache.apply({"/a" : ("10.1.0.0/16 1.1.1.1", 1),
+                                     "/b" : ("10.1.0.0/16 2.2.2.2", 2)},
+                                    complete=True))
+        # The hosts of the same CIDR are merged
+        self.assertEqual(cache.build_route_spec(),
+                         {"10.1.0.0/16" : ["1.1.1.1", "2.2.2.2"]})
+        self.assertEqual(cache.num_duplicate_cidrs, 1)
+        self.assertEqual(cache.num_groups(), 4)
+
+        # Unchanged data and stale revisions don't count as change
+        self.assertFalse(cache.apply({"/a" : ("10.1.0.0/16 1.1.1.1", 3),
+                                      "/b" : ("10.1.0.0/16 9.9.9.9", 1)}))
+        self.assertEqual(cache.key_revisions(), {"/a" : 3, "/b" : 2})
+
+        # A bad shard is ignored, the last good version is kept
+        self.assertFalse(cache.apply({"/b" : ("bad", 4)}))
+        self.assertEqual(cache.num_shard_errors, 1)
+
+        # Complete set of shards: Missing ones are removed
+        self.assertTrue(cache.apply({"/a" : ("10.1.0.0/16 1.1.1.1", 3)},
+                                    complete=True))
+        self.assertEqual(cache.build_route_spec(),
+                         {"10.1.0.0/16" : ["1.1.1.1"]})
+        self.assertTrue(cache.apply({"/a" : (None, 5)}))
+        self.assertEqual(cache.build_route_spec(), {})
+        self.assertEqual(cache.get_stats(),
+                         {"shards" : 0, "shards_parsed" : 2,
+                          "shards_unchanged" : 2, "shards_stale" : 1,
+                          "shard_errors" : 1, "duplicate_cidrs" : 0})
+
+    def test_deleted_shards(self):
+        cache = ShardCache(self._parse)
+        cache.apply({"/a" : ("10.1.0.0/16 1.1.1.1", 5),
+                     "/b" : ("10.2.0.0/16 2.2.2.2", 6)}, complete=True,
+                    revision=10)
+
+        # A put older than the deletion doesn't bring the shard back
+        self.assertTrue(cache.apply({"/a" : (None, 12)}))
+        self.assertFalse(cache.apply({"/a" : ("10.1.0.0/16 1.1.1.9", 11)}))
+
+        # Neither does one older than a complete set without the shard
+        cache.apply({"/a" : ("10.1.0.0/16 1.1.1.1", 5)}, complete=True,
+                    revision=20)
+        self.assertFalse(cache.apply({"/b" : ("10.2.0.0/16 2.2.2.9", 18)}))
+        self.assertEqual(cache.num_shards_stale, 2)
+        self.assertTrue(cache.apply({"/b" : ("10.2.0.0/16 2.2.2.9", 21)}))
+        self.assertEqual(cache.build_route_spec(),
+                         {"10.1.0.0/16" : ["1.1.1.1"],
+                          "10.2.0.0/16" : ["2.2.2.9"]})
@@ -0,0 +1,83 @@
+"""
+Copyright 2017 Pani Networks Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+#
+# Unit tests for the validation of route specs
+#
+
+import unittest
+
+from vpcrouter_romana_plugin.validation import (RouteSpecValidator,
+                                                validate_entry)
+
+
+class TestValidation(unittest.TestCase):
+
+    def test_validate_entry(self):
+        self.assertEqual(validate_entry("10.0.0.0/8",
+                                        ["10.1.1.2", "10.1.1.1", "10.1.1.2"]),
+                         (["10.1.1.1", "10.1.1.2"], []))
+        hosts, errors = validate_entry("10.0.0.0/8", ["10.1.1.1", "foo"])
+        self.assertEqual(hosts, ["10.1.1.1"])
+        self.assertEqual(len(errors), 1)
+        # A CIDR needs a netmask
+        hosts, errors = validate_entry("10.0.0.0", ["10.1.1.1"])
+        self.assertIsNone(hosts)
+        self.assertEqual(len(errors), 1)
+
+    def test_validator(self):
+        v    = RouteSpecValidator()
+        spec = {"10.0.0.0/8"  : ["10.1.1.2", "10.1.1.1"],
+                "10.2.0.0/16" : ["10.1.1.3", "999.1.1.1"],
+                "10.3.0.0/33" : ["10.1.1.4"],
+                "10.4.0.0/16" : ["bar"]}
+        self.assertEqual(v.validate(spec),
+                         {"10.0.0.0/8"  : ["10.1.1.1", "10.1.1.2"],
+                          "10.2.0.0/16" : ["10.1.1.3"]})
+        stats = v.get_stats()
+        self.assertEqual(stats['entries_validated'], 4)
+        self.assertEqual(stats['entries_cached'], 0)
+        self.assertEqual(stats['invalid_entries'], 3)
+        self.assertEqual(sorted(e['cidr'] for e in stats['invalid']),
+                         ["10.2.0.0/16", "10.3.0.0/33", "10.4.0.0/16"])
+
+        # Only the changed entry is validated again
+        spec["10.0.0.0/8"] = ["10.1.1.5"]
+        del spec["10.4.0.0/16"]
+        self.assertEqual(v.validate(spec),
+                         {"10.0.0.0/8"  : ["10.1.1.5"],
+                          "10.2.0.0/16" : ["10.1.1.3"]})
+        stats = v.get_stats()
+        self.assertEqual(stats['entries_validated'], 5)
+        self.assertEqual(stats['entries_cached'], 2)
+        self.assertEqual(stats['invalid_entries'], 2)
+        # Entries of previous route specs are not kept
+        self.assertEqual(len(v.entries), 3)
+
+    def test_canonical(self):
+        v     = RouteSpecValidator()
+        spec1 = v.validate({"10.2.0.0/16" : ["10.1.1.2", "10.1.1.1"],
+                            "10.1.0.0/16" : ["10.1.1.3", "10.1.1.3"]})
+        spec2 = v.validate({"10.1.0.0/16" : ["10.1.1.3"],
+                            "10.2.0.0/16" : ["10.1.1.1", "10.1.1.2"]})
+        self.assertEqual(spec1.items(), spec2.items())
+        self.assertEqual(spec1.keys(), ["10.1.0.0/16", "10.2.0.0/16"])
+
+    def test_nothing_valid(self):
+        v = RouteSpecValidator()
+        self.assertEqual(v.validate({}), {})
+        self.assertRaises(ValueError, v.validate, {"10.0.0.0/8" : ["foo"]})
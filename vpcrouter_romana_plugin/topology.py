@@ -0,0 +1,547 @@
+"""
+Copyright 2017 Pani Networks Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+#
+# Assembling a route spec from the Romana topology data.
+#
+
+import collections
+import hashlib
+import logging
+import threading
+
+from .compact import intern_ip, pack_routes, unpack_hosts
+
+
+DEFAULT_MAX_GROUP_DEPTH = 64
+DEFAULT_MAX_GROUPS      = 100000
+
+
+def fingerprint(data):
+    """
+    Return a short fingerprint of a raw string, used for change detection.
+
+    """
+    if type(data) is unicode:
+        data = data.encode("utf-8")
+    return hashlib.sha1(data).hexdigest()
+
+
+class WalkStats(object):
+    """
+    Counters for the walks over the topology's group trees.
+
+    """
+    def __init__(self):
+        self.groups_visited   = 0
+        self.hosts_visited    = 0
+        self.groups_skipped   = 0  # malformed groups, which were ignored
+        self.networks_ignored = 0  # malformed networks, which were ignored
+        self.limits_exceeded  = 0  # trees cut off by the depth or size limit
+
+    def get_stats(self):
+        """
+        Return the counters as a dictionary.
+
+        """
+        return {
+            "groups_visited"   : self.groups_visited,
+            "hosts_visited"    : self.hosts_visited,
+            "groups_skipped"   : self.groups_skipped,
+            "networks_ignored" : self.networks_ignored,
+            "limits_exceeded"  : self.limits_exceeded
+        }
+
+
+def _host_ips(cidr, hosts, stats):
+    """
+    Return the list of host IPs of a group, or None if a host entry is
+    malformed.
+
+    """
+    try:
+        host_ips = [h['ip'] for h in hosts]
+        for ip in host_ips:
+            if not isinstance(ip, basestring):
+                raise TypeError("host IP '%s' is not a string" % str(ip))
+        return host_ips
+    except (KeyError, TypeError) as e:
+        stats.groups_skipped += 1
+        logging.warning("Romana watcher plugin: Skipping group '%s' with "
+                        "malformed host entry: %s" % (cidr, str(e)))
+        return None
+
+
+def _add_group_entry(group, routes, stats):
+    """
+    Use the hosts and CIDR of a group to add an entry to the routes, unless
+    the group has none, or there already is an entry for the CIDR.
+
+    Return the number of hosts in the added entry.
+
+    """
+    cidr  = group.get("cidr")
+    hosts = group.get("hosts")
+    if not cidr or not hosts or type(hosts) is not list:
+        return 0
+    if not isinstance(cidr, basestring):
+        stats.groups_skipped += 1
+        logging.warning("Romana watcher plugin: Skipping malformed "
+                        "group: %s" % str(group)[:80])
+        return 0
+    if cidr in routes:
+        return 0
+    host_ips = _host_ips(cidr, hosts, stats)
+    if host_ips is None:
+        return 0
+    routes[cidr] = host_ips
+    return len(host_ips)
+
+
+def build_network_routes(net_data, max_depth=DEFAULT_MAX_GROUP_DEPTH,
+                         max_groups=DEFAULT_MAX_GROUPS, stats=None):
+    """
+    Collect the route entries (CIDR to list of host IPs) of one network.
+
+    The topology information may contain recursive definitions of groups.
+    Those need to be traversed and the host information for each group
+    collected.
+
+    * A group may either have another group (child group) or a list of
+      hosts.
+    * A group always has a CIDR.
+
+    The tree is walked with an explicit stack, so that deep trees can't
+    exhaust the recursion limit. Groups further down than 'max_depth' levels
+    and any groups beyond the first 'max_groups' are ignored. A malformed
+    group is skipped, while the rest of the tree is still used. A malformed
+    network has no route entries, but doesn't affect the other networks.
+
+    If a CIDR appears more than once, a parent's entry takes precedence over
+    those of its children and a later sibling's over an earlier one's. The
+    walk visits groups in exactly the reverse of that order, so the first
+    entry found for a CIDR is the one we keep.
+
+    """
+    if stats is None:
+        stats = WalkStats()
+    routes = {}
+    if type(net_data) is not dict:
+        stats.networks_ignored += 1
+        logging.warning("Romana watcher plugin: Skipping malformed "
+                        "network: %s" % str(net_data)[:80])
+        return routes
+
+    # Top level element is always 'groups' (not a list), while further down
+    # 'groups' will be a list of groups.
+    root = net_data.get('host_groups')
+    if not root or type(root) is not dict:
+        return routes
+
+    num_groups = 0
+    num_hosts  = 0
+    # A stack of iterators over the child groups of each level. Its length is
+    # the depth of the groups of the topmost iterator.
+    stack      = [iter((root,))]
+    while stack:
+        for elem in stack[-1]:
+            if type(elem) is not dict:
+                stats.groups_skipped += 1
+                logging.warning("Romana watcher plugin: Skipping malformed "
+                                "group: %s" % str(elem)[:80])
+                continue
+            if num_groups == max_groups:
+                stats.limits_exceeded += 1
+                logging.warning("Romana watcher plugin: More than %d groups "
+                                "in network, ignoring the rest" % max_groups)
+                stack = []
+                break
+            num_groups += 1
+
+            num_hosts += _add_group_entry(elem, routes, stats)
+
+            groups = elem.get("groups")
+            if groups and type(groups) is list:
+                if len(stack) <= max_depth:
+                    # Descend, visiting the children last to first
+                    stack.append(reversed(groups))
+                    break
+                stats.limits_exceeded += 1
+                logging.warning("Romana watcher plugin: Groups nested deeper "
+                                "than %d levels, ignoring them" % max_depth)
+        else:
+            # All groups of this level done
+            stack.pop()
+
+    stats.groups_visited += num_groups
+    stats.hosts_visited  += num_hosts
+    return routes
+
+
+def merge_routes(route_spec, routes):
+    """
+    Add route entries (plain or packed) to a route spec, in place.
+
+    If a CIDR is already in the route spec, it gets the sorted union of both
+    host lists, so that the result doesn't depend on the order in which
+    route entries are merged.
+
+    Return the number of such duplicate CIDRs.
+
+    """
+    num_duplicates = 0
+    for cidr, hosts in routes.items():
+        if cidr in route_spec:
+            route_spec[cidr] = sorted(set(route_spec[cidr]).union(hosts))
+            num_duplicates  += 1
+        else:
+            route_spec[cidr] = hosts
+    return num_duplicates
+
+
+def build_route_spec(topology, max_depth=DEFAULT_MAX_GROUP_DEPTH,
+                     max_groups=DEFAULT_MAX_GROUPS, stats=None, selector=None):
+    """
+    Assemble a route spec from the decoded Romana topology data.
+
+    If a network selector is given, only the networks it selects are used.
+
+    """
+    route_spec = {}
+    # We have separate topology data for different networks
+    for net_name, net_data in topology['networks'].items():
+        if selector and not selector.selects(net_name, net_data):
+            continue
+        merge_routes(route_spec, build_network_routes(net_data, max_depth,
+                                                      max_groups, stats))
+    return route_spec
+
+
+class RouteSpecCache(object):
+    """
+    Assembles route specs, re-using the route entries of networks, which
+    didn't change since the last time.
+
+    The route entries of every network are cached, keyed by the network name
+    and the key of the network's raw text, which the decoder provides along
+    with the data (see decoding.Networks). Only networks whose raw text
+    changed (or which are new) are walked again. Entries of networks that
+    disappeared are dropped. If several networks have an entry for the same
+    CIDR, their host lists are merged.
+
+    If the decoder provides no keys (it can't tell where a network's text
+    starts and ends), every network is walked each time: Anything, which
+    could tell from the decoded data whether a network changed, costs more
+    than the walk itself.
+
+    Networks, which the optional network selector doesn't select, are
+    skipped before they are looked up.
+
+    The cached host lists are tuples of interned IP byte strings (see
+    compact.intern_ip), which take less than half the memory of the decoded
+    strings. Unlike the shard cache, we don't keep them in packed form:
+    Unpacking the entries of all networks for every route spec would cost
+    more than the walks we save.
+
+    """
+    def __init__(self, max_depth=DEFAULT_MAX_GROUP_DEPTH,
+                 max_groups=DEFAULT_MAX_GROUPS, selector=None):
+        self.max_depth           = max_depth
+        self.max_groups          = max_groups
+        self.selector            = selector
+        self.walk_stats          = WalkStats()
+        self.networks            = {}   # name -> (key, routes, num groups)
+        self.num_networks_parsed = 0
+        self.num_networks_reused = 0
+        self.num_groups          = 0    # in the last route spec
+        self.num_duplicate_cidrs = 0    # in the last route spec
+
+    def _network_routes(self, net_name, net_data, raw_key):
+        """
+        Return a tuple with the route entries of a network and the number of
+        groups they came from, from the cache if possible.
+
+        """
+        cached = self.networks.get(net_name)
+        if raw_key is not None and cached and cached[0] == raw_key:
+            self.num_networks_reused += 1
+            return cached[1:]
+        groups_before = self.walk_stats.groups_visited
+        routes        = build_network_routes(net_data, self.max_depth,
+                                             self.max_groups, self.walk_stats)
+        for cidr, hosts in routes.items():
+            routes[cidr] = tuple(intern_ip(ip) for ip in hosts)
+        self.num_networks_parsed += 1
+        return routes, self.walk_stats.groups_visited - groups_before
+
+    def build_route_spec(self, topology):
+        """
+        Assemble a route spec from the decoded Romana topology data.
+
+        The returned route spec has its own host lists, so it can be modified
+        without affecting the cache.
+
+        """
+        raw_keys       = getattr(topology['networks'], 'raw_keys', None) or {}
+        networks       = {}
+        merged         = {}
+        num_groups     = 0
+        num_duplicates = 0
+        for net_name, net_data in topology['networks'].items():
+            if self.selector and not self.selector.selects(net_name,
+                                                           net_data):
+                continue
+            raw_key            = raw_keys.get(net_name)
+            routes, net_groups = self._network_routes(net_name, net_data,
+                                                      raw_key)
+            if raw_key is not None:
+                networks[net_name] = (raw_key, routes, net_groups)
+            num_groups     += net_groups
+            num_duplicates += merge_routes(merged, routes)
+        self.networks            = networks
+        self.num_groups          = num_groups
+        self.num_duplicate_cidrs = num_duplicates
+        return dict((cidr, list(hosts)) for cidr, hosts in merged.items())
+
+    def get_stats(self):
+        """
+        Return the cache stats as a dictionary.
+
+        """
+        stats = self.walk_stats.get_stats()
+        stats.update({
+            "networks_cached" : len(self.networks),
+            "networks_parsed" : self.num_networks_parsed,
+            "networks_reused" : self.num_networks_reused,
+            "duplicate_cidrs" : self.num_duplicate_cidrs
+        })
+        return stats
+
+
+# A cached topology shard: The revision and fingerprint of its raw data, the
+# decoded data, its route entries and the number of groups they came from.
+Shard = collections.namedtuple("Shard",
+                               ["revision", "fingerprint", "data", "routes",
+                                "groups"])
+
+
+class ShardCache(object):
+    """
+    The topology data, sharded over the keys under an etcd prefix.
+
+    Every key holds a topology document of its own, with one or more
+    networks (typically just one). The route entries of every shard are
+    cached, so that a change only requires the changed shard to be decoded
+    and walked. The route spec is merged from all shards: If several shards
+    have an entry for the same CIDR, their host lists are merged.
+
+    The cached route entries are kept in packed form (see compact.py) and
+    only converted to plain lists of IP strings for the assembled route spec.
+    That costs much less than decoding and walking the shards again.
+
+    Changes are recorded by the watch (in any thread) and applied later by
+    the worker, so that none of the changes within a burst are lost.
+
+    A change older than what we already have is ignored. For a key that
+    isn't there, this is decided by the revision of its deletion or, if we
+    don't know that, of the last complete set of shards. So a late put can't
+    bring back a deleted shard.
+
+    """
+    def __init__(self, parse):
+        # raw data -> (data, routes, number of groups)
+        self.parse                = parse
+        self.lock                 = threading.Lock()
+        self.pending              = {}      # key -> (data, revision)
+        self.full_reload          = False
+        self.shards               = {}      # key -> Shard
+        self.deleted              = {}      # key -> revision of deletion
+        self.snapshot_revision    = None    # of the last complete set
+        self.num_shards_parsed    = 0
+        self.num_shards_unchanged = 0
+        self.num_shards_stale     = 0
+        self.num_shard_errors     = 0
+        self.num_duplicate_cidrs  = 0       # in the last route spec
+
+    def record_change(self, key, data, revision):
+        """
+        Record a changed shard. The data is None if the key was deleted.
+
+        """
+        with self.lock:
+            self.pending[key] = (data, revision)
+
+    def request_full_reload(self):
+        """
+        Request that all shards are read again.
+
+        """
+        with self.lock:
+            self.full_reload = True
+
+    def take_pending(self):
+        """
+        Return a tuple with the full reload flag and the recorded changes,
+        and reset both.
+
+        """
+        with self.lock:
+            full_reload, changes = self.full_reload, self.pending
+            self.full_reload = False
+            self.pending     = {}
+        return full_reload, changes
+
+    def clear_pending(self):
+        """
+        Forget the recorded changes, once the cached shards are known to be
+        up to date.
+
+        """
+        with self.lock:
+            self.pending = {}
+
+    def _is_stale(self, key, revision):
+        """
+        Return True if a change is older than what we have for the key.
+
+        """
+        shard = self.shards.get(key)
+        if shard:
+            return None not in (shard.revision, revision) and \
+                revision < shard.revision
+        deleted = self.deleted.get(key, self.snapshot_revision)
+        return None not in (deleted, revision) and revision <= deleted
+
+    def _apply_one(self, key, data, revision):
+        """
+        Apply a single change. Return True if the shard's routes may have
+        changed.
+
+        """
+        if self._is_stale(key, revision):
+            self.num_shards_stale += 1
+            return False
+        shard = self.shards.get(key)
+        if data is None:
+            if revision is not None:
+                self.deleted[key] = revision
+            return self.shards.pop(key, None) is not None
+        self.deleted.pop(key, None)
+
+        shard_fingerprint = fingerprint(data)
+        if shard and shard.fingerprint == shard_fingerprint:
+            self.shards[key] = shard._replace(revision=revision)
+            self.num_shards_unchanged += 1
+            return False
+        try:
+            decoded, routes, num_groups = self.parse(data)
+            routes                      = pack_routes(routes)
+        except Exception as e:
+            # Keep the last good version of the shard
+            self.num_shard_errors += 1
+            logging.error("Cannot load Romana topology shard '%s': %s" %
+                          (key, str(e)))
+            return False
+        self.num_shards_parsed += 1
+        self.shards[key] = Shard(revision, shard_fingerprint, decoded, routes,
+                                 num_groups)
+        return True
+
+    def apply(self, changes, complete=False, revision=None):
+        """
+        Apply changes (key to (data, revision)) to the cached shards.
+
+        If 'complete' is set, the changes are the full set of shards (as of
+        the given etcd revision, if known) and any other cached shards are
+        removed.
+
+        Return True if the route spec may have changed.
+
+        """
+        changed = False
+        if complete:
+            # The complete set covers all deletions before it
+            self.deleted           = {}
+            self.snapshot_revision = None
+            for key in set(self.shards) - set(changes):
+                del self.shards[key]
+                changed = True
+        for key, (data, key_revision) in sorted(changes.items()):
+            changed = self._apply_one(key, data, key_revision) or changed
+        if complete:
+            self.snapshot_revision = revision
+        return changed
+
+    def build_route_spec(self):
+        """
+        Merge the route entries of all shards into a route spec.
+
+        The returned route spec has its own host lists, so it can be modified
+        without affecting the cache.
+
+        """
+        merged         = {}
+        num_duplicates = 0
+        for key in sorted(self.shards):
+            num_duplicates += merge_routes(merged, self.shards[key].routes)
+        self.num_duplicate_cidrs = num_duplicates
+        return dict((cidr, unpack_hosts(hosts))
+                    for cidr, hosts in merged.items())
+
+    def get_data(self):
+        """
+        Return the decoded data of all shards, by key.
+
+        """
+        return dict((key, shard.data) for key, shard in self.shards.items())
+
+    def key_revisions(self):
+        """
+        Return the revisions of all shards, by key.
+
+        """
+        return dict((key, shard.revision)
+                    for key, shard in self.shards.items())
+
+    def num_groups(self):
+        """
+        Return the number of groups in the topology data of all shards.
+
+        """
+        return sum(shard.groups for shard in self.shards.values())
+
+    def max_revision(self):
+        """
+        Return the revision of the most recently changed shard.
+
+        """
+        return max([shard.revision for shard in self.shards.values()] or
+                   [None])
+
+    def get_stats(self):
+        """
+        Return the shard stats as a dictionary.
+
+        """
+        return {
+            "shards"           : len(self.shards),
+            "shards_parsed"    : self.num_shards_parsed,
+            "shards_unchanged" : self.num_shards_unchanged,
+            "shards_stale"     : self.num_shards_stale,
+            "shard_errors"     : self.num_shard_errors,
+            "duplicate_cidrs"  : self.num_duplicate_cidrs
+        }
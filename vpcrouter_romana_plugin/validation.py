@@ -0,0 +1,127 @@
+"""
+Copyright 2017 Pani Networks Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+"""
+
+#
+# Validation of route specs, entry by entry.
+#
+
+import collections
+import logging
+
+from vpcrouter        import utils
+from vpcrouter.errors import ArgsError
+
+
+# Maximum number of invalid entries listed in the stats
+MAX_REPORTED_INVALID = 20
+
+
+def validate_entry(cidr, hosts):
+    """
+    Validate a single route spec entry, with the same checks vpc-router
+    applies to a route spec.
+
+    Returns a tuple with the sorted list of valid host IPs, without
+    duplicates (None if the CIDR itself is invalid), and a list of error
+    messages.
+
+    """
+    try:
+        utils.ip_check(cidr, netmask_expected=True)
+    except ArgsError as e:
+        return None, [str(e)]
+    valid_hosts = set()
+    errors      = []
+    for ip in hosts:
+        try:
+            utils.ip_check(ip)
+            valid_hosts.add(ip)
+        except ArgsError as e:
+            errors.append(str(e))
+    return sorted(valid_hosts), errors
+
+
+class RouteSpecValidator(object):
+    """
+    Validates route specs, remembering the entries that were validated
+    before.
+
+    Only new or changed entries (CIDR and host list) are validated. Invalid
+    hosts are dropped from their entry, and entries with an invalid CIDR or
+    without any valid host are dropped from the route spec, rather than
+    failing the whole route spec.
+
+    The cache only holds the entries of the last route spec.
+
+    The validated route spec is in canonical form: Its entries are ordered by
+    CIDR and every host list is sorted, without duplicates. The same route
+    entries therefore always result in the same route spec, however they were
+    ordered in the topology data.
+
+    """
+    def __init__(self):
+        self.entries         = {}   # (cidr, hosts) -> (hosts, errors)
+        self.invalid_entries = []
+        self.num_validated   = 0
+        self.num_cached      = 0
+
+    def validate(self, route_spec):
+        """
+        Return a validated copy of the route spec, in canonical form.
+
+        Raises ValueError if none of the entries are valid.
+
+        """
+        entries = {}
+        valid   = collections.OrderedDict()
+        invalid = []
+        for cidr in sorted(route_spec):
+            hosts  = route_spec[cidr]
+            key    = (cidr, tuple(hosts))
+            result = self.entries.get(key)
+            if result is None:
+                result = validate_entry(cidr, hosts)
+                self.num_validated += 1
+                if result[1]:
+                    logging.warning("Romana watcher plugin: Invalid route "
+                                    "spec entry for '%s': %s" %
+                                    (cidr, ", ".join(result[1])))
+            else:
+                self.num_cached += 1
+            entries[key] = result
+            valid_hosts, errors = result
+            if errors:
+                invalid.append({"cidr" : cidr, "errors" : errors})
+            if valid_hosts:
+                valid[cidr] = list(valid_hosts)
+        self.entries         = entries
+        self.invalid_entries = invalid
+        if route_spec and not valid:
+            raise ValueError("No valid entries in route spec")
+        return valid
+
+    def get_stats(self):
+        """
+        Return the validation stats as a dictionary.
+
+        """
+        return {
+            "entries_validated" : self.num_validated,
+            "entries_cached"    : self.num_cached,
+            "invalid_entries"   : len(self.invalid_entries),
+            "invalid"           : self.invalid_entries[:MAX_REPORTED_INVALID]
+        }